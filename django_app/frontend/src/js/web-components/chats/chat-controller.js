@@ -1,5 +1,7 @@
 // @ts-check
 
+import { getChatSocket } from "./chat-socket.mjs";
+
 class ChatController extends HTMLElement {
   connectedCallback() {
     const messageForm = document.querySelector("#message-form"); // TO DO: Tidy this up
@@ -9,6 +11,11 @@ class ChatController extends HTMLElement {
       this.querySelector("feedback-buttons")
     );
 
+    // open the chat's socket now, so the first question doesn't wait for it
+    if (this.dataset.streamUrl) {
+      getChatSocket(this.dataset.streamUrl);
+    }
+
     messageForm?.addEventListener("submit", (evt) => {
       evt.preventDefault();
       const messageInput =
@@ -22,8 +29,8 @@ class ChatController extends HTMLElement {
         return;
       }
 
-      // Prevent message sending if there are files waiting to be processed
-      if (document.querySelectorAll('file-status [data-status]:not([data-status="complete"])').length > 0) {
+      // Prevent message sending if there are files waiting to be processed, those partly processed can be used so far
+      if (document.querySelectorAll('file-status [data-status]:not([data-status="complete"]):not([data-partial])').length > 0) {
         this.#showError("<p>You have files waiting to be processed. Please wait for these to complete and then send the message again.</p>");
         return;
       }
@@ -1,6 +1,7 @@
 // @ts-check
 
 import "../loading-message.mjs";
+import { getChatSocket } from "./chat-socket.mjs";
 
 export class ChatMessage extends HTMLElement {
   constructor() {
@@ -87,13 +88,40 @@ export class ChatMessage extends HTMLElement {
     });
 
     let responseComplete = this.querySelector(".rb-loading-complete");
-    let webSocket = new WebSocket(endPoint);
+    const chatSocket = getChatSocket(endPoint);
     let streamedContent = "";
+    /** @type {string | undefined} the id of this answer's stream, from the first message of the turn */
+    let streamId = undefined;
+    let lastSeq = 0;
+
+    // The turn is over once the server sends "end" or "error", or the socket drops, the socket stays open for the next
+    const finish = () => {
+      clearTimeout(firstResponseTimer);
+      chatSocket.removeEventListener("message", onMessage);
+      chatSocket.removeEventListener("drop", onDrop);
+      chatSocket.removeEventListener("open", resume);
+      document.removeEventListener("stop-streaming", stopStreaming);
+      this.loadingMessage?.remove();
+      if (responseComplete) {
+        responseComplete.textContent = "Response complete";
+      }
+      if (this.dataset.status === "streaming") {
+        this.dataset.status = "complete";
+      }
+      const stopStreamingEvent = new CustomEvent("stop-streaming");
+      document.dispatchEvent(stopStreamingEvent);
+    };
 
     // Stop streaming on escape-key or stop-button press
+    // Asking the server to stop lets it save the answer so far, it then sends "end"
     const stopStreaming = () => {
       this.dataset.status = "stopped";
-      webSocket.close();
+      if (chatSocket.isOpen) {
+        chatSocket.send({ type: "stop" });
+      } else {
+        chatSocket.discardPending();
+        finish();
+      }
       window["runMermaid"]();
     };
     this.addEventListener("keydown", (evt) => {
@@ -118,60 +146,60 @@ export class ChatMessage extends HTMLElement {
       /** @type {import("./message-input").MessageInput} */ (document.querySelector("message-input")).undoReset();
     }, MAX_TIME_TO_FIRST_RESPONSE);
 
-    webSocket.onopen = (event) => {
-      webSocket.send(
-        JSON.stringify({
-          message: message,
-          llm: llm,
-        })
-      );
-      this.dataset.status = "streaming";
-      const chatResponseStartEvent = new CustomEvent("chat-response-start");
-      document.dispatchEvent(chatResponseStartEvent);
+    // Once reconnected, ask for the rest of the answer from the last message received
+    const resume = () => {
+      chatSocket.send({ type: "resume", stream: streamId, seq: lastSeq });
     };
 
-    webSocket.onerror = (event) => {
-      clearTimeout(firstResponseTimer);
-      if (!this.responseContainer) {
+    // The server carries on answering for a while after the socket drops, so the answer is resumed when it reconnects,
+    // but a question the server may not have received is over
+    const onDrop = () => {
+      chatSocket.discardPending();
+      if (streamId && this.dataset.status === "streaming") {
+        chatSocket.addEventListener("open", resume, { once: true });
         return;
       }
-      this.responseContainer.innerHTML =
-        "There was a problem. Please try sending this message again.";
+      // any answer already streamed has been saved, so is left in place
+      if (this.responseContainer && !streamedContent) {
+        this.responseContainer.innerHTML =
+          "There was a problem. Please try sending this message again.";
+      }
       this.dataset.status = "error";
+      finish();
     };
 
-    webSocket.onclose = (event) => {
-      clearTimeout(firstResponseTimer);
-      this.loadingMessage?.remove();
-      if (responseComplete) {
-        responseComplete.textContent = "Response complete";
+    const onMessage = (event) => {
+      const response = /** @type {CustomEvent} */ (event).detail;
+
+      // messages of a turn are numbered in its stream, those of other turns on the chat, or already received, are ignored
+      if (response.type === "stream" && !streamId) {
+        streamId = response.stream;
+        lastSeq = response.seq;
+        return;
       }
-      if (this.dataset.status !== "stopped") {
-        this.dataset.status = "complete";
+      if (response.stream && (response.stream !== streamId || response.seq <= lastSeq)) {
+        return;
       }
-      const stopStreamingEvent = new CustomEvent("stop-streaming");
-      document.dispatchEvent(stopStreamingEvent);
-    };
-
-    webSocket.onmessage = (event) => {
+      lastSeq = response.seq ?? lastSeq;
       clearTimeout(firstResponseTimer);
-      let response;
-      try {
-        response = JSON.parse(event.data);
-      } catch (err) {
-        console.log("Error getting JSON response", err);
-      }
 
       if (response.type === "text") {
         streamedContent += response.data;
         this.responseContainer?.update(streamedContent);
+      } else if (response.type === "answer") {
+        // the whole answer, when it was finished while the socket was down
+        streamedContent = response.data;
+        this.responseContainer?.update(streamedContent);
       } else if (response.type === "session-id") {
         chatControllerRef.dataset.sessionId = response.data;
       } else if (response.type === "end") {
-        let chatMessageFooter = document.createElement("chat-message-footer");
-        chatMessageFooter.dataset.id = response.data.message_id;
-        chatMessageFooter.dataset.startText = this.querySelector("markdown-converter")?.textContent?.substring(0, 30);
-        this.parentElement?.appendChild(chatMessageFooter);
+        // an answer stopped before any of it was streamed isn't saved
+        if (response.data.message_id) {
+          let chatMessageFooter = document.createElement("chat-message-footer");
+          chatMessageFooter.dataset.id = response.data.message_id;
+          chatMessageFooter.dataset.startText = this.querySelector("markdown-converter")?.textContent?.substring(0, 30);
+          this.parentElement?.appendChild(chatMessageFooter);
+        }
 
         const chatResponseEndEvent = new CustomEvent("chat-response-end", {
           detail: {
@@ -214,7 +242,21 @@ export class ChatMessage extends HTMLElement {
           window.scrollBy(0, -TOP_POSITION);
         }
       }
+
+      if (response.type === "end" || response.type === "error") {
+        finish();
+      }
     };
+
+    chatSocket.addEventListener("message", onMessage);
+    chatSocket.addEventListener("drop", onDrop);
+    chatSocket.send({
+      message: message,
+      llm: llm,
+    });
+    this.dataset.status = "streaming";
+    const chatResponseStartEvent = new CustomEvent("chat-response-start");
+    document.dispatchEvent(chatResponseStartEvent);
   };
 
   /** This is the same as adding content to the data-text attribute, except that this also reads the content out to screen-reader users */
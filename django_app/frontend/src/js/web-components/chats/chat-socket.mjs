@@ -0,0 +1,95 @@
+// @ts-check
+
+/** Pings keep proxies from closing the socket while the user reads or types */
+const HEARTBEAT_INTERVAL = 25000;
+const FIRST_RECONNECT_DELAY = 1000;
+const MAX_RECONNECT_DELAY = 30000;
+
+/**
+ * The chat's websocket, opened with the page and shared by every turn, so a question is sent without waiting for a
+ * handshake. It reconnects after a network blip, backing off while the server can't be reached.
+ * Messages from the server are dispatched as "message" events, an "open" event is dispatched each time the socket
+ * connects, and a "drop" event when it closes.
+ */
+export class ChatSocket extends EventTarget {
+  /** @param {string} url */
+  constructor(url) {
+    super();
+    this.url = url;
+    this.reconnectDelay = FIRST_RECONNECT_DELAY;
+    /** @type {string[]} messages sent while the socket was connecting */
+    this.pending = [];
+    /** @type {number | undefined} */
+    this.heartbeat = undefined;
+    this.#connect();
+  }
+
+  #connect() {
+    this.webSocket = new WebSocket(this.url);
+
+    this.webSocket.addEventListener("open", () => {
+      this.reconnectDelay = FIRST_RECONNECT_DELAY;
+      this.pending.splice(0).forEach((data) => this.webSocket?.send(data));
+      this.heartbeat = window.setInterval(() => this.send({ type: "ping" }), HEARTBEAT_INTERVAL);
+      this.dispatchEvent(new CustomEvent("open"));
+    });
+
+    this.webSocket.addEventListener("message", (evt) => {
+      let message;
+      try {
+        message = JSON.parse(evt.data);
+      } catch (err) {
+        console.log("Error getting JSON response", err);
+        return;
+      }
+      if (message.type !== "pong") {
+        this.dispatchEvent(new CustomEvent("message", { detail: message }));
+      }
+    });
+
+    this.webSocket.addEventListener("close", () => {
+      window.clearInterval(this.heartbeat);
+      this.dispatchEvent(new CustomEvent("drop"));
+      window.setTimeout(() => this.#connect(), this.reconnectDelay);
+      this.reconnectDelay = Math.min(this.reconnectDelay * 2, MAX_RECONNECT_DELAY);
+    });
+  }
+
+  get isOpen() {
+    return this.webSocket?.readyState === WebSocket.OPEN;
+  }
+
+  /**
+   * Send a message now, or once the socket is open
+   * @param {object} message
+   */
+  send(message) {
+    const data = JSON.stringify(message);
+    if (this.isOpen) {
+      this.webSocket?.send(data);
+    } else {
+      this.pending.push(data);
+    }
+  }
+
+  /** Forget messages still waiting for the socket to open */
+  discardPending() {
+    this.pending = [];
+  }
+}
+
+/** @type {Map<string, ChatSocket>} */
+const chatSockets = new Map();
+
+/**
+ * The page's socket for this endpoint, opening it if need be
+ * @param {string} url
+ */
+export const getChatSocket = (url) => {
+  let chatSocket = chatSockets.get(url);
+  if (!chatSocket) {
+    chatSocket = new ChatSocket(url);
+    chatSockets.set(url, chatSocket);
+  }
+  return chatSocket;
+};
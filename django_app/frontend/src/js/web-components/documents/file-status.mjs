@@ -1,7 +1,31 @@
 // @ts-check
-import { html } from "lit";
+import { html, nothing } from "lit";
 import { RedboxElement } from "../redbox-element.mjs";
 
+/** @type {WebSocket | null} */
+let statusSocket = null;
+/** the most recent status pushed for each file, kept in case it arrives before the file's id is known */
+const pushedStatus = new Map();
+
+/**
+ * Open the chat's file status websocket, shared by every file-status element on the page
+ * @param {string | undefined} url
+ */
+const subscribeToFileStatus = (url) => {
+  if (!url || (statusSocket && statusSocket.readyState <= WebSocket.OPEN)) {
+    return;
+  }
+  statusSocket = new WebSocket(url);
+  statusSocket.addEventListener("message", (evt) => {
+    const message = JSON.parse(evt.data);
+    if (message.type !== "file-status") {
+      return;
+    }
+    pushedStatus.set(message.data.id, { ...pushedStatus.get(message.data.id), ...message.data });
+    document.dispatchEvent(new CustomEvent("file-status", { detail: message.data }));
+  });
+};
+
 
 class FileStatus extends RedboxElement {
 
@@ -15,18 +39,22 @@ class FileStatus extends RedboxElement {
     status: { type: String, state: true },
     positionInQueue: { type: Number, state: true },
     name: { type: String, attribute: "data-name" },
-    tokens: { type: Number, state: true }
+    tokens: { type: Number, state: true },
+    progress: { type: Number, state: true }
   };
 
   connectedCallback() {
     super.connectedCallback();
     this.status = this.textContent || "Uploading";
     this.tokens = 0;
+    subscribeToFileStatus(/** @type {HTMLElement | null} */ (this.closest("[data-status-url]"))?.dataset.statusUrl);
+    document.addEventListener("file-status", this.#onPushedStatus);
     this.#checkStatus();
   }
 
   disconnectedCallback() {
     super.disconnectedCallback();
+    document.removeEventListener("file-status", this.#onPushedStatus);
     this.status = "Error"; // to prevent additional requests
   }
 
@@ -36,6 +64,8 @@ class FileStatus extends RedboxElement {
     if (this.status === "Processing" && this.positionInQueue > 0) {
       statusText = `${this.positionInQueue} ahead in queue`;
       statusAttr = "queued";
+    } else if (this.status === "Processing" && this.progress) {
+      statusText = `Processing ${this.progress}%`;
     }
 
     let icon;
@@ -53,7 +83,7 @@ class FileStatus extends RedboxElement {
 
     return html`
       ${icon}
-      <span data-status=${statusAttr} data-tokens=${this.tokens} data-name=${this.name} aria-live="assertive" aria-atomic="true">
+      <span data-status=${statusAttr} data-tokens=${this.tokens} data-name=${this.name} data-partial=${this.status === "Processing" && this.progress ? "true" : nothing} aria-live="assertive" aria-atomic="true">
         ${statusText}
         <span class="govuk-visually-hidden">${this.name}</span>
       </span>
@@ -69,6 +99,25 @@ class FileStatus extends RedboxElement {
     document.dispatchEvent(fileErrorEvent);
   }
 
+  #onPushedStatus = (/** @type {CustomEvent} */ evt) => {
+    if (evt.detail.id === this.id && this.status !== "Complete" && this.status !== "Error") {
+      this.#updateStatus(evt.detail);
+    }
+  };
+
+  /**
+   * @param {{status: string, position_in_queue?: number, tokens?: number, progress?: number}} fileStatus
+   */
+  #updateStatus(fileStatus) {
+    this.status = fileStatus.status;
+    this.positionInQueue = fileStatus.position_in_queue ?? -1;
+    this.tokens = fileStatus.tokens || 0;
+    this.progress = fileStatus.progress || 0;
+    if (fileStatus.status.toLowerCase() === "error") {
+      this.#sendErrorEvent();
+    }
+  }
+
   async #checkStatus () {
 
     // UPDATE THESE AS REQUIRED
@@ -92,20 +141,19 @@ class FileStatus extends RedboxElement {
       return;
     }
 
-    const response = await fetch(
-      `${FILE_STATUS_ENDPOINT}?id=${this.id}`
-    );
-    const responseObj = await response.json();
-    this.status = responseObj.status;
-    this.positionInQueue = responseObj.position_in_queue;
-    this.tokens = responseObj.tokens || 0;
+    if (pushedStatus.has(this.id)) {
+      this.#updateStatus(pushedStatus.get(this.id));
+    }
 
-    if (responseObj.status.toLowerCase() === "error") {
-      this.#sendErrorEvent();
-      return;
+    // while the websocket is open it pushes every change, polling is only a fallback for when it is not
+    if (statusSocket?.readyState !== WebSocket.OPEN && this.status !== "Complete" && this.status !== "Error") {
+      const response = await fetch(
+        `${FILE_STATUS_ENDPOINT}?id=${this.id}`
+      );
+      this.#updateStatus(await response.json());
     }
 
-    if (responseObj.status === "Complete") {
+    if (this.status === "Complete" || this.status === "Error") {
       return;
     }
 
@@ -0,0 +1,59 @@
+"""Text extraction from uploads, which the ingest worker runs in a process of its own.
+
+The extraction is capped at a memory limit, which applies to the whole process it is set in. The worker has threads
+of its own, such as those that publish file status over the channel layer, so the limit is set in a child process that
+does nothing but extract, and a document too large for it fails with a MemoryError rather than those threads.
+"""
+
+import contextlib
+import logging
+import resource
+from collections.abc import Iterator
+from pathlib import Path
+
+import pdfminer.high_level
+from markitdown import MarkItDown
+from pdfminer.pdfpage import PDFPage
+
+md = MarkItDown()
+
+
+@contextlib.contextmanager
+def memory_limit(limit_bytes: int) -> Iterator[None]:
+    """Cap how much address space, and so resident memory, the process can grow by while in this block.
+
+    An oversized document then fails with a MemoryError rather than the OOM killer taking out the whole worker.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    try:
+        current = int(Path("/proc/self/statm").read_text().split()[0]) * resource.getpagesize()
+    except OSError:
+        logging.warning("cannot read the size of this process, ingest memory is not limited")
+        yield
+        return
+
+    limit = current + limit_bytes
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def convert(path: Path, limit_bytes: int) -> str:
+    """the text of a document that is not a PDF, converted whole"""
+    with memory_limit(limit_bytes):
+        return md.convert_local(path).text_content
+
+
+def count_pdf_pages(path: Path, limit_bytes: int) -> int:
+    with memory_limit(limit_bytes), path.open("rb") as fp:
+        return sum(1 for _ in PDFPage.get_pages(fp))
+
+
+def extract_pdf_pages(path: Path, pages: range, limit_bytes: int) -> str:
+    """the text of a range of the pages of a PDF"""
+    with memory_limit(limit_bytes):
+        return pdfminer.high_level.extract_text(path, page_numbers=pages)
@@ -178,9 +178,9 @@ class FileInline(admin.StackedInline):
         "ingest_error",
         "chat",
         "token_count",
-        "task",
+        "ingest_task",
     )  # do not include 'text' as it contravenes our DPIA
-    readonly_fields = ("status", "original_file", "ingest_error", "chat", "token_count", "task")
+    readonly_fields = ("status", "original_file", "ingest_error", "chat", "token_count", "ingest_task")
     extra = 0
 
 
@@ -235,9 +235,9 @@ class FileAdmin(ExportMixin, admin.ModelAdmin):
         "ingest_error",
         "chat",
         "token_count",
-        "task",
+        "ingest_task",
     )  # do not include 'text' as it contravenes our DPIA
-    readonly_fields = ("status", "original_file", "ingest_error", "chat", "token_count", "task")
+    readonly_fields = ("status", "original_file", "ingest_error", "chat", "token_count", "ingest_task")
 
 
 admin.site.register(models.DepartmentBusinessUnit, DepartmentBusinessUnitAdmin)
@@ -0,0 +1,146 @@
+"""Fair admission of chat turns to each LLM backend.
+
+Turns wait in a queue per backend, in this process, and are admitted one at a time as the backend's TokenBucket allows.
+Waiting turns are taken from each department in turn, and within a department from each user in turn, so that one busy
+user or department cannot hold everyone else up. A turn cancelled while it waits, because its client has gone, simply
+leaves the queue.
+
+The queue is held in memory, so this fairness only holds among the turns of one process. Each process running the
+consumers, such as each replica of the web service, has queues of its own, and they only share the backend's
+TokenBucket: a DatabaseTokenBucket keeps their combined traffic within its rate_limit, but a busy user on one replica
+is not taken in turn with users waiting on another.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from redbox_app.redbox_core.rate_limit import get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(eq=False)
+class Ticket:
+    """A turn waiting to be admitted. on_position is told each new place in the queue, counting from 1, and 0 once
+    it is at the front but waiting for the rate limit."""
+
+    user: str
+    department: str | None
+    tokens: int
+    on_position: Callable[[int], Awaitable[None]] | None = None
+    position: int = 0
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    ready: bool = False
+
+
+class AdmissionQueue:
+    def __init__(self):
+        # round robin over departments, then over users, by moving each to the end once it has had a turn
+        self._waiting: dict[str | None, dict[str, deque[Ticket]]] = {}
+        self._admitting = False
+
+    def __len__(self) -> int:
+        return sum(len(tickets) for users in self._waiting.values() for tickets in users.values())
+
+    def order(self) -> list[Ticket]:
+        """the waiting tickets, in the order they will be admitted"""
+        departments = deque(deque(deque(tickets) for tickets in users.values()) for users in self._waiting.values())
+        order = []
+        while departments:
+            users = departments.popleft()
+            tickets = users.popleft()
+            order.append(tickets.popleft())
+            if tickets:
+                users.append(tickets)
+            if users:
+                departments.append(users)
+        return order
+
+    async def admit(self, ticket: Ticket, chat_backend) -> float:
+        """wait for the ticket's turn and for its tokens to be available, returning the seconds waited, or 0 if it
+        was admitted at once"""
+        started = time.monotonic()
+        self._waiting.setdefault(ticket.department, {}).setdefault(ticket.user, deque()).append(ticket)
+        try:
+            self._update()
+            queued = not ticket.ready
+            reported = None
+            while not ticket.ready:
+                ticket.changed.clear()
+                if ticket.on_position and ticket.position != reported:
+                    reported = ticket.position
+                    await ticket.on_position(reported)
+                await ticket.changed.wait()
+        except BaseException:
+            # cancelled, or failed telling the client its place, so leave the queue
+            if ticket.ready:
+                # given its turn just as it left, so pass the turn on
+                self._admitting = False
+            else:
+                self._remove(ticket)
+            self._update()
+            raise
+
+        delay = 0.0
+        reserved = False
+        try:
+            delay = await sync_to_async(get_rate_limiter().reserve)(chat_backend, ticket.tokens)
+            reserved = True
+            if delay > settings.MESSAGE_THROTTLE_SECONDS_MAX:
+                logger.error("delay=%s > %s, this will be capped", delay, settings.MESSAGE_THROTTLE_SECONDS_MAX)
+                delay = settings.MESSAGE_THROTTLE_SECONDS_MAX
+            if delay > settings.MESSAGE_THROTTLE_SECONDS_MIN and ticket.on_position:
+                await ticket.on_position(0)
+            await asyncio.sleep(delay)
+        except BaseException:
+            if reserved:
+                await asyncio.shield(sync_to_async(get_rate_limiter().refund)(chat_backend, ticket.tokens))
+            raise
+        finally:
+            self._admitting = False
+            self._update()
+        return time.monotonic() - started if queued or delay else 0.0
+
+    def _remove(self, ticket: Ticket) -> None:
+        users = self._waiting[ticket.department]
+        users[ticket.user].remove(ticket)
+        if not users[ticket.user]:
+            del users[ticket.user]
+        if not users:
+            del self._waiting[ticket.department]
+
+    def _update(self) -> None:
+        """give the front ticket its turn if no other is being admitted, and tell the rest their places"""
+        if not self._admitting and self._waiting:
+            department, users = next(iter(self._waiting.items()))
+            user, tickets = next(iter(users.items()))
+            head = tickets[0]
+            self._remove(head)
+            # the head's user and department go to the back of the round robin
+            if user in users:
+                users[user] = users.pop(user)
+            if department in self._waiting:
+                self._waiting[department] = self._waiting.pop(department)
+            self._admitting = True
+            head.ready = True
+            head.changed.set()
+
+        for position, ticket in enumerate(self.order(), 1):
+            if ticket.position != position:
+                ticket.position = position
+                ticket.changed.set()
+
+
+admission_queues: dict[object, AdmissionQueue] = {}
+
+
+def get_admission_queue(chat_backend) -> AdmissionQueue:
+    """the queue of turns waiting for this backend in this process"""
+    return admission_queues.setdefault(chat_backend.pk, AdmissionQueue())
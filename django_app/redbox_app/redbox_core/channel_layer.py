@@ -0,0 +1,256 @@
+"""A channel layer on Postgres LISTEN/NOTIFY, so that consumers in every web process, and the worker, can reach each
+other through the database they already share.
+
+Every process LISTENs on one connection, in a thread of its own, and NOTIFYs from another. Each message is notified
+to every process, saying the channel or group it is for, and each process delivers it to the channels of its own
+consumers, so a group's members are only known to the processes they are in. NOTIFY payloads must be under 8000
+bytes, so larger messages are notified in parts and put back together by each listener. Messages must be JSON.
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import select
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, ClassVar
+
+import psycopg2
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.db import DatabaseError, connection, connections
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY payloads must be shorter than 8000 bytes, each part holds this much of the message once escaped again
+PAYLOAD_LIMIT = 7900
+PART_SIZE = 3900
+
+
+class PostgresChannelLayer(BaseChannelLayer):
+    extensions: ClassVar[list[str]] = ["groups", "flush"]
+
+    def __init__(
+        self,
+        expiry=60,
+        capacity=100,
+        channel_capacity=None,
+        pg_channel: str = "channel_layer",
+        poll_interval: float = 1.0,
+        listen_timeout: float = 5.0,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.pg_channel = pg_channel
+        self.poll_interval = poll_interval
+        self.listen_timeout = listen_timeout
+        self.client_prefix = uuid.uuid4().hex
+        self.listening = threading.Event()
+        self._channels: dict[str, tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = {}
+        self._groups: dict[str, set[str]] = defaultdict(set)
+        self._parts: dict[str, tuple[float, list[str | None]]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        # one thread, and so one connection, sends every notification, in the order they were sent
+        self._publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="channel-layer-notify")
+
+    async def new_channel(self, prefix: str = "specific.") -> str:
+        """a channel for a consumer in this process, whose messages are delivered by this process's listener"""
+        name = f"{prefix}{self.client_prefix}!{uuid.uuid4().hex}"
+        self._queue(name)
+        self._ensure_listening()
+        return name
+
+    async def send(self, channel: str, message: dict[str, Any]) -> None:
+        assert isinstance(message, dict), "message is not a dict"  # noqa: S101
+        self.require_valid_channel_name(channel)
+
+        with self._lock:
+            local = self._channels.get(channel)
+        if local is not None and "!" in channel:
+            loop, queue = local
+            if queue.full():
+                raise ChannelFull(channel)
+            loop.call_soon_threadsafe(self._put, channel, queue, (time.time() + self.expiry, copy.deepcopy(message)))
+            return
+        await self._notify({"channel": channel, "message": message})
+
+    async def receive(self, channel: str) -> dict[str, Any]:
+        self.require_valid_channel_name(channel)
+        self._ensure_listening()
+        _, queue = self._queue(channel)
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        except asyncio.CancelledError:
+            # the consumer has stopped, so its channel goes with it
+            if queue.empty():
+                self._discard(channel)
+            raise
+
+    async def group_add(self, group: str, channel: str) -> None:
+        """add the channel to the group, once this process is listening, so that nothing sent after this returns is
+        missed, raising TimeoutError if it is not listening within listen_timeout"""
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        with self._lock:
+            self._groups[group].add(channel)
+        self._ensure_listening()
+        if not await asyncio.to_thread(self.listening.wait, self.listen_timeout):
+            msg = f"channel layer is not listening on {self.pg_channel}"
+            raise TimeoutError(msg)
+
+    async def group_discard(self, group: str, channel: str) -> None:
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        with self._lock:
+            members = self._groups.get(group, set())
+            members.discard(channel)
+            if not members:
+                self._groups.pop(group, None)
+
+    async def group_send(self, group: str, message: dict[str, Any]) -> None:
+        assert isinstance(message, dict), "message is not a dict"  # noqa: S101
+        self.require_valid_group_name(group)
+        await self._notify({"group": group, "message": message})
+
+    async def flush(self) -> None:
+        with self._lock:
+            self._channels.clear()
+            self._groups.clear()
+            self._parts.clear()
+
+    async def close(self) -> None:
+        """stop listening, and close the connections to the database"""
+        await asyncio.to_thread(self.stop)
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # connection is looked up in the publisher's thread, to close that thread's own
+        self._publisher.submit(lambda: connection.close()).result()
+
+    async def _notify(self, envelope: dict[str, Any]) -> None:
+        payload = json.dumps(envelope)
+        if len(payload) <= PAYLOAD_LIMIT:
+            payloads = [payload]
+        else:
+            parts = range(0, len(payload), PART_SIZE)
+            message_id = uuid.uuid4().hex
+            payloads = [
+                json.dumps(
+                    {"id": message_id, "part": i, "parts": len(parts), "data": payload[start : start + PART_SIZE]}
+                )
+                for i, start in enumerate(parts)
+            ]
+        await asyncio.get_running_loop().run_in_executor(self._publisher, self._execute_notify, payloads)
+
+    def _execute_notify(self, payloads: list[str]) -> None:
+        try:
+            self._pg_notify(payloads)
+        except DatabaseError:
+            # the connection may have been dropped since the last notification
+            logger.warning("lost the channel layer's notify connection, reconnecting")
+            connection.close()
+            self._pg_notify(payloads)
+
+    def _pg_notify(self, payloads: list[str]) -> None:
+        with connection.cursor() as cursor:
+            for payload in payloads:
+                cursor.execute("SELECT pg_notify(%s, %s)", [self.pg_channel, payload])
+
+    def _queue(self, channel: str) -> tuple[asyncio.AbstractEventLoop, asyncio.Queue]:
+        with self._lock:
+            if channel not in self._channels:
+                self._channels[channel] = (asyncio.get_running_loop(), asyncio.Queue(self.get_capacity(channel)))
+            return self._channels[channel]
+
+    def _discard(self, channel: str) -> None:
+        with self._lock:
+            self._channels.pop(channel, None)
+            for group in [group for group, members in self._groups.items() if channel in members]:
+                self._groups[group].discard(channel)
+                if not self._groups[group]:
+                    del self._groups[group]
+
+    @staticmethod
+    def _put(channel: str, queue: asyncio.Queue, item: tuple[float, dict[str, Any]]) -> None:
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logger.warning("channel %s is full, message dropped", channel)
+
+    def _ensure_listening(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="channel-layer-listener", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._listen()
+                except (DatabaseError, psycopg2.Error):
+                    logger.exception("lost the channel layer's listen connection, reconnecting")
+                    self.listening.clear()
+                    connection.close()
+                    time.sleep(self.poll_interval)
+        finally:
+            self.listening.clear()
+            connection.close()
+
+    def _listen(self) -> None:
+        # connection is this thread's own, so it is not shared with any request
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.pg_channel}"')
+        raw = connections["default"].connection
+        self.listening.set()
+
+        while not self._stop.is_set():
+            if select.select([raw], [], [], self.poll_interval) == ([], [], []):
+                continue
+            raw.poll()
+            while raw.notifies:
+                if envelope := self._assemble(json.loads(raw.notifies.pop(0).payload)):
+                    self._dispatch(envelope)
+
+    def _assemble(self, payload: dict[str, Any]) -> dict[str, Any] | None:
+        """the envelope, once every part of it has arrived"""
+        if "parts" not in payload:
+            return payload
+
+        now = time.time()
+        # parts of messages from a sender that stopped part way are never completed
+        for message_id, (started, _) in list(self._parts.items()):
+            if started < now - self.expiry:
+                del self._parts[message_id]
+
+        _, parts = self._parts.setdefault(payload["id"], (now, [None] * payload["parts"]))
+        parts[payload["part"]] = payload["data"]
+        if any(part is None for part in parts):
+            return None
+        del self._parts[payload["id"]]
+        return json.loads("".join(parts))
+
+    def _dispatch(self, envelope: dict[str, Any]) -> None:
+        with self._lock:
+            names = list(self._groups.get(envelope["group"], ())) if "group" in envelope else [envelope["channel"]]
+            targets = [(name, self._channels[name]) for name in names if name in self._channels]
+
+        expires = time.time() + self.expiry
+        for name, (loop, queue) in targets:
+            try:
+                loop.call_soon_threadsafe(self._put, name, queue, (expires, copy.deepcopy(envelope["message"])))
+            except RuntimeError:
+                logger.debug("channel %s's event loop has closed, dropping message", name)
@@ -1,21 +1,32 @@
 import asyncio
+import contextlib
 import json
 import logging
+import uuid
 from collections.abc import Mapping
+from datetime import UTC, datetime
 from typing import Any
 
 from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from langchain_core.messages import AIMessage
 from openai import RateLimitError
 
-from redbox import run_async
+from redbox import RedboxState, run_async, run_map_reduce
 from redbox_app.redbox_core import error_messages
+from redbox_app.redbox_core.admission import Ticket, get_admission_queue
 from redbox_app.redbox_core.models import (
+    Chat,
     ChatMessage,
+    File,
+    IngestTask,
     get_chat_session,
 )
+from redbox_app.redbox_core.notifications import FILE_QUEUE_GROUP, chat_files_group, chat_group, file_status
+from redbox_app.redbox_core.rate_limit import get_rate_limiter, tokens_used
+from redbox_app.redbox_core.streams import AnswerStream, Resumption, stream_group
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
@@ -23,66 +34,472 @@ logger.info("WEBSOCKET_SCHEME is: %s", settings.WEBSOCKET_SCHEME)
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    """Answer the turns of one chat over a socket kept open for the life of the chat page, holding the Chat and the
+    user's department between turns so that each question after the first starts without a handshake or reload."""
+
+    turn: asyncio.Task | None = None
+    # from a question until its answer or error is sent, the turn then goes on to refund its unused tokens
+    answering = False
+    disconnected = False
+    # the turn answered here, kept for a browser that reconnects to resume
+    stream: AnswerStream | None = None
+    # after a disconnect, the turn is stopped unless a browser resumes it in time
+    abandoning: asyncio.TimerHandle | None = None
+    # a turn answered elsewhere that the browser is resuming on this socket
+    resumption: Resumption | None = None
+    resuming: asyncio.Task | None = None
+    chat: Chat | None = None
+    department: str | None = None
+    # the other sockets on the chat, in any process, the only ones the turns answered here are published to
+    peers: frozenset[str] | set[str] = frozenset()
+
+    async def connect(self):
+        if not await self.owns_chat():
+            await self.close()
+            return
+
+        # every socket on the chat, in any process, hears the turns answered on the others
+        self.group = chat_group(self.scope["url_route"]["kwargs"]["chat_id"])
+        self.groups.append(self.group)
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.accept()
+        self.peers = set()
+        await self.channel_layer.group_send(self.group, {"type": "chat.join", "sender": self.channel_name})
+
     async def receive(self, text_data=None, _bytes_data=None):
-        """Receive & respond to message from browser websocket."""
+        """Receive a message from the browser websocket, and answer it in a task of its own so that a disconnect
+        or a stop message is seen while the answer is queued or streaming."""
 
         data = json.loads(text_data)
         logger.debug("received %s from browser", data)
 
+        if data.get("type") == "ping":
+            await self.reply("pong")
+            return
+
+        if data.get("type") in ("stop", "resume") and not await self.owns_chat():
+            await self.close()
+            return
+
+        if data.get("type") == "stop":
+            await self.stop()
+            return
+
+        if data.get("type") == "resume":
+            self.resuming = asyncio.create_task(self.resume(data.get("stream"), data.get("seq", 0)))
+            return
+
         try:
             user: User = self.scope["user"]
             chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
         except KeyError:
             await self.close()
-            await self.send_to_client("error", error_messages.CORE_ERROR_MESSAGE)
+            await self.reply("error", error_messages.CORE_ERROR_MESSAGE)
             raise
 
+        if self.answering:
+            await self.reply("error", error_messages.TURN_IN_PROGRESS)
+            return
+
+        self.answering = True
+        self.turn = asyncio.create_task(self.answer(user, chat_id, data, previous=self.turn))
+        self.turn.add_done_callback(self.turn_done)
+
+    async def owns_chat(self) -> bool:
+        """is the socket's chat the user's own, so that no one else can hear, stop or resume its answers"""
+        user: User = self.scope.get("user")
+        chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
+        return bool(user and user.is_authenticated) and await Chat.objects.filter(id=chat_id, user=user).aexists()
+
+    def turn_done(self, turn: asyncio.Task) -> None:
+        # a turn that ends without an answer or an error, such as one whose socket has gone, is over too
+        if turn is self.turn:
+            self.answering = False
+
+    async def disconnect(self, _code):
+        self.disconnected = True
+        if self.groups:
+            await self.channel_layer.group_send(self.group, {"type": "chat.leave", "sender": self.channel_name})
+        if self.resuming is not None:
+            self.resuming.cancel()
+        if self.answering and settings.STREAM_RESUME_SECONDS:
+            # the answer goes on, for the browser to resume when it reconnects
+            self.abandoning = asyncio.get_running_loop().call_later(settings.STREAM_RESUME_SECONDS, self.abandon)
+        else:
+            await self.stop()
+
+    def abandon(self) -> None:
+        """stop the turn of a socket that has gone, as no browser has resumed it"""
+        if self.turn is not None:
+            self.turn.cancel()
+
+    def keep_answering(self) -> None:
+        """a browser has resumed the turn"""
+        if self.abandoning is not None:
+            self.abandoning.cancel()
+
+    async def stop(self) -> None:
+        """cancel the turn in progress, a turn waiting for admission leaves the queue and the answer so far of one
+        that is streaming is saved as truncated"""
+        if self.turn is not None and not self.turn.done():
+            self.turn.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.turn
+        elif self.resumption is not None:
+            # the turn being resumed here is answered by another socket
+            await self.channel_layer.group_send(
+                stream_group(self.resumption.stream_id),
+                {"type": "chat.stop", "chat_id": str(self.scope["url_route"]["kwargs"]["chat_id"])},
+            )
+
+    async def answer(self, user: User, chat_id, data: dict, previous: asyncio.Task | None = None) -> None:
+        """answer the question once the previous turn is over, keeping the answer's stream for resuming until the
+        answer is saved"""
+        if previous is not None:
+            await asyncio.wait([previous])
+        self.stream = AnswerStream(chat_id, on_resume=self.keep_answering, on_stop=self.abandon)
+        server = asyncio.create_task(self.stream.serve(self.channel_layer))
         try:
-            chat, delay = await sync_to_async(get_chat_session)(chat_id=chat_id, user=user, data=data)
+            await self.send_to_client("stream")
+            await self.answer_question(user, chat_id, data)
+        finally:
+            server.cancel()
+            if self.abandoning is not None:
+                self.abandoning.cancel()
+
+    async def start_session(self, user: User, chat_id, data: dict) -> tuple[Chat, int] | None:
+        """the Chat with the question added and the tokens its answer reserves, or None once an error is sent"""
+        first_turn = self.chat is None
+        try:
+            chat, _, reserved = await sync_to_async(get_chat_session)(
+                chat_id=chat_id, user=user, data=data, allow_map_reduce=True, reserve=False, chat=self.chat
+            )
+            if first_turn:
+                self.department = (
+                    await User.objects.filter(id=user.id).values_list("business_unit__department", flat=True).afirst()
+                )
         except ValueError as e:
-            await self.send_to_client("error", e.args[0])
-            await self.close()
+            await self.finish("error", e.args[0])
+            return None
+        except Exception as e:
+            logger.exception("Error starting the chat session.", exc_info=e)
+            await self.finish("error", error_messages.CORE_ERROR_MESSAGE)
+            return None
+        self.chat = chat
+        return chat, reserved
+
+    async def answer_question(self, user: User, chat_id, data: dict) -> None:
+        started = datetime.now(tz=UTC)
+        self.streamed: list[str] = []
+        if (session := await self.start_session(user, chat_id, data)) is None:
             return
+        chat, reserved = session
+        session_duration = datetime.now(tz=UTC) - started
 
-        if delay > settings.MESSAGE_THROTTLE_SECONDS_MIN:
-            await self.send_to_client("info", "Due to high demand your message is being queued")
-            if delay > settings.MESSAGE_THROTTLE_SECONDS_MAX:
-                logger.error("delay=%s > %s, this will be capped", delay, settings.MESSAGE_THROTTLE_SECONDS_MAX)
-            await asyncio.sleep(max(delay, settings.MESSAGE_THROTTLE_SECONDS_MAX))
+        ticket = Ticket(
+            user=str(user.id), department=self.department, tokens=reserved, on_position=self.handle_position
+        )
+        try:
+            delay = await get_admission_queue(chat.chat_backend).admit(ticket, chat.chat_backend)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.save_truncated(chat, 0.0, session_duration))
+            raise
+        except Exception as e:
+            # the ticket has left the queue, and any tokens it reserved are refunded
+            logger.exception("Error waiting for admission.", exc_info=e)
+            await self.finish("error", error_messages.CORE_ERROR_MESSAGE)
+            return
 
         await self.send_to_client("info", "Loading")
 
-        state = await sync_to_async(chat.to_langchain)()
-
+        generating = False
+        used = 0
+        saving: asyncio.Future | None = None
         try:
-            state, time_to_first_token = await run_async(
-                state,
-                response_tokens_callback=self.handle_text,
+            started = datetime.now(tz=UTC)
+            map_reduce = await sync_to_async(chat.needs_map_reduce)()
+            state = await sync_to_async(chat.to_langchain)(retrieval=not map_reduce)
+            prompt_build_duration = datetime.now(tz=UTC) - started
+
+            generating = True
+            state = await self.generate(state, map_reduce)
+            used = tokens_used(state, reserved)
+
+            # once the answer is whole, a stop no longer cuts it short
+            saving = asyncio.ensure_future(
+                self.save_answer(
+                    chat,
+                    delay=delay,
+                    session_duration=session_duration,
+                    **ChatMessage.response_fields(state, prompt_build_duration),
+                )
             )
+            await asyncio.shield(saving)
+            await sync_to_async(chat.compact)()
 
+        except RateLimitError as e:
+            logger.exception("Rate limit error", exc_info=e)
+            await self.finish("error", error_messages.RATE_LIMITED)
+
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError) and asyncio.current_task().cancelling():
+                # stopped by the user, rather than the LLM call failing
+                if saving is not None:
+                    await asyncio.shield(saving)
+                else:
+                    if generating:
+                        used = tokens_used(AIMessage(content="".join(self.streamed)), reserved)
+                    await asyncio.shield(self.save_truncated(chat, delay, session_duration))
+                raise
+            logger.exception("General error.", exc_info=e)
+            await self.finish("error", error_messages.CORE_ERROR_MESSAGE)
+
+        finally:
+            await asyncio.shield(sync_to_async(get_rate_limiter().refund)(chat.chat_backend, reserved - used))
+
+    async def save_answer(self, chat: Chat, **fields) -> None:
+        message = await ChatMessage.objects.acreate(id=self.stream.id, chat=chat, **fields)
+        await self.finish("end", {"message_id": message.id, "title": chat.name, "session_id": chat.id})
+
+    async def save_truncated(self, chat: Chat, delay: float, session_duration) -> None:
+        """save the answer streamed before the turn was stopped, if any, and tell the browser if it is still there"""
+        message = None
+        if text := "".join(self.streamed):
             message = await ChatMessage.objects.acreate(
+                id=self.stream.id,
                 chat=chat,
-                text=state.content,
+                text=text,
                 role=ChatMessage.Role.ai,
+                truncated=True,
                 delay=delay,
-                time_to_first_token=time_to_first_token,
+                session_duration=session_duration,
             )
+        await self.finish(
+            "end",
+            {"message_id": message and message.id, "title": chat.name, "session_id": chat.id, "truncated": True},
+        )
 
-            await self.send_to_client("end", {"message_id": message.id, "title": chat.name, "session_id": chat.id})
+    async def generate(self, state: RedboxState, map_reduce: bool) -> AIMessage:
+        """stream the answer to the browser, from the whole of the documents at once or a part at a time"""
+        if map_reduce:
+            response, _ = await run_map_reduce(
+                state,
+                response_tokens_callback=self.handle_text,
+                progress_callback=self.handle_progress,
+                concurrency=settings.MAP_REDUCE_CONCURRENCY,
+                flush_interval=settings.STREAM_FLUSH_INTERVAL_MS / 1000,
+                flush_chars=settings.STREAM_FLUSH_CHARS,
+            )
+        else:
+            response, _ = await run_async(
+                state,
+                response_tokens_callback=self.handle_text,
+                response_cache=settings.RESPONSE_CACHE,
+                flush_interval=settings.STREAM_FLUSH_INTERVAL_MS / 1000,
+                flush_chars=settings.STREAM_FLUSH_CHARS,
+            )
+        return response
 
-        except RateLimitError as e:
-            logger.exception("Rate limit error", exc_info=e)
-            await self.send_to_client("error", error_messages.RATE_LIMITED)
+    async def finish(self, message_type: str, data: str | Mapping[str, Any] | None = None) -> None:
+        """send the answer's end, or its error, after which the next question can be asked"""
+        self.answering = False
+        await self.send_to_client(message_type, data)
 
-        except BaseException as e:
-            logger.exception("General error.", exc_info=e)
-            await self.send_to_client("error", error_messages.CORE_ERROR_MESSAGE)
+    async def send_to_client(self, message_type: str, data: str | Mapping[str, Any] | None = None) -> None:
+        """send a message of the turn to this socket, and to the others on the chat, numbered in its stream"""
+        seq, text = self.stream.add({"type": message_type, "data": data})
+        if not self.disconnected:
+            await self.send(text)
+        # each message published is a NOTIFY through the database, so only when another socket may hear it, or one
+        # resuming the turn, which after a disconnect would otherwise miss what is streamed after its backlog
+        if not (self.peers or self.disconnected or self.stream.resumed):
+            return
+        await self.channel_layer.group_send(
+            self.group,
+            {
+                "type": "chat.event",
+                "text": text,
+                "sender": self.channel_name,
+                "stream": str(self.stream.id),
+                "seq": seq,
+            },
+        )
 
-        await self.close()
+    async def reply(self, message_type: str, data: str | Mapping[str, Any] | None = None) -> str:
+        """send to this socket only"""
+        text = json.dumps({"type": message_type, "data": data}, default=str)
+        if not self.disconnected:
+            await self.send(text)
+        return text
 
-    async def send_to_client(self, message_type: str, data: str | Mapping[str, Any] | None = None) -> None:
-        message = {"type": message_type, "data": data}
-        await self.send(json.dumps(message, default=str))
+    async def chat_event(self, event: dict[str, Any]):
+        """pass on what is sent about a turn answered on another socket on this chat, unless answering one here"""
+        if event["sender"] == self.channel_name or self.disconnected:
+            return
+        resumption = self.resumption
+        if resumption is not None and event.get("stream") == resumption.stream_id:
+            if not resumption.live:
+                resumption.held.append((event["seq"], event["text"]))
+                return
+            for text in resumption.take([(event["seq"], event["text"])]):
+                await self.send(text)
+        elif not self.answering:
+            await self.send(event["text"])
+
+    async def chat_join(self, event: dict[str, Any]):
+        """another socket has opened on the chat, which is told of this one in turn, and of the turn answered here
+        so that it can be sent what was streamed before it was heard of"""
+        if event["sender"] == self.channel_name:
+            return
+        self.peers.add(event["sender"])
+        peer = {"type": "chat.peer", "sender": self.channel_name}
+        if self.answering and self.stream is not None:
+            peer["stream"] = str(self.stream.id)
+        await self.channel_layer.send(event["sender"], peer)
+
+    async def chat_peer(self, event: dict[str, Any]):
+        self.peers.add(event["sender"])
+        if event.get("stream") and not self.answering and self.resumption is None:
+            self.resuming = asyncio.create_task(self.resume(event["stream"], 0))
+
+    async def chat_leave(self, event: dict[str, Any]):
+        self.peers.discard(event["sender"])
+
+    async def chat_backlog(self, event: dict[str, Any]):
+        resumption = self.resumption
+        if resumption is not None and event["stream"] == resumption.stream_id and not resumption.backlog.done():
+            resumption.backlog.set_result(event["messages"])
+
+    async def resume(self, stream_id: str, seq: int) -> None:
+        """send what the browser missed of an answer after its socket dropped, from the process still answering it,
+        or from the saved message once it is complete"""
+        try:
+            stream_id = uuid.UUID(stream_id)
+        except (TypeError, ValueError):
+            await self.reply("error", error_messages.ANSWER_LOST)
+            return
+        # what is heard of the stream from now on is held back until the backlog is sent
+        self.resumption = resumption = Resumption(stream_id, seq)
+        if await self.send_saved(stream_id):
+            self.resumption = None
+            return
+
+        await self.channel_layer.group_send(
+            stream_group(stream_id),
+            {
+                "type": "chat.resume",
+                "chat_id": str(self.scope["url_route"]["kwargs"]["chat_id"]),
+                "seq": seq,
+                "reply_to": self.channel_name,
+            },
+        )
+        try:
+            backlog = await asyncio.wait_for(resumption.backlog, settings.STREAM_RESUME_TIMEOUT_SECONDS)
+        except TimeoutError:
+            self.resumption = None
+            # the answer was saved as the request was sent, or the process answering it has gone
+            if not await self.send_saved(stream_id):
+                await self.reply("error", error_messages.ANSWER_LOST)
+            return
+
+        for text in resumption.take([*backlog, *resumption.held]):
+            await self.send(text)
+        resumption.held = []
+        resumption.live = True
+
+    async def send_saved(self, stream_id: uuid.UUID) -> bool:
+        """send the whole of an answer that has been saved, if it has"""
+        message = (
+            await ChatMessage.objects.filter(
+                id=stream_id,
+                chat_id=self.scope["url_route"]["kwargs"]["chat_id"],
+                chat__user=self.scope["user"],
+                role=ChatMessage.Role.ai,
+            )
+            .select_related("chat")
+            .afirst()
+        )
+        if message is None:
+            return False
+        stream = {"stream": str(stream_id)}
+        await self.send(json.dumps({"type": "answer", "data": message.text, **stream}))
+        end = {"message_id": message.id, "title": message.chat.name, "session_id": message.chat_id}
+        if message.truncated:
+            end["truncated"] = True
+        await self.send(json.dumps({"type": "end", "data": end, **stream}, default=str))
+        return True
 
     async def handle_text(self, response: str):
+        self.streamed.append(response)
         await self.send_to_client("text", response)
+
+    async def handle_progress(self, progress: str):
+        await self.send_to_client("info", progress)
+
+    async def handle_position(self, position: int):
+        if position:
+            await self.send_to_client("info", error_messages.QUEUE_POSITION.format(position=position))
+        else:
+            await self.send_to_client("info", error_messages.QUEUED)
+
+
+def get_processing_files(chat_id) -> list[tuple[int | None, dict[str, Any]]]:
+    return [
+        (file.ingest_task_id, file_status(file))
+        for file in File.objects.filter(chat_id=chat_id, status=File.Status.processing).select_related("ingest_task")
+    ]
+
+
+class FileStatusConsumer(AsyncWebsocketConsumer):
+    """Push the status of a chat's files as the worker ingests them, in place of the browser polling for each one."""
+
+    async def connect(self):
+        user: User = self.scope.get("user")
+        self.chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
+        if not (user and user.is_authenticated and await Chat.objects.filter(id=self.chat_id, user=user).aexists()):
+            await self.close()
+            return
+
+        # once in the groups nothing can be missed, so only then take the snapshot of the files being processed
+        try:
+            for group in (chat_files_group(self.chat_id), FILE_QUEUE_GROUP):
+                self.groups.append(group)
+                await self.channel_layer.group_add(group, self.channel_name)
+        except TimeoutError:
+            logger.exception("channel layer is not listening, the browser will poll instead")
+            await self.close()
+            return
+
+        await self.accept()
+        # ingest task sequence of each file still waiting in the queue, to place it when the queue moves on
+        self.queued: dict[str, int] = {}
+        for sequence, status in await sync_to_async(get_processing_files)(self.chat_id):
+            await self.send_file_status(sequence, status)
+
+    async def file_status(self, event: dict[str, Any]):
+        await self.send_file_status(event["sequence"], event["file"])
+
+    async def queue_head(self, event: dict[str, Any]):
+        await self.handle_queue_head(event["queue_head"])
+
+    async def handle_queue_head(self, queue_head: int | None):
+        for file_id, sequence in list(self.queued.items()):
+            if queue_head is None or sequence <= queue_head:
+                # the file's task has started, which the worker notifies separately
+                del self.queued[file_id]
+                continue
+            position = await IngestTask.queued().filter(id__lt=sequence).acount()
+            await self.send_to_client(
+                "file-status", {"id": file_id, "status": File.Status.processing.label, "position_in_queue": position}
+            )
+
+    async def send_file_status(self, sequence: int | None, status: Mapping[str, Any]):
+        if sequence is not None and status["position_in_queue"] > 0:
+            self.queued[status["id"]] = sequence
+        else:
+            self.queued.pop(status["id"], None)
+        await self.send_to_client("file-status", status)
+
+    async def send_to_client(self, message_type: str, data: str | Mapping[str, Any] | None = None) -> None:
+        message = {"type": message_type, "data": data}
+        await self.send(json.dumps(message, default=str))
@@ -11,3 +11,7 @@ RATE_LIMITED = (
     'Please try again in a few minutes, and contact <a href="/support/">support</a> if the problem persists.'
 )
 FILES_TOO_LARGE = "The attached files are too large to work with"
+QUEUED = "Due to high demand your message is being queued"
+QUEUE_POSITION = "Due to high demand your message is being queued, it is number {position} in the queue"
+TURN_IN_PROGRESS = "Please wait for the answer to your last message, or stop it, before sending another"
+ANSWER_LOST = "The connection was lost before the answer was finished, please send your message again"
@@ -1,11 +1,13 @@
 from django.core.management import BaseCommand
 
 from redbox_app.redbox_core.models import ChatMessage
+from redbox_app.redbox_core.telemetry import chat_message_telemetry
 
 
 class Command(BaseCommand):
     help = """This is a one-off command to back populate elastic logs."""
 
     def handle(self, *args, **kwargs):  # noqa:ARG002
-        for chat_message in ChatMessage.objects.all():
+        for chat_message in ChatMessage.objects.select_related("chat__user__business_unit").iterator():
             chat_message.log()
+        chat_message_telemetry.flush()
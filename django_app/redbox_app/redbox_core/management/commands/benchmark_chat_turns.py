@@ -0,0 +1,95 @@
+import asyncio
+import statistics
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management import BaseCommand
+from django.db import connections
+
+from redbox_app.redbox_core.models import Chat, ChatMessage, get_chat_session
+
+User = get_user_model()
+
+QUESTION = "What did the spending review say about capital budgets?"
+ANSWER = "The spending review set capital budgets for each department. " * 20
+
+
+async def turn(chat: Chat, answer_seconds: float) -> float:
+    """a turn's database work as the consumer does it, returning the seconds until the prompt was built"""
+    started = time.perf_counter()
+    chat, _, _ = await sync_to_async(get_chat_session)(chat.user, chat.id, {"message": QUESTION}, reserve=False)
+    map_reduce = await sync_to_async(chat.needs_map_reduce)()
+    await sync_to_async(chat.to_langchain)(retrieval=not map_reduce)
+    time_to_prompt = time.perf_counter() - started
+
+    await asyncio.sleep(answer_seconds)
+    await ChatMessage.objects.acreate(chat=chat, text=ANSWER, role=ChatMessage.Role.ai)
+    return time_to_prompt
+
+
+async def run_rounds(
+    chats: list[Chat], rounds: int, answer_seconds: float
+) -> tuple[list[float], list[float], list[float]]:
+    """the seconds each round of turns on every chat took, the slow turn's time to prompt and the quick turns'"""
+    walls: list[float] = []
+    slow: list[float] = []
+    quick: list[float] = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        times_to_prompt = await asyncio.gather(*(turn(chat, answer_seconds) for chat in chats))
+        walls.append(time.perf_counter() - started)
+        slow.append(times_to_prompt[0])
+        quick.extend(times_to_prompt[1:])
+    # the thread sync_to_async ran the queries in keeps its connection otherwise
+    await sync_to_async(connections.close_all)()
+    return walls, slow, quick
+
+
+class Command(BaseCommand):
+    help = """Time chat turns answered concurrently in one process, with their database work run through sync_to_async
+    as the consumer does.
+
+    No LLM is called, each answer is canned and takes --answer-seconds, so what is measured is how much each turn's
+    database work holds up the others. The first chat has a long history, as a slow turn among quick ones, and the time
+    to prompt of the quick turns is reported apart from it. The chats are made for a user of their own, who is deleted
+    afterwards.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--turns", type=int, default=20, help="turns answered at once, each on a chat of its own")
+        parser.add_argument("--rounds", type=int, default=3, help="times every chat is asked a question")
+        parser.add_argument("--history", type=int, default=20, help="messages already on each chat")
+        parser.add_argument("--answer-seconds", type=float, default=0.5, help="how long each answer takes to stream")
+        parser.add_argument("--slow-history", type=int, default=2000, help="messages already on the first chat")
+
+    def handle(self, *_args, **kwargs):
+        user = User.objects.create_user(email=f"benchmark-{uuid.uuid4().hex}@example.com")
+        try:
+            chats = []
+            for i in range(kwargs["turns"]):
+                chat = Chat.objects.create(user=user, name=f"benchmark {i}")
+                history = kwargs["slow_history"] if i == 0 else kwargs["history"]
+                # saved in bulk, so the history is not counted into the chat's running totals
+                ChatMessage.objects.bulk_create(
+                    ChatMessage(
+                        chat=chat,
+                        role=ChatMessage.Role.user if j % 2 == 0 else ChatMessage.Role.ai,
+                        text=QUESTION if j % 2 == 0 else ANSWER,
+                    )
+                    for j in range(history)
+                )
+                chats.append(Chat.objects.select_related("user").get(id=chat.id))
+
+            walls, slow, quick = asyncio.run(run_rounds(chats, kwargs["rounds"], kwargs["answer_seconds"]))
+        finally:
+            user.delete()
+
+        quick.sort()
+        p95 = quick[min(len(quick) - 1, int(len(quick) * 0.95))] if quick else 0.0
+        self.stdout.write(
+            f"{kwargs['turns'] / statistics.mean(walls):.1f} turns/s, "
+            f"time to prompt of the quick turns p50 {statistics.median(quick or [0.0]):.3f}s p95 {p95:.3f}s, "
+            f"of the slow turn {statistics.mean(slow):.3f}s"
+        )
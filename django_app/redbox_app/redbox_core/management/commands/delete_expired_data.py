@@ -11,7 +11,7 @@ from django.db.models import Max
 from django.utils import timezone
 from requests.exceptions import RequestException
 
-from redbox_app.redbox_core.models import Chat, File
+from redbox_app.redbox_core.models import Chat, ExtractedText, File
 
 logger = logging.getLogger(__name__)
 
@@ -37,7 +37,8 @@ def post_summary_to_slack(message):
 
 class Command(BaseCommand):
     help = """This should be run daily per environment to remove expired data.
-    It removes Files, ChatMessages and ChatHistories that have exceeded their expiry date.
+    It removes Files, ChatMessages and ChatHistories that have exceeded their expiry date, and then any
+    ExtractedText that is no longer used by a File.
     """
 
     def handle(self, *_args, **_kwargs):
@@ -79,6 +80,12 @@ class Command(BaseCommand):
             chats_to_delete.delete()
 
             self.stdout.write(self.style.SUCCESS(f"Successfully deleted {chat_counter} ChatHistory objects"))
+
+            self.stdout.write(self.style.NOTICE("Deleting extracted text no longer used by any file"))
+            extracted_text_counter = ExtractedText.delete_unreferenced()
+            self.stdout.write(
+                self.style.SUCCESS(f"Successfully deleted {extracted_text_counter} ExtractedText objects")
+            )
             post_summary_to_slack(
                 f"The file deletion task succeeded in {os.environ["ENVIRONMENT"]} :put_litter_in_its_place:. {counter} "
                 f"files deleted. {chat_counter} chats deleted. {failure_counter} failures."
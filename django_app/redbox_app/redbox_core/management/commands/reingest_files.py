@@ -1,8 +1,12 @@
 import logging
+import time
+from datetime import timedelta
 
 from django.core.management import BaseCommand
+from django.db.models import Q
 
 from redbox_app.redbox_core.models import File
+from redbox_app.worker import INGEST_VERSION
 
 logger = logging.getLogger(__name__)
 
@@ -10,15 +14,50 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = """This is an ad-hoc command when changes to the AI pipeline (e.g. a new embedding strategy)
     mean we need to regenerate chunks for all the current files.
+
+    Only files produced by an older INGEST_VERSION are reingested, in batches at no more than --rate files a second.
+    Files already queued or being ingested are skipped, so the command can be stopped and run again to carry on where
+    it left off. Files whose ingest task has been queued or run for longer than Q_TIMEOUT, and so has been lost or has
+    died, are resumed. Each file keeps its old text until its new text is complete.
     """
 
     def add_arguments(self, parser):
         """sync only to be used for testing"""
         parser.add_argument("sync", nargs="?", type=bool, default=False)
+        parser.add_argument("--batch-size", type=int, default=100, help="files selected and enqueued at a time")
+        parser.add_argument("--rate", type=float, default=10.0, help="maximum files enqueued per second")
 
     def handle(self, *_args, **kwargs):
-        self.stdout.write(self.style.NOTICE("Reingesting active files from Django"))
-
-        for file in File.objects.exclude(status=File.Status.errored):
-            logger.debug("Reingesting file object %s", file)
-            file.ingest(kwargs["sync"])
+        stale_files = File.stale_files().order_by("created_at", "id")
+        total = stale_files.count()
+        self.stdout.write(self.style.NOTICE(f"Reingesting {total} files older than ingest version {INGEST_VERSION}"))
+
+        started = time.monotonic()
+        done = 0
+        remaining = stale_files
+        while done < total:
+            # each file leaves stale_files once it is queued, or ingested if sync, so this is also the checkpoint, and
+            # is only taken once a run, even if its task waits in the queue for longer than Q_TIMEOUT
+            batch = list(remaining[: min(kwargs["batch_size"], total - done)])
+            if not batch:
+                break
+            last = batch[-1]
+            remaining = stale_files.filter(
+                Q(created_at__gt=last.created_at) | Q(created_at=last.created_at, id__gt=last.id)
+            )
+
+            for file in batch:
+                logger.debug("Reingesting file object %s", file)
+                file.ingest(kwargs["sync"])
+            done += len(batch)
+
+            elapsed = time.monotonic() - started
+            if (wait := done / kwargs["rate"] - elapsed) > 0:
+                time.sleep(wait)
+                elapsed += wait
+
+            rate = done / elapsed if elapsed else float("inf")
+            eta = timedelta(seconds=round((total - done) / rate))
+            self.stdout.write(f"{done}/{total} files, {rate:.1f} files/s, ETA {eta}")
+
+        self.stdout.write(self.style.SUCCESS(f"Reingested {done} files"))
@@ -0,0 +1,249 @@
+# Generated by Django 5.2.5 on 2026-10-17 10:08
+
+import logging
+import uuid
+import zlib
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django_q.signing import SignedPackage
+
+
+def move_text(apps, schema_editor):
+    # files ingested before text was shared get an ExtractedText of their own, they have no content hash to share it by
+    ExtractedText = apps.get_model("redbox_core", "ExtractedText")
+    File = apps.get_model("redbox_core", "File")
+
+    for file in File.objects.filter(text__isnull=False).iterator():
+        file.extracted_text = ExtractedText.objects.create(
+            compressed_text=zlib.compress(file.text.encode()),
+            token_count=file.token_count or 0,
+        )
+        file.save(update_fields=["extracted_text"])
+
+
+def restore_text(apps, schema_editor):
+    File = apps.get_model("redbox_core", "File")
+
+    for file in File.objects.filter(extracted_text__isnull=False).select_related("extracted_text").iterator():
+        file.text = zlib.decompress(file.extracted_text.compressed_text).decode()
+        file.save(update_fields=["text"])
+
+
+def move_tasks(apps, schema_editor):
+    # a file still waiting for its django-q task gets an IngestTask for it, so it shows as queued and reingest_files
+    # resumes it if the task is lost
+    File = apps.get_model("redbox_core", "File")
+    IngestTask = apps.get_model("redbox_core", "IngestTask")
+
+    for file in File.objects.filter(task__isnull=False).select_related("task").iterator():
+        try:
+            task_id = SignedPackage.loads(file.task.payload)["id"]
+        except Exception:  # the payload is only needed for the id, which is not worth failing the migration over
+            logging.exception("cannot read the queued task of file %s", file.id)
+            task_id = None
+        file.ingest_task = IngestTask.objects.create(task_id=task_id)
+        file.save(update_fields=["ingest_task"])
+
+
+def total(queryset):
+    """the sum of the token_count of a queryset filtered by OuterRef("pk"), as a subquery"""
+    return Coalesce(
+        Subquery(queryset.order_by().values("chat").annotate(total=Sum("token_count")).values("total")),
+        Value(0),
+    )
+
+
+def count_chat_tokens(apps, schema_editor):
+    # from the token counts already stored, in one update rather than tokenising every message again
+    # the token_count of a user message includes the files of its chat, so history is over rather than under counted
+    Chat = apps.get_model("redbox_core", "Chat")
+    ChatMessage = apps.get_model("redbox_core", "ChatMessage")
+    File = apps.get_model("redbox_core", "File")
+
+    Chat.objects.update(
+        file_token_count=total(File.objects.filter(chat=OuterRef("pk"))),
+        history_token_count=total(ChatMessage.objects.filter(chat=OuterRef("pk"))),
+    )
+
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redbox_core', '0093_chatmessage_time_to_first_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractedText',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('content_hash', models.CharField(blank=True, help_text='sha256 of the original file, null while a single file is still being extracted', max_length=64, null=True, unique=True)),
+                ('compressed_text', models.BinaryField(default=b'', help_text='zlib compressed text extracted from file')),
+                ('token_count', models.PositiveIntegerField(default=0, help_text='number of tokens in extracted text')),
+                ('lexical_index', models.JSONField(blank=True, help_text='BM25 index over chunks of the extracted text, used in retrieval mode', null=True)),
+                ('ingest_version', models.PositiveIntegerField(blank=True, help_text='version of ingest that produced this', null=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('chat_backend', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='redbox_core.chatllmbackend')),
+                ('level', models.FloatField(help_text='tokens available, negative while reservations wait for the bucket to refill')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, help_text='when level was last refilled')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='file_token_count',
+            field=models.PositiveBigIntegerField(default=0, help_text="tokens in the text of this chat's files"),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='history_token_count',
+            field=models.PositiveBigIntegerField(default=0, help_text='tokens in the text of the messages not yet folded into the summary'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='summary',
+            field=models.TextField(blank=True, help_text='running summary of the earlier messages', null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='summary_token_count',
+            field=models.PositiveIntegerField(default=0, help_text='tokens in the summary'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='summary_until',
+            field=models.DateTimeField(blank=True, help_text='created_at of the last message folded into the summary', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatllmbackend',
+            name='max_connections',
+            field=models.PositiveIntegerField(default=20, help_text='pooled connections each worker process keeps open to this model'),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='cache_hit',
+            field=models.BooleanField(blank=True, help_text='was this answer served from the response cache, blank if it was not consulted', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='cached_token_count',
+            field=models.PositiveIntegerField(blank=True, help_text='number of prompt tokens the provider served from its prompt cache', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='persistence_duration',
+            field=models.DurationField(blank=True, help_text='time taken to save this message', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='prompt_build_duration',
+            field=models.DurationField(blank=True, help_text='time taken to build the prompt, including document retrieval', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='session_duration',
+            field=models.DurationField(blank=True, help_text='time taken to load and update the chat before it was answered', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='streaming_duration',
+            field=models.DurationField(blank=True, help_text='time from the first token of the response to the last', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='tokens_per_second',
+            field=models.FloatField(blank=True, help_text='output tokens per second of streaming', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='truncated',
+            field=models.BooleanField(default=False, help_text='was this answer stopped part way, by the user or by them leaving'),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='sha256 of the original file', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='ingest_version',
+            field=models.PositiveIntegerField(blank=True, help_text='version of ingest that produced the text, null if it predates versioning', null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='pages_extracted',
+            field=models.PositiveIntegerField(default=0, help_text='pages extracted so far, ingest resumes from here'),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='pages_total',
+            field=models.PositiveIntegerField(blank=True, help_text='number of pages, for files that are extracted page by page', null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='extracted_text',
+            field=models.ForeignKey(blank=True, help_text='text extracted from this file, shared with files with the same content', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='files', to='redbox_core.extractedtext'),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='extracting_text',
+            field=models.ForeignKey(blank=True, help_text='text being extracted page by page, swapped in for extracted_text once complete', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='extracting_files', to='redbox_core.extractedtext'),
+        ),
+        migrations.CreateModel(
+            name='IngestTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(blank=True, help_text='django-q task id', max_length=32, null=True, unique=True)),
+                ('enqueued_at', models.DateTimeField(auto_now_add=True)),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('complete', 'Complete'), ('errored', 'Errored')], default='queued', max_length=16)),
+                ('started_at', models.DateTimeField(blank=True, help_text='when the task started running, it has been killed if still running after Q_TIMEOUT', null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['state', 'id'], name='redbox_core_state_b99257_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='ingest_task',
+            field=models.ForeignKey(blank=True, help_text='most recent text extraction task', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='files', to='redbox_core.ingesttask'),
+        ),
+        migrations.CreateModel(
+            name='ExtractedTextBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_page', models.PositiveIntegerField(help_text='the page the batch starts at, counting from 0')),
+                ('compressed_text', models.BinaryField(default=b'', help_text='zlib compressed text extracted from the pages')),
+                ('extracted_text', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batches', to='redbox_core.extractedtext')),
+            ],
+            options={
+                'ordering': ['first_page'],
+                'constraints': [models.UniqueConstraint(fields=('extracted_text', 'first_page'), name='unique_extracted_text_batch')],
+            },
+        ),
+        migrations.RunPython(move_text, restore_text),
+        migrations.RunPython(move_tasks, migrations.RunPython.noop),
+        migrations.RunPython(count_chat_tokens, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='file',
+            name='task',
+        ),
+        migrations.RemoveField(
+            model_name='file',
+            name='text',
+        ),
+    ]
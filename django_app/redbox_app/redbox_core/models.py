@@ -1,7 +1,9 @@
+import hashlib
 import logging
 import os
 import textwrap
 import uuid
+import zlib
 from collections.abc import Collection, Sequence
 from datetime import UTC, date, datetime, timedelta
 from typing import override
@@ -10,21 +12,22 @@ from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
 from django.core import validators
 from django.db import models
-from django.db.models import Avg, Count, Max, Min, Sum, UniqueConstraint
+from django.db.models import Avg, Count, F, Max, Min, Q, Sum, UniqueConstraint
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django_q.models import OrmQ, Success
+from django_q.models import Success
 from django_q.tasks import async_task
 from django_use_email_as_username.models import BaseUser, BaseUserManager
 from langchain_core.documents import Document
 from langchain_core.messages import AIMessage, AnyMessage, HumanMessage
-from pytz import utc
 
 import redbox
 from redbox import RedboxState, get_tokeniser
-from redbox_app.redbox_core import error_messages
+from redbox_app.redbox_core import error_messages, notifications
+from redbox_app.redbox_core.rate_limit import get_rate_limiter
+from redbox_app.redbox_core.telemetry import chat_message_telemetry
 from redbox_app.redbox_core.utils import get_date_group, sanitise_string
-from redbox_app.worker import ingest
+from redbox_app.worker import INGEST_VERSION, compact_chat, ingest
 
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
@@ -73,6 +76,9 @@ class ChatLLMBackend(models.Model):
     display = models.CharField(max_length=128, null=True, blank=True, help_text="name to display in UI.")
     context_window_size = models.PositiveIntegerField(help_text="size of the LLM context window")
     rate_limit = models.PositiveIntegerField(default=1000000, help_text="tokens per minute allowed by this model")
+    max_connections = models.PositiveIntegerField(
+        default=20, help_text="pooled connections each worker process keeps open to this model"
+    )
 
     class Meta:
         constraints = [UniqueConstraint(fields=["name", "provider"], name="unique_name_provider")]
@@ -89,6 +95,27 @@ class ChatLLMBackend(models.Model):
     def active_context_window_sizes(cls) -> dict[str, int]:
         return {str(o): o.context_window_size for o in cls.objects.filter(enabled=True)}
 
+    def to_langchain(self, temperature: float | None = None) -> redbox.ChatLLMBackend:
+        return redbox.ChatLLMBackend(
+            name=self.name,
+            provider=self.provider,
+            description=self.description,
+            context_window_size=self.context_window_size,
+            max_connections=self.max_connections,
+            temperature=temperature,
+        )
+
+
+class RateLimitBucket(models.Model):
+    """tokens left for a ChatLLMBackend this minute, see rate_limit.DatabaseTokenBucket"""
+
+    chat_backend = models.OneToOneField(ChatLLMBackend, on_delete=models.CASCADE, primary_key=True)
+    level = models.FloatField(help_text="tokens available, negative while reservations wait for the bucket to refill")
+    updated_at = models.DateTimeField(default=timezone.now, help_text="when level was last refilled")
+
+    def __str__(self):
+        return f"{self.chat_backend}: {self.level:.0f}"
+
 
 class DepartmentBusinessUnit(UUIDPrimaryKeyBase):
     class Department(models.TextChoices):
@@ -372,6 +399,22 @@ class Chat(UUIDPrimaryKeyBase):
     )
     feedback_notes = models.TextField(null=True, blank=True, help_text="Do you want to tell us anything further?")
 
+    # Compacted history - messages up to summary_until are sent to the LLM as this summary rather than verbatim
+    summary = models.TextField(null=True, blank=True, help_text="running summary of the earlier messages")
+    summary_until = models.DateTimeField(
+        null=True, blank=True, help_text="created_at of the last message folded into the summary"
+    )
+
+    # Running token totals, only ever changed with add_token_counts and by compaction
+    file_token_count = models.PositiveBigIntegerField(default=0, help_text="tokens in the text of this chat's files")
+    history_token_count = models.PositiveBigIntegerField(
+        default=0, help_text="tokens in the text of the messages not yet folded into the summary"
+    )
+    summary_token_count = models.PositiveIntegerField(default=0, help_text="tokens in the summary")
+    RUNNING_TOTALS = frozenset({"file_token_count", "history_token_count", "summary_token_count"})
+    # changed by ingest, compaction and renaming behind the back of an instance held across turns
+    REFRESHED_EACH_TURN = RUNNING_TOTALS | {"name", "summary", "summary_until"}
+
     def __str__(self) -> str:  # pragma: no cover
         return self.name or ""
 
@@ -385,11 +428,42 @@ class Chat(UUIDPrimaryKeyBase):
         if self.temperature is None:
             self.temperature = 0
 
-        for chat_message in self.chatmessage_set.all():
-            chat_message.log()
+        if settings.ELASTIC_CLIENT:
+            n_selected_files = self.file_set.count()
+            for chat_message in self.chatmessage_set.select_related("chat__user__business_unit"):
+                chat_message.log(n_selected_files)
+
+        if not self._state.adding and update_fields is None:
+            # a stale instance must not overwrite totals that have been added to since it was loaded
+            update_fields = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.RUNNING_TOTALS
+            ]
 
         super().save(force_insert, force_update, using, update_fields)
 
+    @classmethod
+    def add_token_counts(cls, chat_id: uuid.UUID, files: int = 0, history: int = 0) -> None:
+        """add to the running totals of a chat in a single update, so that concurrent turns and ingests all count"""
+        if files or history:
+            cls.objects.filter(id=chat_id).update(
+                file_token_count=F("file_token_count") + files,
+                history_token_count=F("history_token_count") + history,
+            )
+
+    @classmethod
+    def recount_token_totals(cls, chat_ids: Collection[uuid.UUID]) -> None:
+        """count the running totals of chats again from their files, messages and summary, after a delete of a queryset
+        of files or messages, which does not go through the delete of each one and so does not subtract from them"""
+        for chat in cls.objects.filter(id__in=chat_ids):
+            texts = chat.uncompacted_messages().values_list("text", flat=True)
+            cls.objects.filter(id=chat.id).update(
+                file_token_count=chat.file_set.aggregate(total=Sum("token_count"))["total"] or 0,
+                history_token_count=sum(len(tokeniser.encode(text)) for text in texts),
+                summary_token_count=len(tokeniser.encode(chat.summary)) if chat.summary else 0,
+            )
+
     @classmethod
     def get_ordered_by_last_message_date(
         cls, user: User, exclude_chat_ids: Collection[uuid.UUID] | None = None
@@ -411,31 +485,74 @@ class Chat(UUIDPrimaryKeyBase):
     def date_group(self):
         return get_date_group(self.newest_message_date)
 
-    def to_langchain(self) -> RedboxState:
-        chat_backend = redbox.ChatLLMBackend(
-            name=self.chat_backend.name,
-            provider=self.chat_backend.provider,
-            description=self.chat_backend.description,
-            context_window_size=self.chat_backend.context_window_size,
-        )
+    def to_langchain(self, retrieval: bool = True) -> RedboxState:
+        """the state for the next turn, with only the chunks retrieved from files that would leave less than the reserve
+        of the context window for the history and answer, retrieval=False always sends the documents in full"""
+        files = list(self.file_set.select_related("extracted_text").order_by("created_at"))
+        messages = [message.to_langchain() for message in self.uncompacted_messages()]
+        chat_backend = self.chat_backend.to_langchain(temperature=self.temperature)
+        documents = [Document(file.text or "", metadata={"uri": file.original_file.name}) for file in files]
 
-        return RedboxState(
-            documents=[
-                Document(str(file.text), metadata={"uri": file.original_file.name})
-                for file in self.file_set.order_by("created_at")
-            ],
-            messages=[message.to_langchain() for message in self.chatmessage_set.order_by("created_at")],
-            chat_backend=chat_backend,
-        )
+        if retrieval and messages and self.retrieves(sum(file.token_count or 0 for file in files)):
+            documents = redbox.retrieve_chunks(
+                [(document, file.get_lexical_index()) for document, file in zip(documents, files, strict=True)],
+                query=messages[-1].content,
+                k=settings.RETRIEVAL_TOP_K,
+                token_budget=settings.RETRIEVAL_TOKEN_BUDGET,
+            )
+
+        return RedboxState(documents=documents, messages=messages, chat_backend=chat_backend, summary=self.summary)
 
     def context_window_size(self) -> int:
         return self.chat_backend.context_window_size
 
-    def token_count(self) -> int:
-        def f(obj):
-            return obj.aggregate(Sum("token_count"))["token_count__sum"] or 0
+    def needs_map_reduce(self) -> bool:
+        """is this chat too large for the context window of every enabled model, even once retrieved from"""
+        return self.prompt_token_count() > max(ChatLLMBackend.active_context_window_sizes().values())
+
+    def uncompacted_messages(self) -> Sequence["ChatMessage"]:
+        """messages that have not yet been folded into the summary, oldest first"""
+        messages = self.chatmessage_set.order_by("created_at")
+        if self.summary_until:
+            messages = messages.filter(created_at__gt=self.summary_until)
+        return messages
+
+    def needs_compaction(self) -> bool:
+        return self.history_token_count > settings.COMPACTION_THRESHOLD * self.context_window_size()
 
-        return f(self.file_set) + f(self.chatmessage_set)
+    def compact(self, sync: bool = False):
+        """summarise older messages in the background once the history passes its share of the context window"""
+        if self.needs_compaction():
+            async_task(compact_chat, self.id, task_name=self.name, group="compact", sync=sync)
+
+    def token_count(self) -> int:
+        """tokens in the files, uncompacted messages and summary that make up the next prompt"""
+        return self.file_token_count + self.history_token_count + self.summary_token_count
+
+    def retrieves(self, file_token_count: int | None = None) -> bool:
+        """would the files, of file_token_count tokens if not all of this chat's, leave less than the reserve of the
+        context window for the history and answer, so that only the chunks retrieved from them are sent, a
+        RETRIEVAL_TOKEN_BUDGET of 0 turns retrieval off"""
+        if file_token_count is None:
+            file_token_count = self.file_token_count
+        document_budget = self.context_window_size() - settings.RETRIEVAL_CONTEXT_RESERVE_TOKENS
+        return bool(settings.RETRIEVAL_TOKEN_BUDGET) and file_token_count > document_budget
+
+    def prompt_token_count(self) -> int:
+        """tokens in the next prompt, as token_count but with the files counted as the RETRIEVAL_TOKEN_BUDGET retrieved
+        from them when they are retrieved from"""
+        file_token_count = self.file_token_count
+        if self.retrieves():
+            file_token_count = min(file_token_count, settings.RETRIEVAL_TOKEN_BUDGET)
+        return file_token_count + self.history_token_count + self.summary_token_count
+
+    def reserved_token_count(self, largest_context_window: int) -> int:
+        """tokens to reserve from the rate limit for the next turn, the prompt it sends or, when it is too large for
+        largest_context_window and so answered with redbox.run_map_reduce, every token that map-reduce reads"""
+        prompt_token_count = self.prompt_token_count()
+        if prompt_token_count > largest_context_window:
+            return self.token_count()
+        return prompt_token_count
 
 
 class InactiveFileError(ValueError):
@@ -452,6 +569,153 @@ def build_s3_key(instance, filename: str) -> str:
     return f"{instance.chat.user.email}/{filename}"
 
 
+class ExtractedText(UUIDPrimaryKeyBase):
+    """Text extracted from an upload, shared by every File with the same content so that it is only extracted once.
+
+    The text is kept compressed, and apart from File, so that listing files never loads it.
+    The Files that refer to it are its references, once there are none it is deleted by delete_expired_data.
+    """
+
+    content_hash = models.CharField(
+        max_length=64,
+        unique=True,
+        null=True,
+        blank=True,
+        help_text="sha256 of the original file, null while a single file is still being extracted",
+    )
+    compressed_text = models.BinaryField(default=b"", help_text="zlib compressed text extracted from file")
+    token_count = models.PositiveIntegerField(default=0, help_text="number of tokens in extracted text")
+    lexical_index = models.JSONField(
+        null=True, blank=True, help_text="BM25 index over chunks of the extracted text, used in retrieval mode"
+    )
+    ingest_version = models.PositiveIntegerField(
+        null=True, blank=True, help_text="version of ingest that produced this"
+    )
+
+    def __str__(self) -> str:  # pragma: no cover
+        return self.content_hash or str(self.id)
+
+    @property
+    def text(self) -> str:
+        if self.compressed_text:
+            return zlib.decompress(self.compressed_text).decode()
+        # text still being extracted page by page is kept in batches, until it is compressed as a whole
+        return "".join(batch.text for batch in self.batches.all())
+
+    @text.setter
+    def text(self, text: str) -> None:
+        self.compressed_text = zlib.compress(text.encode())
+
+    @property
+    def reference_count(self) -> int:
+        return self.files.count()
+
+    @classmethod
+    def delete_unreferenced(cls) -> int:
+        """delete the text no file refers to, other than that changed within Q_TIMEOUT, which an ingest still running
+        may have extracted but not yet given to its file"""
+        grace = timezone.now() - timedelta(seconds=settings.Q_CLUSTER["timeout"])
+        _, deleted = cls.objects.filter(
+            files__isnull=True, extracting_files__isnull=True, modified_at__lt=grace
+        ).delete()
+        return deleted.get(cls._meta.label, 0)
+
+
+class ExtractedTextBatch(models.Model):
+    """The text of a batch of pages of a PDF, saved as it is extracted, so that neither the text so far nor its
+    compression is redone for every batch."""
+
+    extracted_text = models.ForeignKey(ExtractedText, on_delete=models.CASCADE, related_name="batches")
+    first_page = models.PositiveIntegerField(help_text="the page the batch starts at, counting from 0")
+    compressed_text = models.BinaryField(default=b"", help_text="zlib compressed text extracted from the pages")
+
+    class Meta:
+        ordering = ["first_page"]
+        constraints = [
+            models.UniqueConstraint(fields=["extracted_text", "first_page"], name="unique_extracted_text_batch")
+        ]
+
+    def __str__(self) -> str:  # pragma: no cover
+        return f"{self.extracted_text_id}: {self.first_page}"
+
+    @property
+    def text(self) -> str:
+        return zlib.decompress(self.compressed_text).decode()
+
+    @text.setter
+    def text(self, text: str) -> None:
+        self.compressed_text = zlib.compress(text.encode())
+
+
+class IngestTask(models.Model):
+    """An ingest job, written as it is enqueued so that it can be found and placed without reading the django-q queue.
+
+    The id increases in the order tasks are enqueued, which is the order the workers take them in.
+    """
+
+    class State(models.TextChoices):
+        queued = "queued"
+        running = "running"
+        complete = "complete"
+        errored = "errored"
+
+    task_id = models.CharField(max_length=32, null=True, blank=True, unique=True, help_text="django-q task id")
+    enqueued_at = models.DateTimeField(auto_now_add=True)
+    state = models.CharField(choices=State.choices, default=State.queued, max_length=16)
+    started_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="when the task started running, it has been killed if still running after Q_TIMEOUT",
+    )
+
+    class Meta:
+        indexes = [models.Index(fields=["state", "id"])]
+
+    def __str__(self) -> str:  # pragma: no cover
+        return f"{self.task_id}: {self.state}"
+
+    def position_in_queue(self) -> int:
+        """number of queued tasks ahead of this one"""
+        if self.state == self.State.running:
+            return 0
+        if self.state != self.State.queued:
+            return -1
+        return IngestTask.queued().filter(id__lt=self.id).count()
+
+    @classmethod
+    def queued(cls) -> models.QuerySet["IngestTask"]:
+        """tasks still waiting to run, those queued for longer than django-q's timeout are taken to have been lost"""
+        return cls.objects.filter(cls.in_progress() & Q(state=cls.State.queued))
+
+    @classmethod
+    def first_queued(cls) -> int | None:
+        return cls.queued().aggregate(first=Min("id"))["first"]
+
+    @classmethod
+    def mark(cls, ingest_task_id: int | None, state: "IngestTask.State") -> None:
+        if ingest_task_id is not None:
+            started_at = {"started_at": timezone.now()} if state == cls.State.running else {}
+            cls.objects.filter(id=ingest_task_id).update(state=state, **started_at)
+
+    @classmethod
+    def in_progress(cls, prefix: str = "") -> Q:
+        """tasks queued or running for no longer than django-q's timeout, after which a queued task has been lost and
+        the worker running one has been killed or has died without marking it, prefix is the lookup from the model
+        being filtered to the task"""
+        lease_expired = timezone.now() - timedelta(seconds=settings.Q_CLUSTER["timeout"])
+        return Q(**{f"{prefix}state": cls.State.queued, f"{prefix}enqueued_at__gt": lease_expired}) | Q(
+            **{f"{prefix}state": cls.State.running, f"{prefix}started_at__gt": lease_expired}
+        )
+
+
+class FileQuerySet(models.QuerySet):
+    def delete(self):
+        chat_ids = set(self.values_list("chat_id", flat=True))
+        deleted = super().delete()
+        Chat.recount_token_totals(chat_ids)
+        return deleted
+
+
 class File(UUIDPrimaryKeyBase):
     class Status(models.TextChoices):
         complete = "complete"
@@ -475,11 +739,47 @@ class File(UUIDPrimaryKeyBase):
         on_delete=models.CASCADE,
         help_text="chat that this document belongs to",
     )
-    text = models.TextField(null=True, blank=True, help_text="text extracted from file")
     token_count = models.PositiveIntegerField(null=True, blank=True, help_text="number of tokens in extracted text")
-    task = models.ForeignKey(
-        OrmQ, on_delete=models.SET_NULL, null=True, blank=True, help_text="pending text extraction task"
+    ingest_version = models.PositiveIntegerField(
+        null=True, blank=True, help_text="version of ingest that produced the text, null if it predates versioning"
+    )
+    pages_total = models.PositiveIntegerField(
+        null=True, blank=True, help_text="number of pages, for files that are extracted page by page"
+    )
+    pages_extracted = models.PositiveIntegerField(
+        default=0, help_text="pages extracted so far, ingest resumes from here"
+    )
+    ingest_task = models.ForeignKey(
+        IngestTask,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="files",
+        help_text="most recent text extraction task",
+    )
+    content_hash = models.CharField(
+        max_length=64, null=True, blank=True, db_index=True, help_text="sha256 of the original file"
+    )
+    extracted_text = models.ForeignKey(
+        ExtractedText,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name="files",
+        help_text="text extracted from this file, shared with files with the same content",
     )
+    extracting_text = models.ForeignKey(
+        ExtractedText,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name="extracting_files",
+        help_text="text being extracted page by page, swapped in for extracted_text once complete",
+    )
+
+    objects = FileQuerySet.as_manager()
+
+    _saved_token_count = 0
 
     def __str__(self) -> str:  # pragma: no cover
         return self.file_name
@@ -492,13 +792,31 @@ class File(UUIDPrimaryKeyBase):
             else:
                 self.last_referenced = timezone.now()
 
+        if self._state.adding and self.content_hash is None and self.original_file:
+            sha256 = hashlib.sha256()
+            for chunk in self.original_file.chunks():
+                sha256.update(chunk)
+            self.content_hash = sha256.hexdigest()
+
         super().save(*args, **kwargs)
 
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "token_count" in update_fields:
+            Chat.add_token_counts(self.chat_id, files=(self.token_count or 0) - self._saved_token_count)
+            self._saved_token_count = self.token_count or 0
+
     @override
     def delete(self, using=None, keep_parents=False):
         #  Needed to make sure no orphaned files remain in the storage
         self.original_file.delete(save=False)
         super().delete()
+        Chat.add_token_counts(self.chat_id, files=-self._saved_token_count)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_token_count = instance.__dict__.get("token_count") or 0  # noqa: SLF001
+        return instance
 
     @property
     def url(self) -> str:
@@ -529,6 +847,18 @@ class File(UUIDPrimaryKeyBase):
             return permanent_error
         return dict(File.Status.choices).get(self.status, permanent_error)
 
+    @property
+    def text(self) -> str | None:
+        """text extracted so far, loaded only when asked for"""
+        return self.extracted_text.text if self.extracted_text_id else None
+
+    @property
+    def progress(self) -> int | None:
+        """percentage of pages extracted so far, for files that are extracted page by page"""
+        if not self.pages_total:
+            return None
+        return 100 * self.pages_extracted // self.pages_total
+
     @property
     def expires_at(self) -> datetime:
         return self.last_referenced + timedelta(seconds=settings.FILE_EXPIRY_IN_SECONDS)
@@ -541,13 +871,30 @@ class File(UUIDPrimaryKeyBase):
         return self.id < other.id
 
     def ingest(self, sync: bool = False):
-        task = async_task(ingest, self.id, task_name=self.file_name, group="ingest", sync=sync)
+        self.ingest_task = IngestTask.objects.create()
+        self.save()
+        task = async_task(ingest, self.id, self.ingest_task.id, task_name=self.file_name, group="ingest", sync=sync)
+        self.ingest_task.task_id = task
+        self.ingest_task.save(update_fields=["task_id"])
         if sync:
             result = Success.objects.get(pk=task)
-            self.status = self.Status.complete if result.success else self.Status.errored
+            # the worker has saved the text, and its own status, since this was loaded
+            self.refresh_from_db()
+            if not result.success:
+                self.status = self.Status.errored
+                self.save()
         else:
-            self.task = next(item for item in OrmQ.objects.all() if item.task["id"] == task)
-        self.save()
+            notifications.publish_file_status(self)
+
+    @classmethod
+    def stale_files(cls) -> models.QuerySet["File"]:
+        """files whose text was produced by an older version of ingest, and that are not already being reingested, those
+        whose ingest task died part way are reingested from their checkpoint"""
+        return (
+            cls.objects.exclude(status=cls.Status.errored)
+            .exclude(ingest_version=INGEST_VERSION)
+            .exclude(IngestTask.in_progress("ingest_task__"))
+        )
 
     @classmethod
     def get_completed_and_processing_files(cls, chat_id: uuid.UUID) -> tuple[Sequence["File"], Sequence["File"]]:
@@ -566,10 +913,24 @@ class File(UUIDPrimaryKeyBase):
             .order_by("min_created_at")
         )
 
+    def get_lexical_index(self) -> redbox.LexicalIndex:
+        if self.extracted_text_id is None or self.extracted_text.lexical_index is None:
+            # files ingested before chunking was introduced, or still being extracted, are indexed on the fly
+            return redbox.LexicalIndex.from_text(self.text or "")
+        return redbox.LexicalIndex.model_validate(self.extracted_text.lexical_index)
+
     def position_in_queue(self) -> int:
-        if not self.task_id:
+        if not self.ingest_task_id:
             return -1
-        return OrmQ.objects.filter(lock__lt=self.task.lock).count()
+        return self.ingest_task.position_in_queue()
+
+
+class ChatMessageQuerySet(models.QuerySet):
+    def delete(self):
+        chat_ids = set(self.values_list("chat_id", flat=True))
+        deleted = super().delete()
+        Chat.recount_token_totals(chat_ids)
+        return deleted
 
 
 class ChatMessage(UUIDPrimaryKeyBase):
@@ -591,47 +952,116 @@ class ChatMessage(UUIDPrimaryKeyBase):
     rating_chips = ArrayField(models.CharField(max_length=32), null=True, blank=True)
     token_count = models.PositiveIntegerField(null=True, blank=True, help_text="number of tokens in the message")
     delay = models.FloatField(default=0, help_text="by how much was this message delayed in seconds")
+    # Latency of each phase of the turn that produced this message, delay above is the time spent throttled
+    session_duration = models.DurationField(
+        null=True, blank=True, help_text="time taken to load and update the chat before it was answered"
+    )
+    prompt_build_duration = models.DurationField(
+        null=True, blank=True, help_text="time taken to build the prompt, including document retrieval"
+    )
     time_to_first_token = models.DurationField(
         null=True, blank=True, help_text="time take to for LLM to respond with first token"
     )
+    streaming_duration = models.DurationField(
+        null=True, blank=True, help_text="time from the first token of the response to the last"
+    )
+    tokens_per_second = models.FloatField(null=True, blank=True, help_text="output tokens per second of streaming")
+    persistence_duration = models.DurationField(null=True, blank=True, help_text="time taken to save this message")
+    cache_hit = models.BooleanField(
+        null=True, blank=True, help_text="was this answer served from the response cache, blank if it was not consulted"
+    )
+    cached_token_count = models.PositiveIntegerField(
+        null=True, blank=True, help_text="number of prompt tokens the provider served from its prompt cache"
+    )
+    truncated = models.BooleanField(
+        default=False, help_text="was this answer stopped part way, by the user or by them leaving"
+    )
+
+    _saved_text: str | None = None
+
+    objects = ChatMessageQuerySet.as_manager()
 
     def __str__(self) -> str:  # pragma: no cover
         return textwrap.shorten(self.text, width=20, placeholder="...")
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        self.text = sanitise_string(self.text)
-        self.rating_text = sanitise_string(self.rating_text)
-        self.token_count = self.associated_file_token_count + len(tokeniser.encode(self.text))
-        super().save(force_insert, force_update, using, update_fields)
+        adding = self._state.adding
+        history_token_count = self.count_tokens(adding)
+        started = datetime.now(tz=UTC)
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        self._saved_text = self.text
+        if history_token_count:
+            Chat.add_token_counts(self.chat_id, history=history_token_count)
+            self.chat.history_token_count += history_token_count
+        if adding and self.role == self.Role.ai:
+            self.persistence_duration = datetime.now(tz=UTC) - started
+            ChatMessage.objects.filter(pk=self.pk).update(persistence_duration=self.persistence_duration)
         self.log()
 
-    @property
-    def associated_file_token_count(self):
-        """count token of all files created before this chat
-        that would have been used in the creation of this message
-        """
-        if self.role == self.Role.ai:
-            return 0
+    def count_tokens(self, adding: bool) -> int:
+        """sanitise the text and count its tokens, returning how many it adds to the chat's history"""
+        self.rating_text = sanitise_string(self.rating_text)
+        history_token_count = 0
+        # saves that do not change the text, such as rating a message, do not need counting again
+        if adding or self.text != self._saved_text:
+            self.text = sanitise_string(self.text)
+            text_token_count = len(tokeniser.encode(self.text))
+            if adding:
+                file_token_count = self.chat.file_token_count if self.role == self.Role.user else 0
+                self.token_count = file_token_count + text_token_count
+                history_token_count = text_token_count
+            else:
+                saved_text_token_count = len(tokeniser.encode(self._saved_text or ""))
+                self.token_count = (self.token_count or 0) - saved_text_token_count + text_token_count
+                if not self.chat.summary_until or self.created_at > self.chat.summary_until:
+                    history_token_count = text_token_count - saved_text_token_count
+        return history_token_count
 
-        return (
-            self.chat.file_set.filter(
-                created_at__lt=datetime.now(tz=utc),
-            ).aggregate(Sum("token_count"))["token_count__sum"]
-            or 0
-        )
+    @override
+    def delete(self, using=None, keep_parents=False):
+        deleted = super().delete(using, keep_parents)
+        if not self.chat.summary_until or self.created_at > self.chat.summary_until:
+            Chat.add_token_counts(self.chat_id, history=-len(tokeniser.encode(self._saved_text or "")))
+        return deleted
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_text = instance.__dict__.get("text")  # noqa: SLF001
+        return instance
 
     @classmethod
     def get_messages(cls, chat_id: uuid.UUID) -> Sequence["ChatMessage"]:
         """Returns all chat messages for a given chat history, ordered by citation priority."""
         return cls.objects.filter(chat_id=chat_id).order_by("created_at")
 
+    @staticmethod
+    def response_fields(response: AIMessage, prompt_build_duration: timedelta) -> dict:
+        """fields of an ai message taken from a redbox response, prompt_build_duration is the time taken to build the
+        RedboxState, to which the time redbox took to render the prompt is added"""
+        timings = response.response_metadata.get("timings", {})
+        return {
+            "text": response.content,
+            "role": ChatMessage.Role.ai,
+            "cache_hit": response.response_metadata.get("cache_hit"),
+            "cached_token_count": redbox.get_cached_token_count(response),
+            "prompt_build_duration": prompt_build_duration + timings.get("prompt_build", timedelta()),
+            "time_to_first_token": timings.get("time_to_first_token"),
+            "streaming_duration": timings.get("streaming"),
+            "tokens_per_second": timings.get("tokens_per_second"),
+        }
+
     def to_langchain(self) -> AnyMessage:
         if self.role == self.Role.ai:
             return AIMessage(content=self.text)
         return HumanMessage(content=self.text)
 
-    def log(self):
-        n_selected_files = self.chat.file_set.count()
+    def log(self, n_selected_files: int | None = None):
+        """queue this message's metrics for Elasticsearch, n_selected_files is counted if not given"""
+        if not settings.ELASTIC_CLIENT:
+            return
+        if n_selected_files is None:
+            n_selected_files = self.chat.file_set.count()
         elastic_log_msg = {
             "@timestamp": self.created_at.isoformat(),
             "id": str(self.id),
@@ -653,19 +1083,19 @@ class ChatMessage(UUIDPrimaryKeyBase):
             "chat_feedback_improved_work": self.chat.feedback_improved_work,
             "n_selected_files": n_selected_files,
             "delay_seconds": self.delay,
+            "session_seconds": self.session_duration.total_seconds() if self.session_duration else None,
+            "prompt_build_seconds": self.prompt_build_duration.total_seconds() if self.prompt_build_duration else None,
             "time_to_first_token_seconds": self.time_to_first_token.total_seconds()
             if self.time_to_first_token
             else None,
+            "streaming_seconds": self.streaming_duration.total_seconds() if self.streaming_duration else None,
+            "tokens_per_second": self.tokens_per_second,
+            "persistence_seconds": self.persistence_duration.total_seconds() if self.persistence_duration else None,
+            "cache_hit": self.cache_hit,
+            "truncated": self.truncated,
+            "cached_token_count": self.cached_token_count,
         }
-        if settings.ELASTIC_CLIENT:
-            try:
-                settings.ELASTIC_CLIENT.create(
-                    index=settings.ELASTIC_CHAT_MESSAGE_INDEX,
-                    id=uuid.uuid4(),
-                    document=elastic_log_msg,
-                )
-            except Exception as e:  # noqa: BLE001
-                logger.warning("failed to log metric %s", e)
+        chat_message_telemetry.put(str(self.id), elastic_log_msg)
 
     @classmethod
     def metrics(cls):
@@ -697,36 +1127,41 @@ def get_unique_chat_title(title: str, user: User, number: int = 0) -> str:
     return new_title
 
 
-def get_chat_session(user: User, chat_id: uuid.UUID, data: dict) -> tuple[Chat, float]:
-    """create or update a Chat, and return a delay (seconds) to handle large traffic"""
-    chat = Chat.objects.get(id=chat_id)
+def get_chat_session(
+    user: User,
+    chat_id: uuid.UUID,
+    data: dict,
+    allow_map_reduce: bool = False,
+    reserve: bool = True,
+    chat: Chat | None = None,
+) -> tuple[Chat, float, int]:
+    """create or update a Chat, reserve its tokens from the rate limit of its backend, and return the delay (seconds)
+    before the reservation can be used and the number of tokens reserved, for refunding once the actual usage is known
+
+    chats too large for every model are rejected, unless the caller can answer them with redbox.run_map_reduce
+    callers that queue for admission reserve the tokens themselves, reserve=False only counts them
+    callers answering many turns pass the Chat from the last one, and only what changes elsewhere is read again
+    """
+    if chat is None:
+        chat = Chat.objects.select_related("chat_backend").get(id=chat_id)
+    else:
+        chat.refresh_from_db(fields=Chat.REFRESHED_EACH_TURN)
 
-    if chat_backend_id := data.get("llm"):
+    if (chat_backend_id := data.get("llm")) and str(chat_backend_id) != str(chat.chat_backend_id):
         chat.chat_backend = ChatLLMBackend.objects.get(id=chat_backend_id)
-        chat.save()
+        chat.save(update_fields=["chat_backend"])
 
-    if temperature := data.get("temperature", 0):
+    if (temperature := data.get("temperature", 0)) and temperature != chat.temperature:
         chat.temperature = temperature
-        chat.save()
+        chat.save(update_fields=["temperature"])
 
     # Update session name if this is the first message
     if not chat.chatmessage_set.exists():
         chat.name = get_unique_chat_title(data.get("message", ""), user)
-        chat.save()
-
-    token_count_this_message = chat.token_count()
+        chat.save(update_fields=["name"])
 
     active_context_window_sizes = ChatLLMBackend.active_context_window_sizes()
-
-    if token_count_this_message > max(active_context_window_sizes.values()):
-        raise ValueError(error_messages.FILES_TOO_LARGE)
-
-    if token_count_this_message > chat.context_window_size():
-        details = "\n".join(
-            f"* `{k}`: {v} tokens" for k, v in active_context_window_sizes.items() if v >= token_count_this_message
-        )
-        msg = f"{error_messages.FILES_TOO_LARGE}.\nTry one of the following models:\n{details}"
-        raise ValueError(msg)
+    check_context_window(chat, active_context_window_sizes, allow_map_reduce)
 
     ChatMessage.objects.create(
         chat=chat,
@@ -734,16 +1169,25 @@ def get_chat_session(user: User, chat_id: uuid.UUID, data: dict) -> tuple[Chat,
         role=ChatMessage.Role.user,
     )
 
-    tokens_used_in_last_min = (
-        ChatMessage.objects.filter(
-            chat__chat_backend=chat.chat_backend,
-            created_at__gt=datetime.now(tz=utc) - timedelta(minutes=1),
-        ).aggregate(Sum("token_count"))["token_count__sum"]
-        or 0
-    )
+    # the chat's totals now include the message
+    reserved = chat.reserved_token_count(max(active_context_window_sizes.values()))
+    delay = get_rate_limiter().reserve(chat.chat_backend, reserved) if reserve else 0.0
+
+    return chat, delay, reserved
 
-    delay = token_count_this_message / (chat.chat_backend.rate_limit - tokens_used_in_last_min)
 
-    delay = max(delay, 0)  # should never happen but just in case!
+def check_context_window(chat: Chat, active_context_window_sizes: dict[str, int], allow_map_reduce: bool) -> None:
+    """reject a chat too large for every model, unless it can be answered with redbox.run_map_reduce, or too large
+    for its own model, suggesting the models it would fit"""
+    token_count_this_message = chat.prompt_token_count()
+
+    if token_count_this_message > max(active_context_window_sizes.values()):
+        if not allow_map_reduce:
+            raise ValueError(error_messages.FILES_TOO_LARGE)
 
-    return chat, delay * 60
+    elif token_count_this_message > chat.context_window_size():
+        details = "\n".join(
+            f"* `{k}`: {v} tokens" for k, v in active_context_window_sizes.items() if v >= token_count_this_message
+        )
+        msg = f"{error_messages.FILES_TOO_LARGE}.\nTry one of the following models:\n{details}"
+        raise ValueError(msg)
@@ -0,0 +1,53 @@
+"""File status pushed from the ingest worker to the browser.
+
+The worker sends each status change to the chat's group on the channel layer, once the change is committed, and the
+ingest queue's head to every file status socket. The consumers that have joined those groups, in any web process,
+pass them on to the browser.
+"""
+
+from typing import Any
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+# every file status socket, in every process, joins this group to hear when the ingest queue moves on
+FILE_QUEUE_GROUP = "file-queue"
+
+
+def chat_group(chat_id) -> str:
+    """the group of the sockets answering a chat, in every process"""
+    return f"chat-{chat_id}"
+
+
+def chat_files_group(chat_id) -> str:
+    """the group of the sockets following the status of a chat's files, in every process"""
+    return f"chat-{chat_id}-files"
+
+
+def file_status(file) -> dict[str, Any]:
+    """the status of a file as the browser shows it"""
+    return {
+        "id": str(file.id),
+        "status": file.get_status_text(),
+        "position_in_queue": file.position_in_queue() if file.status == file.Status.processing else -1,
+        "tokens": file.token_count,
+        "progress": file.progress,
+    }
+
+
+def publish(group: str, message: dict[str, Any]) -> None:
+    """send to every member of the group once the current transaction commits, so a change rolled back is never seen"""
+    transaction.on_commit(lambda: async_to_sync(get_channel_layer().group_send)(group, message))
+
+
+def publish_file_status(file) -> None:
+    publish(
+        chat_files_group(file.chat_id),
+        {"type": "file.status", "sequence": file.ingest_task_id, "file": file_status(file)},
+    )
+
+
+def publish_queue_head(first_queued: int | None) -> None:
+    """tell every chat which ingest task is now at the front of the queue, so that they can work out their positions"""
+    publish(FILE_QUEUE_GROUP, {"type": "queue.head", "queue_head": first_queued})
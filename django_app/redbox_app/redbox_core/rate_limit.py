@@ -0,0 +1,103 @@
+"""Token buckets that keep the traffic to each LLM backend within its rate_limit, in tokens per minute.
+
+Each turn reserves the tokens it expects to use before it calls the LLM, waiting if the bucket has run dry, and is
+refunded the difference once the LLM has said how many it really used.
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from functools import cache
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from langchain_core.messages import AIMessage
+
+from redbox import count_tokens
+
+
+def refill(level: float, capacity: int, elapsed_seconds: float) -> float:
+    """the level of a bucket that refills at capacity tokens a minute, and holds no more than capacity"""
+    return min(float(capacity), level + elapsed_seconds * capacity / 60)
+
+
+def wait_for(level: float, capacity: int) -> float:
+    """seconds until a bucket at level has refilled to zero"""
+    if level >= 0 or not capacity:
+        return 0.0
+    return -level * 60 / capacity
+
+
+class TokenBucket(ABC):
+    """A bucket of tokens per ChatLLMBackend, full at its rate_limit. Reservations may take the level below zero, the
+    caller then waits until it would have refilled.
+    """
+
+    def reserve(self, chat_backend, tokens: int) -> float:
+        """take tokens from the backend's bucket, returning the seconds to wait before using them"""
+        return wait_for(self._take(chat_backend, tokens), chat_backend.rate_limit)
+
+    def refund(self, chat_backend, tokens: int) -> None:
+        """return tokens that were reserved but not used, a negative refund takes tokens used but not reserved"""
+        if tokens:
+            self._take(chat_backend, -tokens)
+
+    @abstractmethod
+    def _take(self, chat_backend, tokens: int) -> float:
+        """refill the bucket, take tokens from it and return the level left"""
+
+
+class MemoryTokenBucket(TokenBucket):
+    """Buckets held in this process, for tests and for running a single process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: dict[object, tuple[float, float]] = {}
+
+    def _take(self, chat_backend, tokens: int) -> float:
+        now = time.monotonic()
+        with self._lock:
+            level, updated = self._buckets.get(chat_backend.pk, (float(chat_backend.rate_limit), now))
+            level = refill(level, chat_backend.rate_limit, now - updated) - tokens
+            self._buckets[chat_backend.pk] = (level, now)
+        return level
+
+
+class DatabaseTokenBucket(TokenBucket):
+    """Buckets held in the RateLimitBucket table, shared by every process. Each row is locked while it is updated."""
+
+    def _take(self, chat_backend, tokens: int) -> float:
+        from redbox_app.redbox_core.models import RateLimitBucket
+
+        with transaction.atomic():
+            bucket, _ = RateLimitBucket.objects.select_for_update().get_or_create(
+                chat_backend=chat_backend, defaults={"level": chat_backend.rate_limit}
+            )
+            now = timezone.now()
+            elapsed = max((now - bucket.updated_at).total_seconds(), 0.0)
+            bucket.level = refill(bucket.level, chat_backend.rate_limit, elapsed) - tokens
+            bucket.updated_at = now
+            bucket.save(update_fields=["level", "updated_at"])
+        return bucket.level
+
+
+@cache
+def _rate_limiter(path: str) -> TokenBucket:
+    return import_string(path)()
+
+
+def get_rate_limiter() -> TokenBucket:
+    """the TokenBucket named by settings.RATE_LIMITER, one per process"""
+    return _rate_limiter(settings.RATE_LIMITER)
+
+
+def tokens_used(response: AIMessage, prompt_tokens: int) -> int:
+    """tokens a turn used, as reported by the LLM, or else estimated as the prompt plus the answer, map-reduce answers
+    served from the cache still report the usage of the calls made for their notes"""
+    if response.usage_metadata:
+        return response.usage_metadata["total_tokens"]
+    if response.response_metadata.get("cache_hit"):
+        return 0
+    return prompt_tokens + count_tokens(response.content)
@@ -0,0 +1,87 @@
+"""Answers as they are streamed, kept so that a browser whose socket drops part way through an answer can reconnect,
+perhaps to another web process, and be sent what it missed rather than asking again.
+
+The process answering a turn numbers each message it sends about it and keeps them, under the id that the answer will
+be saved with, answering requests to resume from the stream's group on the channel layer. Once the answer is saved it
+is resumed from its ChatMessage instead.
+"""
+
+import asyncio
+import json
+import uuid
+from collections.abc import Callable, Iterable
+from typing import Any
+
+from channels.layers import BaseChannelLayer
+
+
+def stream_group(stream_id: uuid.UUID | str) -> str:
+    return f"stream-{stream_id}"
+
+
+class AnswerStream:
+    """the messages of one turn, numbered from 1, in the process answering it"""
+
+    def __init__(self, chat_id, on_resume: Callable[[], None], on_stop: Callable[[], None]):
+        self.id = uuid.uuid4()
+        self.chat_id = str(chat_id)
+        self.on_resume = on_resume
+        self.on_stop = on_stop
+        self.messages: list[tuple[int, str]] = []
+        # a socket has asked to resume the stream, and hears the rest of it from the chat's group
+        self.resumed = False
+
+    def add(self, message: dict[str, Any]) -> tuple[int, str]:
+        """number the message, returning it as the text to send"""
+        seq = len(self.messages) + 1
+        text = json.dumps({**message, "stream": str(self.id), "seq": seq}, default=str)
+        self.messages.append((seq, text))
+        return seq, text
+
+    def after(self, seq: int) -> list[tuple[int, str]]:
+        return self.messages[max(seq, 0) :]
+
+    async def serve(self, channel_layer: BaseChannelLayer) -> None:
+        """answer requests to resume, or stop, this stream from sockets on its chat, until cancelled once the answer
+        is saved"""
+        group = stream_group(self.id)
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(group, channel)
+        try:
+            while True:
+                request = await channel_layer.receive(channel)
+                if request.get("chat_id") != self.chat_id:
+                    continue
+                if request["type"] == "chat.stop":
+                    self.on_stop()
+                    continue
+                self.resumed = True
+                self.on_resume()
+                await channel_layer.send(
+                    request["reply_to"],
+                    {"type": "chat.backlog", "stream": str(self.id), "messages": self.after(request["seq"])},
+                )
+        finally:
+            await channel_layer.group_discard(group, channel)
+
+
+class Resumption:
+    """a stream being resumed on a socket, what is heard of it from the group while waiting for the backlog is held
+    back, so that the browser is sent each message once and in order"""
+
+    def __init__(self, stream_id: uuid.UUID, seq: int):
+        self.stream_id = str(stream_id)
+        self.seq = seq
+        self.backlog: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.held: list[tuple[int, str]] = []
+        # once the backlog is sent, messages are passed on as they are heard
+        self.live = False
+
+    def take(self, messages: Iterable[tuple[int, str]]) -> list[str]:
+        """the texts of the messages not yet sent, in order"""
+        texts = []
+        for seq, text in sorted(messages):
+            if seq > self.seq:
+                texts.append(text)
+                self.seq = seq
+        return texts
@@ -0,0 +1,159 @@
+"""Chat message metrics sent to Elasticsearch in the background.
+
+Saving a ChatMessage puts its metrics on a bounded queue and returns. A flusher thread sends them with the bulk API,
+keeping only the latest version of each message, and appends them to a spill file when Elasticsearch cannot be
+reached, to be sent again once it can. Documents Elasticsearch rejects are spilled too if it may take them later,
+when it is overloaded or failing, and otherwise dropped, as sending them again would fail the same way.
+"""
+
+import atexit
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any
+
+from django.conf import settings
+from elasticsearch import ApiError, TransportError
+
+logger = logging.getLogger(__name__)
+
+# bulk item statuses that may succeed if the document is sent again, others are dropped
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TelemetryQueue:
+    """Documents waiting to be indexed, by id, so a document put twice before it is sent is only sent once."""
+
+    def __init__(self):
+        self._pending: dict[str, dict[str, Any]] = {}
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.dropped = 0
+        atexit.register(self.stop)
+
+    def put(self, document_id: str, document: dict[str, Any]) -> None:
+        """queue a document to be indexed, this never waits for Elasticsearch"""
+        if not settings.ELASTIC_CLIENT:
+            return
+
+        with self._condition:
+            if document_id not in self._pending and len(self._pending) >= settings.TELEMETRY_QUEUE_SIZE:
+                self.dropped += 1
+                logger.warning("telemetry queue is full, %s documents dropped", self.dropped)
+                return
+            self._pending[document_id] = document
+            if len(self._pending) >= settings.TELEMETRY_BATCH_SIZE:
+                self._condition.notify()
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="telemetry-flusher", daemon=True)
+                self._thread.start()
+
+    def flush(self) -> None:
+        """send everything queued, or spill it if Elasticsearch is down"""
+        while batch := self._take():
+            self._send(batch)
+
+    def stop(self) -> None:
+        """stop the flusher, once it has sent what is queued"""
+        self._stop.set()
+        with self._condition:
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            with self._condition:
+                if len(self._pending) < settings.TELEMETRY_BATCH_SIZE and not self._stop.is_set():
+                    self._condition.wait(settings.TELEMETRY_FLUSH_INTERVAL_SECONDS)
+            self.flush()
+        self.flush()
+
+    def _take(self) -> dict[str, dict[str, Any]]:
+        with self._condition:
+            ids = list(self._pending)[: settings.TELEMETRY_BATCH_SIZE]
+            return {document_id: self._pending.pop(document_id) for document_id in ids}
+
+    def _send(self, batch: dict[str, dict[str, Any]]) -> None:
+        retry = self._bulk(batch)
+        if retry is None:
+            self._spill(batch)
+            return
+        self._replay_spill()
+        # spilled after the replay, so that they wait for the next batch rather than being sent again at once
+        if retry:
+            self._spill(retry)
+
+    def _bulk(self, batch: dict[str, dict[str, Any]]) -> dict[str, dict[str, Any]] | None:
+        """index the batch, returning the documents to send again later, or None if Elasticsearch could not be
+        reached"""
+        operations: list[dict[str, Any]] = []
+        for document_id, document in batch.items():
+            operations += [{"index": {"_index": settings.ELASTIC_CHAT_MESSAGE_INDEX, "_id": document_id}}, document]
+
+        try:
+            response = settings.ELASTIC_CLIENT.bulk(operations=operations)
+        except (ApiError, TransportError) as e:
+            logger.warning("failed to send %s metrics: %s", len(batch), e)
+            return None
+
+        if not response.get("errors"):
+            return {}
+        failed = [item["index"] for item in response["items"] if "error" in item["index"]]
+        retry = {item["_id"]: batch[item["_id"]] for item in failed if item.get("status") in RETRY_STATUSES}
+        logger.warning(
+            "failed to index %s metrics, %s to be sent again, first error %s",
+            len(failed),
+            len(retry),
+            failed[0]["error"],
+        )
+        return retry
+
+    def _spill(self, batch: dict[str, dict[str, Any]]) -> None:
+        path = Path(settings.TELEMETRY_SPILL_PATH)
+        try:
+            with path.open("a") as spill:
+                for document_id, document in batch.items():
+                    spill.write(json.dumps({"id": document_id, "document": document}, default=str) + "\n")
+        except OSError:
+            logger.exception("failed to spill %s metrics to %s", len(batch), path)
+
+    def _replay_spill(self) -> None:
+        """send documents spilled while Elasticsearch was down, the latest of each id, a replay left by a process that
+        stopped part way is sent before anything spilled since"""
+        path = Path(settings.TELEMETRY_SPILL_PATH)
+        replaying = path.with_name(f"{path.name}.replay")
+        if not replaying.exists():
+            try:
+                path.replace(replaying)
+            except FileNotFoundError:
+                return
+
+        spilled: dict[str, dict[str, Any]] = {}
+        with replaying.open() as spill:
+            for number, line in enumerate(spill, 1):
+                try:
+                    record = json.loads(line)
+                    spilled[record["id"]] = record["document"]
+                except (ValueError, KeyError, TypeError):
+                    # such as the last line of a spill cut short by a crash
+                    logger.warning("skipping unreadable line %s of %s", number, replaying)
+        replaying.unlink()
+
+        items = list(spilled.items())
+        for start in range(0, len(items), settings.TELEMETRY_BATCH_SIZE):
+            batch = dict(items[start : start + settings.TELEMETRY_BATCH_SIZE])
+            retry = self._bulk(batch)
+            if retry is None:
+                self._spill(dict(items[start:]))
+                return
+            if retry:
+                self._spill(retry)
+        logger.info("sent %s spilled metrics", len(items))
+
+
+chat_message_telemetry = TelemetryQueue()
@@ -1,8 +1,10 @@
 import logging
+from datetime import UTC, datetime
 from http import HTTPStatus
 from typing import ClassVar
 from uuid import UUID
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.shortcuts import get_object_or_404
 from rest_framework import status
@@ -17,6 +19,7 @@ from rest_framework.viewsets import ModelViewSet
 from redbox import run_sync
 from redbox_app.redbox_core import error_messages
 from redbox_app.redbox_core.models import Chat, ChatMessage, File, get_chat_session
+from redbox_app.redbox_core.rate_limit import get_rate_limiter, tokens_used
 from redbox_app.redbox_core.utils import sanitize_json
 
 User = get_user_model()
@@ -90,22 +93,30 @@ class ChatMessageView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+        started = datetime.now(tz=UTC)
         try:
-            chat, _delay = get_chat_session(chat_id=chat_id, user=request.user, data=serializer.validated_data)
+            chat, _delay, reserved = get_chat_session(
+                chat_id=chat_id, user=request.user, data=serializer.validated_data
+            )
         except ValueError as e:
             return Response({"non_field_errors": e.args[0]}, status=status.HTTP_400_BAD_REQUEST)
+        session_duration = datetime.now(tz=UTC) - started
 
+        started = datetime.now(tz=UTC)
         state = chat.to_langchain()
+        prompt_build_duration = datetime.now(tz=UTC) - started
 
+        used = 0
         try:
-            state, time_to_first_token = run_sync(state)
+            state, _ = run_sync(state, response_cache=settings.RESPONSE_CACHE)
+            used = tokens_used(state, reserved)
 
             message = ChatMessage.objects.create(
                 chat=chat,
-                text=state.content,
-                role=ChatMessage.Role.ai,
-                time_to_first_token=time_to_first_token,
+                session_duration=session_duration,
+                **ChatMessage.response_fields(state, prompt_build_duration),
             )
+            chat.compact()
 
             return Response(
                 {"message_id": message.id, "title": chat.name, "session_id": chat.id}, status=status.HTTP_200_OK
@@ -114,6 +125,9 @@ class ChatMessageView(APIView):
         except BaseException:  # noqa: BLE001
             return Response({"non_field_error": error_messages.CORE_ERROR_MESSAGE}, status=status.HTTP_200_OK)
 
+        finally:
+            get_rate_limiter().refund(chat.chat_backend, reserved - used)
+
 
 class ChatSerializer(ModelSerializer):
     class Meta:
@@ -55,6 +55,7 @@ class ChatsView(View):
             "chat_grouped_by_date_group": chat_grouped_by_date_group,
             "current_chat": current_chat,
             "streaming": {"endpoint": str(endpoint)},
+            "file_status": {"endpoint": str(endpoint / "files")},
             "contact_email": settings.CONTACT_EMAIL,
             "completed_files": completed_files,
             "processing_files": processing_files,
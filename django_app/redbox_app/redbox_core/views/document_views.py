@@ -15,6 +15,7 @@ from django.views import View
 from django.views.decorators.http import require_http_methods
 
 from redbox_app.redbox_core.models import File
+from redbox_app.redbox_core.notifications import file_status
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
@@ -130,6 +131,4 @@ def file_status_api_view(request: HttpRequest) -> JsonResponse:
     except File.DoesNotExist as ex:
         logger.exception("File object information not found in django - file does not exist %s.", file_id, exc_info=ex)
         return JsonResponse({"status": File.Status.errored.label})
-    return JsonResponse(
-        {"status": file.get_status_text(), "position_in_queue": file.position_in_queue(), "tokens": file.token_count}
-    )
+    return JsonResponse(file_status(file))
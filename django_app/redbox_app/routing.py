@@ -4,4 +4,5 @@ from .redbox_core import consumers
 
 websocket_urlpatterns = [
     path(r"ws/chat/<uuid:chat_id>", consumers.ChatConsumer.as_asgi(), name="chat"),
+    path(r"ws/chat/<uuid:chat_id>/files", consumers.FileStatusConsumer.as_asgi(), name="file-status"),
 ]
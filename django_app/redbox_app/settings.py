@@ -2,6 +2,7 @@
 import logging
 import os
 import socket
+import tempfile
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -15,6 +16,7 @@ from sentry_sdk.integrations.django import DjangoIntegration
 from storages.backends import s3boto3
 from yarl import URL
 
+from redbox import ResponseCache
 from redbox_app.setting_enums import Classification, Environment
 
 logger = logging.getLogger(__name__)
@@ -123,6 +125,14 @@ TEMPLATES = [
 WSGI_APPLICATION = "redbox_app.wsgi.application"
 ASGI_APPLICATION = "redbox_app.asgi.application"
 
+# consumers in every web process, and the worker, reach each other through the database with LISTEN/NOTIFY, the in
+# memory layer only reaches consumers in the same process
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": env.str("CHANNEL_LAYER_BACKEND", "redbox_app.redbox_core.channel_layer.PostgresChannelLayer"),
+    }
+}
+
 AUTHENTICATION_BACKENDS = [
     "django.contrib.auth.backends.ModelBackend",
 ]
@@ -395,6 +405,50 @@ MESSAGE_THROTTLE_SECONDS_MIN = env.int("MESSAGE_THROTTLE_SECONDS_MIN", 1)
 MESSAGE_THROTTLE_SECONDS_MAX = env.int("MESSAGE_THROTTLE_SECONDS_MAX", 10)
 MESSAGE_THROTTLE_RATE = env.float("MESSAGE_THROTTLE_RATE", 0.1)
 
+# paces the tokens sent to each LLM backend to its rate_limit, MemoryTokenBucket only holds them in one process
+# chat turns queue for it fairly across users and departments within each process only, see redbox_core.admission
+RATE_LIMITER = env.str("RATE_LIMITER", "redbox_app.redbox_core.rate_limit.DatabaseTokenBucket")
+
+# uploads are streamed to disk in chunks of this many bytes for ingest, and their text extracted using at most this much
+# memory, in a process of its own
+INGEST_SPOOL_CHUNK_SIZE = env.int("INGEST_SPOOL_CHUNK_SIZE", 8 * 1024 * 1024)
+INGEST_MEMORY_LIMIT_MB = env.int("INGEST_MEMORY_LIMIT_MB", 4096)
+
+# PDFs are ingested, and saved, this many pages at a time, with each task handing over to a new one after this long
+INGEST_PAGE_BATCH_SIZE = env.int("INGEST_PAGE_BATCH_SIZE", 20)
+INGEST_TIME_BUDGET_SECONDS = env.int("INGEST_TIME_BUDGET_SECONDS", Q_CLUSTER["timeout"] * 4 // 5)
+
+# chats whose documents leave less than this many tokens of the context window only send the best matching chunks
+RETRIEVAL_CONTEXT_RESERVE_TOKENS = env.int("RETRIEVAL_CONTEXT_RESERVE_TOKENS", 32_000)
+# tokens of those chunks sent in place of the documents, 0 always sends them in full, using map-reduce when too large
+RETRIEVAL_TOKEN_BUDGET = env.int("RETRIEVAL_TOKEN_BUDGET", 16_000)
+RETRIEVAL_TOP_K = env.int("RETRIEVAL_TOP_K", 32)
+
+# streamed answers are sent to the browser in batches, when this much text is waiting or after this long
+STREAM_FLUSH_INTERVAL_MS = env.int("STREAM_FLUSH_INTERVAL_MS", 30)
+STREAM_FLUSH_CHARS = env.int("STREAM_FLUSH_CHARS", 256)
+# an answer goes on this long after the browser's socket drops, for it to reconnect and resume, 0 stops it at once
+STREAM_RESUME_SECONDS = env.int("STREAM_RESUME_SECONDS", 60)
+# how long a reconnected socket waits to hear from the process answering the turn it is resuming
+STREAM_RESUME_TIMEOUT_SECONDS = env.float("STREAM_RESUME_TIMEOUT_SECONDS", 2.0)
+
+# chats too large for any model are answered section by section, this many LLM calls at a time per chat
+MAP_REDUCE_CONCURRENCY = env.int("MAP_REDUCE_CONCURRENCY", 4)
+
+# once the chat history passes this share of the context window, all but the most recent messages are summarised
+COMPACTION_THRESHOLD = env.float("COMPACTION_THRESHOLD", 0.5)
+COMPACTION_KEEP_MESSAGES = env.int("COMPACTION_KEEP_MESSAGES", 6)
+
+
+# answers to identical requests over identical documents are served from memory, per process, when enabled
+if env.bool("RESPONSE_CACHE_ENABLED", False):
+    RESPONSE_CACHE = ResponseCache(
+        ttl=env.int("RESPONSE_CACHE_TTL_SECONDS", 3600),
+        max_bytes=env.int("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+    )
+else:
+    RESPONSE_CACHE = None
+
 ALLOWED_EMAIL_DOMAINS = [domain.strip() for domain in env.str("ALLOWED_EMAIL_DOMAINS", ".gov.uk").split(",")]
 
 
@@ -424,3 +478,10 @@ else:
         pass
 
     ELASTIC_CLIENT = client.options(request_timeout=30, retry_on_timeout=True, max_retries=3)
+
+# chat message metrics are queued, up to TELEMETRY_QUEUE_SIZE messages, and sent to elastic in the background in bulk
+TELEMETRY_QUEUE_SIZE = env.int("TELEMETRY_QUEUE_SIZE", 10000)
+TELEMETRY_BATCH_SIZE = env.int("TELEMETRY_BATCH_SIZE", 500)
+TELEMETRY_FLUSH_INTERVAL_SECONDS = env.float("TELEMETRY_FLUSH_INTERVAL_SECONDS", 5.0)
+# metrics that could not be sent are appended here and sent once elastic is back
+TELEMETRY_SPILL_PATH = env.str("TELEMETRY_SPILL_PATH", str(Path(tempfile.gettempdir()) / "redbox-telemetry.jsonl"))
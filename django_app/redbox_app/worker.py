@@ -1,33 +1,263 @@
+import contextlib
 import logging
+import multiprocessing
+import resource
+import tempfile
+import time
+import zlib
+from collections.abc import Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import cache
+from pathlib import Path
 from uuid import UUID
 
-from markitdown import MarkItDown, UnsupportedFormatException
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.fields.files import FieldFile
+from django.db.models.functions import Greatest
+from markitdown import UnsupportedFormatException
 
-from redbox import get_tokeniser
+from redbox import LexicalIndex, count_tokens, summarise_messages
+from redbox_app import extraction
+from redbox_app.redbox_core import notifications
 from redbox_app.redbox_core.utils import sanitise_string
 
-md = MarkItDown()
-tokeniser = get_tokeniser()
+# bump whenever a change to ingest would change the text or index it produces, files from older versions are stale
+INGEST_VERSION = 1
 
 
-def ingest(file_id: UUID) -> None:
-    # These models need to be loaded at runtime otherwise they can be loaded before they exist
-    from redbox_app.redbox_core.models import File
+@contextlib.contextmanager
+def spool(original_file: FieldFile, chunk_size: int) -> Iterator[Path]:
+    """stream an upload from storage to a temporary file, chunk_size bytes at a time, and yield its path"""
+    with (
+        original_file.open("rb") as original,
+        tempfile.NamedTemporaryFile(suffix=Path(original_file.name).suffix) as spooled,
+    ):
+        for chunk in original.chunks(chunk_size):
+            spooled.write(chunk)
+        spooled.flush()
+        yield Path(spooled.name)
+
+
+@cache
+def extractor() -> Executor:
+    """the process this worker extracts text in, started afresh rather than forked from the worker and its threads, on
+    first use and again if it dies"""
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+
+
+def reset_peak_rss() -> None:
+    """start measuring peak_rss from here, where the kernel allows it"""
+    with contextlib.suppress(OSError), Path("/proc/self/clear_refs").open("w") as clear_refs:
+        clear_refs.write("5")
+
+
+def peak_rss() -> int:
+    """the high-water mark of resident memory in bytes, since reset_peak_rss where supported"""
+    with contextlib.suppress(OSError):
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def extract_pdf_pages(file, path: Path, deadline: float, extracting: Executor) -> bool:
+    """Extract the text of a PDF a batch of pages at a time, from file.pages_extracted onwards.
+
+    Each batch is saved to the file's extracting_text as a row of its own as it is extracted, so that ingest can resume
+    from it. A file without text yet uses it as its text, so that chats can use the pages so far, one being reingested
+    keeps its old text until the new text is complete. Returns False if the deadline passes before the last page.
+    """
+    from redbox_app.redbox_core.models import ExtractedText, ExtractedTextBatch
+
+    limit_bytes = settings.INGEST_MEMORY_LIMIT_MB * 1024 * 1024
+    if file.extracting_text_id is None:
+        # a row of its own, rather than one shared with identical files, until the text is complete
+        file.pages_total = extracting.submit(extraction.count_pdf_pages, path, limit_bytes).result()
+        file.pages_extracted = 0
+        file.extracting_text = ExtractedText.objects.create()
+        update_fields = ["extracting_text", "pages_extracted", "pages_total", "modified_at"]
+        if file.extracted_text_id is None:
+            file.extracted_text = file.extracting_text
+            file.token_count = 0
+            update_fields += ["extracted_text", "token_count"]
+        file.save(update_fields=update_fields)
+
+    partial = file.extracted_text_id == file.extracting_text_id
+    while file.pages_extracted < file.pages_total:
+        end = min(file.pages_extracted + settings.INGEST_PAGE_BATCH_SIZE, file.pages_total)
+        pages = range(file.pages_extracted, end)
+        text = sanitise_string(extracting.submit(extraction.extract_pdf_pages, path, pages, limit_bytes).result())
+        ExtractedTextBatch.objects.update_or_create(
+            extracted_text=file.extracting_text,
+            first_page=file.pages_extracted,
+            defaults={"compressed_text": zlib.compress(text.encode())},
+        )
+        file.pages_extracted = end
+        update_fields = ["pages_extracted", "pages_total", "modified_at"]
+        if partial:
+            file.token_count += count_tokens(text)
+            update_fields.append("token_count")
+        file.save(update_fields=update_fields)
+        notifications.publish_file_status(file)
+        # every task extracts at least one batch, so that ingest always moves on
+        if file.pages_extracted < file.pages_total and time.monotonic() > deadline:
+            return False
+    return True
+
+
+def extract_text(file, deadline: float) -> dict | None:
+    """convert a file to text, returning the fields of its ExtractedText, or None if the deadline passed first"""
+    with spool(file.original_file, settings.INGEST_SPOOL_CHUNK_SIZE) as path:
+        try:
+            if path.suffix.lower() == ".pdf":
+                if not extract_pdf_pages(file, path, deadline, extractor()):
+                    return None
+                text = file.extracting_text.text
+            else:
+                limit_bytes = settings.INGEST_MEMORY_LIMIT_MB * 1024 * 1024
+                text = sanitise_string(extractor().submit(extraction.convert, path, limit_bytes).result())
+        except BrokenProcessPool:
+            # killed part way, by the OOM killer say, the next file is extracted in a new process
+            extractor.cache_clear()
+            raise
+        return {
+            "text": text,
+            "token_count": count_tokens(text),
+            "lexical_index": LexicalIndex.from_text(text).model_dump(),
+            "ingest_version": INGEST_VERSION,
+        }
+
+
+def get_extracted_text(file, deadline: float):
+    """the up to date ExtractedText of an identical file, else the file's own once extracted, or None if paused"""
+    from redbox_app.redbox_core.models import ExtractedText
+
+    if file.content_hash:
+        extracted_text = ExtractedText.objects.filter(
+            content_hash=file.content_hash, ingest_version=INGEST_VERSION
+        ).first()
+        if extracted_text:
+            logging.info("reusing text extracted from an identical file for: %s", file)
+            return extracted_text
+
+    fields = extract_text(file, deadline)
+    if fields is None:
+        return None
+    if file.content_hash:
+        extracted_text, _ = ExtractedText.objects.update_or_create(content_hash=file.content_hash, defaults=fields)
+        return extracted_text
+    return ExtractedText.objects.create(**fields)
+
+
+def get_file_to_ingest(file_id: UUID, ingest_task_id: int | None):
+    """the file, or None, with the task marked as done, if it has been deleted or enqueued again"""
+    from redbox_app.redbox_core.models import File, IngestTask
 
     try:
         file = File.objects.get(id=file_id)
     except File.DoesNotExist:
         logging.info("file_id=%s no longer exists, has the user deleted it?", file_id)
+        IngestTask.mark(ingest_task_id, IngestTask.State.errored)
+        return None
+    if ingest_task_id is not None and file.ingest_task_id not in (None, ingest_task_id):
+        # the file was enqueued again once this task was taken to have been lost, the newer task ingests it
+        logging.info("ingest task %s of %s has been superseded by %s", ingest_task_id, file, file.ingest_task_id)
+        IngestTask.mark(ingest_task_id, IngestTask.State.complete)
+        return None
+    return file
+
+
+def ingest(file_id: UUID, ingest_task_id: int | None = None) -> None:
+    # These models need to be loaded at runtime otherwise they can be loaded before they exist
+    from redbox_app.redbox_core.models import File, IngestTask
+
+    IngestTask.mark(ingest_task_id, IngestTask.State.running)
+    notifications.publish_queue_head(IngestTask.first_queued())
+    file = get_file_to_ingest(file_id, ingest_task_id)
+    if file is None:
         return
+    if file.status == File.Status.errored:
+        # retrying, with any text the file has kept until the new text is complete
+        file.status = File.Status.processing
+        file.save(update_fields=["status", "modified_at"])
+    # a complete file is being reingested, and stays complete on its old text until the new text is swapped in
+    reingesting = file.status == File.Status.complete
+    notifications.publish_file_status(file)
 
-    logging.info("Ingesting file: %s", file)
+    logging.info("Ingesting file: %s, from page %d", file, file.pages_extracted)
+    reset_peak_rss()
+    # stop and hand over to a new task before django-q's timeout, which would otherwise kill this one
+    deadline = time.monotonic() + settings.INGEST_TIME_BUDGET_SECONDS
 
+    ingest_error = None
     try:
-        markdown = md.convert(file.url)
-        file.text = sanitise_string(markdown.text_content)
-        file.token_count = len(tokeniser.encode(markdown.text_content))
-        file.status = File.Status.complete
+        extracted_text = get_extracted_text(file, deadline)
+        if extracted_text is None:
+            logging.info("Ingest of %s paused at page %d, resuming in a new task", file, file.pages_extracted)
+            IngestTask.mark(ingest_task_id, IngestTask.State.complete)
+            file.ingest()
+            return
+    except MemoryError:
+        ingest_error = f"ran out of memory, {settings.INGEST_MEMORY_LIMIT_MB}MB, while extracting text"
     except (Exception, UnsupportedFormatException) as error:
+        ingest_error = str(error)
+
+    previous = file.extracted_text if file.extracted_text_id else None
+    extracting = file.extracting_text if file.extracting_text_id else None
+    file.extracting_text = None
+    if ingest_error is None:
+        file.extracted_text = extracted_text
+        file.token_count = extracted_text.token_count
+        file.ingest_version = INGEST_VERSION
+        file.status = File.Status.complete
+    elif reingesting:
+        logging.error("Reingest of %s failed, keeping the text it had: %s", file, ingest_error)
+    else:
         file.status = File.Status.errored
-        file.ingest_error = str(error)
-    file.save()
+        file.ingest_error = ingest_error
+    with transaction.atomic():
+        file.save()
+        # text without a content hash belongs to this file alone, such as that its pages were extracted into
+        for own in {previous, extracting} - {None, file.extracted_text}:
+            if own.content_hash is None:
+                own.delete()
+    IngestTask.mark(ingest_task_id, IngestTask.State.errored if ingest_error else IngestTask.State.complete)
+    notifications.publish_file_status(file)
+
+    logging.info("Ingested file: %s, status=%s, peak_rss_mb=%d", file, file.status, peak_rss() // (1024 * 1024))
+
+
+def compact_chat(chat_id: UUID) -> None:
+    """fold all but the most recent messages of a chat into its running summary"""
+    from redbox_app.redbox_core.models import Chat
+
+    try:
+        chat = Chat.objects.get(id=chat_id)
+    except Chat.DoesNotExist:
+        logging.info("chat_id=%s no longer exists, has the user deleted it?", chat_id)
+        return
+
+    if not chat.needs_compaction():
+        return
+
+    messages = list(chat.uncompacted_messages())
+    older = messages[: -settings.COMPACTION_KEEP_MESSAGES or None]
+    if not older:
+        return
+
+    summary = summarise_messages(
+        [m.to_langchain() for m in older], chat.chat_backend.to_langchain(), summary=chat.summary
+    )
+
+    # only save if no other compaction of this chat has finished in the meantime
+    updated = Chat.objects.filter(id=chat.id, summary_until=chat.summary_until).update(
+        summary=summary,
+        summary_until=older[-1].created_at,
+        summary_token_count=count_tokens(summary),
+        history_token_count=Greatest(F("history_token_count") - sum(count_tokens(m.text) for m in older), 0),
+    )
+    if not updated:
+        logging.info("chat_id=%s was compacted concurrently, discarding this summary", chat_id)
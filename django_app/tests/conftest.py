@@ -229,6 +229,18 @@ def original_file() -> UploadedFile:
     return SimpleUploadedFile("original_file.txt", b"Lorem Ipsum.")
 
 
+@pytest.fixture()
+def pdf_file(chat: Chat, s3_client) -> File:  # noqa: ARG001
+    path = Path(__file__).parents[2] / "tests" / "data" / "pdf" / "Cabinet Office - Wikipedia.pdf"
+    file = File.objects.create(
+        chat=chat,
+        original_file=SimpleUploadedFile(path.name, path.read_bytes()),
+        status=File.Status.processing,
+    )
+    yield file
+    file.delete()
+
+
 @pytest.fixture()
 def chat_with_files(chat: Chat, several_files: Sequence[File]) -> Chat:
     ChatMessage.objects.create(
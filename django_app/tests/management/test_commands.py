@@ -2,17 +2,20 @@ import contextlib
 import json
 from datetime import UTC, datetime, timedelta
 from io import StringIO
+from unittest.mock import patch
 
 import pytest
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management import CommandError, call_command
 from django.utils import timezone
 from freezegun import freeze_time
 from magic_link.models import MagicLink
 from pytz import utc
 
-from redbox_app.redbox_core.models import Chat, ChatMessage, File
+from redbox_app.redbox_core.models import Chat, ChatMessage, ExtractedText, File, IngestTask
+from redbox_app.worker import INGEST_VERSION, ingest
 
 User = get_user_model()
 
@@ -161,6 +164,95 @@ def test_reingest_files(uploaded_file: File):
     # Then
     uploaded_file.refresh_from_db()
     assert uploaded_file.status == File.Status.complete
+    assert uploaded_file.ingest_task.state == IngestTask.State.complete
+    assert uploaded_file.ingest_task.task_id
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reingest_files_only_reingests_stale_files(chat: Chat, s3_client):  # noqa: ARG001
+    # Given
+    files = {
+        name: File.objects.create(
+            chat=chat,
+            original_file=SimpleUploadedFile(f"{name}.txt", b"Lorem Ipsum."),
+            status=status,
+            extracted_text=ExtractedText.objects.create(text="old text"),
+            ingest_version=version,
+        )
+        for name, status, version in [
+            ("stale", File.Status.complete, None),
+            ("older", File.Status.complete, INGEST_VERSION - 1),
+            ("current", File.Status.complete, INGEST_VERSION),
+            ("errored", File.Status.errored, None),
+        ]
+    }
+
+    # When
+    out = StringIO()
+    call_command("reingest_files", True, batch_size=1, rate=1000, stdout=out)
+
+    # Then
+    for file in files.values():
+        file.refresh_from_db()
+    assert files["stale"].text == files["older"].text == "Lorem Ipsum."
+    assert files["stale"].ingest_version == files["older"].ingest_version == INGEST_VERSION
+    assert files["current"].text == files["errored"].text == "old text"
+    assert "2/2 files" in out.getvalue()
+    assert "files/s, ETA" in out.getvalue()
+
+    # nothing is left to do, so running again reingests nothing
+    assert not File.stale_files().exists()
+    out = StringIO()
+    call_command("reingest_files", True, stdout=out)
+    assert "Reingested 0 files" in out.getvalue()
+
+
+@pytest.mark.django_db()
+def test_reingest_files_skips_queued_files(uploaded_file: File):
+    # When
+    call_command("reingest_files", stdout=StringIO())
+    call_command("reingest_files", stdout=StringIO())
+
+    # Then
+    assert IngestTask.objects.count() == 1
+    assert uploaded_file not in File.stale_files()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reingest_files_resumes_files_whose_task_died(uploaded_file: File, settings):
+    uploaded_file.ingest()
+    IngestTask.mark(uploaded_file.ingest_task_id, IngestTask.State.running)
+    assert uploaded_file not in File.stale_files()
+
+    # the task has run for longer than django-q would let it
+    IngestTask.objects.update(started_at=timezone.now() - timedelta(seconds=settings.Q_CLUSTER["timeout"] + 1))
+    assert uploaded_file in File.stale_files()
+
+    call_command("reingest_files", True, stdout=StringIO())
+
+    uploaded_file.refresh_from_db()
+    assert (uploaded_file.status, uploaded_file.text) == (File.Status.complete, "Lorem Ipsum.")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reingest_files_resumes_files_whose_queued_task_was_lost(uploaded_file: File, settings):
+    uploaded_file.ingest()
+    lost = uploaded_file.ingest_task_id
+    assert uploaded_file not in File.stale_files()
+
+    # the task has been queued for longer than django-q would have taken to run it
+    IngestTask.objects.update(enqueued_at=timezone.now() - timedelta(seconds=settings.Q_CLUSTER["timeout"] + 1))
+    assert uploaded_file in File.stale_files()
+
+    call_command("reingest_files", True, stdout=StringIO())
+    uploaded_file.refresh_from_db()
+    assert (uploaded_file.status, uploaded_file.text) == (File.Status.complete, "Lorem Ipsum.")
+
+    # and should the lost task turn up after all, it leaves the file to the task that replaced it
+    with patch("redbox_app.worker.extract_text") as extract_text:
+        ingest(uploaded_file.id, lost)
+    extract_text.assert_not_called()
+    assert IngestTask.objects.get(id=lost).state == IngestTask.State.complete
 
 
 @pytest.mark.django_db(transaction=True)
@@ -287,3 +379,19 @@ def test_chat_metrics(user_with_chats_with_messages_over_time: Chat, s3_client):
         ],
     ]
     assert lines == expected_value
+
+
+# === benchmark_chat_turns command tests ===
+
+
+@pytest.mark.django_db(transaction=True)
+def test_benchmark_chat_turns():
+    # When
+    out = StringIO()
+    call_command("benchmark_chat_turns", turns=3, rounds=2, history=4, slow_history=20, answer_seconds=0, stdout=out)
+
+    # Then
+    assert len(out.getvalue().splitlines()) == 1
+    assert "turns/s, time to prompt of the quick turns p50" in out.getvalue()
+    assert not Chat.objects.filter(name__startswith="benchmark").exists()
+    assert not User.objects.filter(email__startswith="benchmark-").exists()
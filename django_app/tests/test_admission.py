@@ -0,0 +1,106 @@
+import asyncio
+import itertools
+
+import pytest
+
+from redbox_app.redbox_core.admission import AdmissionQueue, Ticket
+from redbox_app.redbox_core.models import ChatLLMBackend
+
+backend_ids = itertools.count(1_000_000)
+
+
+@pytest.fixture()
+def chat_backend(settings) -> ChatLLMBackend:
+    settings.RATE_LIMITER = "redbox_app.redbox_core.rate_limit.MemoryTokenBucket"
+    settings.MESSAGE_THROTTLE_SECONDS_MAX = 0.01
+    # a token a second, so that after the first turn every other turn has to wait
+    return ChatLLMBackend(id=next(backend_ids), name="gpt-4o", rate_limit=60)
+
+
+async def admit_all(queue, chat_backend, tickets) -> tuple[list[str], dict[str, list[int]]]:
+    admitted: list[str] = []
+    positions: dict[str, list[int]] = {name: [] for name in tickets}
+
+    async def admit(name: str, ticket: Ticket):
+        await queue.admit(ticket, chat_backend)
+        admitted.append(name)
+
+    tasks = []
+    for name, ticket in tickets.items():
+
+        async def on_position(position, name=name):
+            positions[name].append(position)
+
+        ticket.on_position = on_position
+        tasks.append(asyncio.create_task(admit(name, ticket)))
+
+    await asyncio.gather(*tasks)
+    return admitted, positions
+
+
+@pytest.mark.asyncio()
+async def test_admission_is_fair_between_users_and_departments(chat_backend):
+    queue = AdmissionQueue()
+    tickets = {
+        "alice 1": Ticket(user="alice", department="Cabinet Office", tokens=60),
+        "alice 2": Ticket(user="alice", department="Cabinet Office", tokens=1),
+        "alice 3": Ticket(user="alice", department="Cabinet Office", tokens=1),
+        "bob": Ticket(user="bob", department="Cabinet Office", tokens=1),
+        "carol": Ticket(user="carol", department="Number 10", tokens=1),
+    }
+
+    admitted, positions = await admit_all(queue, chat_backend, tickets)
+
+    assert admitted == ["alice 1", "alice 2", "carol", "bob", "alice 3"]
+    assert positions["alice 1"] == []
+    assert positions["carol"] == [2, 1]
+    assert positions["alice 3"][-3:] == [3, 2, 1]
+    assert len(queue) == 0
+
+
+@pytest.mark.asyncio()
+async def test_cancelled_turn_leaves_the_queue(chat_backend):
+    queue = AdmissionQueue()
+    first = Ticket(user="alice", department=None, tokens=60)
+    leaving = Ticket(user="bob", department=None, tokens=1)
+    staying = Ticket(user="carol", department=None, tokens=1)
+    positions = []
+
+    async def on_position(position):
+        positions.append(position)
+
+    staying.on_position = on_position
+
+    first_task = asyncio.create_task(queue.admit(first, chat_backend))
+    leaving_task = asyncio.create_task(queue.admit(leaving, chat_backend))
+    staying_task = asyncio.create_task(queue.admit(staying, chat_backend))
+    await asyncio.sleep(0)
+    assert len(queue) == 2
+
+    leaving_task.cancel()
+    await asyncio.gather(first_task, staying_task)
+
+    assert leaving_task.cancelled()
+    assert not leaving.ready
+    assert positions == [2, 1]
+    assert len(queue) == 0
+
+
+@pytest.mark.asyncio()
+async def test_turn_that_fails_while_waiting_leaves_the_queue(chat_backend):
+    queue = AdmissionQueue()
+    first = Ticket(user="alice", department=None, tokens=60)
+    failing = Ticket(user="bob", department=None, tokens=1)
+
+    async def on_position(_position):
+        raise ConnectionError
+
+    failing.on_position = on_position
+
+    first_task = asyncio.create_task(queue.admit(first, chat_backend))
+    await asyncio.sleep(0)
+    with pytest.raises(ConnectionError):
+        await queue.admit(failing, chat_backend)
+    await first_task
+
+    assert len(queue) == 0
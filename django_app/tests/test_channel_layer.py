@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from redbox_app.redbox_core.channel_layer import PostgresChannelLayer
+
+
+@pytest.fixture()
+def layers():
+    """two layers, as if in two web processes"""
+    layers = [PostgresChannelLayer(poll_interval=0.1), PostgresChannelLayer(poll_interval=0.1)]
+    yield layers
+    # the listeners' connections would otherwise stop the test database from being dropped
+    for layer in layers:
+        layer.stop()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_group_send_reaches_members_in_every_process(layers):
+    here, there = layers
+    channels = [await here.new_channel(), await there.new_channel(), await there.new_channel()]
+    await here.group_add("chat-1", channels[0])
+    await there.group_add("chat-1", channels[1])
+    await there.group_add("chat-2", channels[2])
+
+    await here.group_send("chat-1", {"type": "chat.event", "text": "hello"})
+
+    assert await asyncio.wait_for(here.receive(channels[0]), 5) == {"type": "chat.event", "text": "hello"}
+    assert await asyncio.wait_for(there.receive(channels[1]), 5) == {"type": "chat.event", "text": "hello"}
+    with pytest.raises(TimeoutError):
+        await asyncio.wait_for(there.receive(channels[2]), 0.5)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_send_reaches_a_channel_in_another_process(layers):
+    here, there = layers
+    channel = await there.new_channel()
+    await there.group_add("chat-1", channel)
+
+    await here.send(channel, {"type": "file.status", "n": 1})
+    await there.group_discard("chat-1", channel)
+    await here.group_send("chat-1", {"type": "file.status", "n": 2})
+    await here.send(channel, {"type": "file.status", "n": 3})
+
+    assert await asyncio.wait_for(there.receive(channel), 5) == {"type": "file.status", "n": 1}
+    assert await asyncio.wait_for(there.receive(channel), 5) == {"type": "file.status", "n": 3}
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_messages_too_large_to_notify_are_sent_in_parts(layers):
+    here, there = layers
+    channel = await there.new_channel()
+    await there.group_add("chat-1", channel)
+    text = "An answer. " * 5000
+
+    await here.group_send("chat-1", {"type": "chat.event", "text": text})
+
+    assert await asyncio.wait_for(there.receive(channel), 5) == {"type": "chat.event", "text": text}
@@ -1,31 +1,37 @@
+import asyncio
 import json
 import logging
 import os
+import uuid
 from asyncio import CancelledError
 from collections.abc import Sequence
+from datetime import timedelta
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
 from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db.models import Model
 from django.forms import model_to_dict
 from langchain_core.documents import Document
 from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 from websockets import WebSocketClientProtocol
 from websockets.legacy.client import Connect
 
-from redbox import RedboxState
+from redbox import RedboxState, ResponseCache, count_tokens
 from redbox_app.redbox_core import error_messages
-from redbox_app.redbox_core.consumers import ChatConsumer
+from redbox_app.redbox_core.consumers import ChatConsumer, FileStatusConsumer
 from redbox_app.redbox_core.models import (
     Chat,
     ChatMessage,
     File,
 )
+from redbox_app.worker import ingest
 
 User = get_user_model()
 
@@ -46,20 +52,17 @@ async def test_chat_consumer_with_new_session(chat: Chat, mocked_connect: Connec
         connected, _ = await communicator.connect()
         assert connected
 
-        await communicator.send_json_to({"message": "Hello Hal."})
+        await ask(communicator, {"message": "Hello Hal."})
         response_1 = await communicator.receive_json_from(timeout=5)
         response_2 = await communicator.receive_json_from(timeout=5)
         response_3 = await communicator.receive_json_from(timeout=5)
-        response_4 = await communicator.receive_json_from(timeout=5)
 
         # Then
         assert response_1["type"] == "info"
         assert response_1["data"] == "Loading"
         assert response_2["type"] == "text"
-        assert response_2["data"] == "Good afternoon, "
-        assert response_3["type"] == "text"
-        assert response_3["data"] == "Mr. Amor."
-        assert response_4["type"] == "end"
+        assert response_2["data"] == "Good afternoon, Mr. Amor."
+        assert response_3["type"] == "end"
 
         # Close
         await communicator.disconnect()
@@ -67,11 +70,54 @@ async def test_chat_consumer_with_new_session(chat: Chat, mocked_connect: Connec
     assert await get_chat_message_text(chat.user, ChatMessage.Role.user) == ["Hello Hal."]
     assert await get_chat_message_text(chat.user, ChatMessage.Role.ai) == ["Good afternoon, Mr. Amor."]
 
+    message = await ChatMessage.objects.aget(chat=chat, role=ChatMessage.Role.ai)
+    assert message.delay == 0
+    assert message.session_duration > timedelta()
+    assert message.prompt_build_duration > timedelta()
+    assert message.time_to_first_token > timedelta()
+    assert message.streaming_duration >= timedelta()
+    assert message.persistence_duration > timedelta()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_with_response_cache(alice: User, mocked_connect: Connect, settings):
+    # Given
+    settings.RESPONSE_CACHE = ResponseCache()
+    chats = [
+        await Chat.objects.acreate(user=alice, name="a chat"),
+        await Chat.objects.acreate(user=alice, name="another chat"),
+    ]
+
+    # When
+    frames = []
+    with patch("redbox.RedboxState.get_llm", new=lambda _: mocked_connect):
+        for chat in chats:
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+            communicator.scope["user"] = alice
+            communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+            connected, _ = await communicator.connect()
+            assert connected
+
+            await ask(communicator, {"message": "Hello Hal."})
+            responses = []
+            while not responses or responses[-1]["type"] != "end":
+                responses.append(await communicator.receive_json_from(timeout=5))
+            frames.append([response["data"] for response in responses if response["type"] == "text"])
+            await communicator.disconnect()
+
+    # Then
+    assert frames == [["Good afternoon, Mr. Amor."], ["Good afternoon, Mr. Amor."]]
+    ai_messages = [m async for m in ChatMessage.objects.filter(chat__user=alice, role=ChatMessage.Role.ai)]
+    assert [m.cache_hit for m in ai_messages] == [False, True]
+    assert [m.text for m in ai_messages] == ["Good afternoon, Mr. Amor."] * 2
+
 
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio()
-async def test_chat_consumer_staff_user(staff_user: User, chat: Chat, mocked_connect: Connect):
+async def test_chat_consumer_staff_user(staff_user: User, mocked_connect: Connect):
     # Given
+    chat = await Chat.objects.acreate(user=staff_user, name="a chat")
 
     # When
     with patch("redbox.RedboxState.get_llm", new=lambda _: mocked_connect):
@@ -81,20 +127,17 @@ async def test_chat_consumer_staff_user(staff_user: User, chat: Chat, mocked_con
         connected, _ = await communicator.connect()
         assert connected
 
-        await communicator.send_json_to({"message": "Hello Hal.", "output_text": "hello"})
+        await ask(communicator, {"message": "Hello Hal.", "output_text": "hello"})
         response_1 = await communicator.receive_json_from(timeout=5)
         response_2 = await communicator.receive_json_from(timeout=5)
         response_3 = await communicator.receive_json_from(timeout=5)
-        response_4 = await communicator.receive_json_from(timeout=5)
 
         # Then
         assert response_1["type"] == "info"
         assert response_1["data"] == "Loading"
         assert response_2["type"] == "text"
-        assert response_2["data"] == "Good afternoon, "
-        assert response_3["type"] == "text"
-        assert response_3["data"] == "Mr. Amor."
-        assert response_4["type"] == "end"
+        assert response_2["data"] == "Good afternoon, Mr. Amor."
+        assert response_3["type"] == "end"
 
         # Close
         await communicator.disconnect()
@@ -113,7 +156,10 @@ async def test_chat_consumer_with_existing_session(chat: Chat, mocked_connect: C
         connected, _ = await communicator.connect()
         assert connected
 
-        await communicator.send_json_to({"message": "Hello Hal."})
+        await ask(communicator, {"message": "Hello Hal."})
+        # disconnecting stops the answer, so wait for it to finish
+        while (await communicator.receive_json_from(timeout=5))["type"] != "end":
+            pass
 
         # Close
         await communicator.disconnect()
@@ -122,6 +168,30 @@ async def test_chat_consumer_with_existing_session(chat: Chat, mocked_connect: C
     assert await get_chat_message_text(chat.user, ChatMessage.Role.ai) == ["Good afternoon, Mr. Amor."]
 
 
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_rejects_other_users(chat: Chat, bob: User):
+    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{chat.id}")
+    communicator.scope["user"] = bob
+    communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+    connected, _ = await communicator.connect()
+    assert not connected
+    await communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_closes_on_resume_of_a_chat_no_longer_owned(chat: Chat, bob: User):
+    communicator = await open_chat(chat)
+    chat.user = bob
+    await chat.asave(update_fields=["user"])
+
+    await communicator.send_json_to({"type": "resume", "stream": str(uuid.uuid4()), "seq": 0})
+
+    assert (await communicator.receive_output(timeout=5))["type"] == "websocket.close"
+    await communicator.disconnect()
+
+
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio()
 async def test_chat_consumer_with_naughty_question(chat: Chat, mocked_connect: Connect):
@@ -135,20 +205,17 @@ async def test_chat_consumer_with_naughty_question(chat: Chat, mocked_connect: C
         connected, _ = await communicator.connect()
         assert connected
 
-        await communicator.send_json_to({"message": "Hello Hal. \x00"})
+        await ask(communicator, {"message": "Hello Hal. \x00"})
         response_1 = await communicator.receive_json_from(timeout=5)
         response_2 = await communicator.receive_json_from(timeout=5)
         response_3 = await communicator.receive_json_from(timeout=5)
-        response_4 = await communicator.receive_json_from(timeout=5)
 
         # Then
         assert response_1["type"] == "info"
         assert response_1["data"] == "Loading"
         assert response_2["type"] == "text"
-        assert response_2["data"] == "Good afternoon, "
-        assert response_3["type"] == "text"
-        assert response_3["data"] == "Mr. Amor."
-        assert response_4["type"] == "end"
+        assert response_2["data"] == "Good afternoon, Mr. Amor."
+        assert response_3["type"] == "end"
 
         # Close
         await communicator.disconnect()
@@ -157,6 +224,125 @@ async def test_chat_consumer_with_naughty_question(chat: Chat, mocked_connect: C
     assert await get_chat_message_text(chat.user, ChatMessage.Role.ai) == ["Good afternoon, Mr. Amor."]
 
 
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_answers_many_turns_on_one_socket(chat: Chat, mocked_connect: Connect):
+    # Given
+    async def answer(question: str) -> list[dict]:
+        await ask(communicator, {"message": question})
+        responses = [await communicator.receive_json_from(timeout=5)]
+        while responses[-1]["type"] != "end":
+            responses.append(await communicator.receive_json_from(timeout=5))
+        return responses
+
+    # When
+    with patch("redbox.RedboxState.get_llm", new=lambda _: mocked_connect):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+        communicator.scope["user"] = chat.user
+        communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+        connected, _ = await communicator.connect()
+        assert connected
+
+        first = await answer("Hello Hal.")
+        await communicator.send_json_to({"type": "ping"})
+        pong = await communicator.receive_json_from(timeout=5)
+        await Chat.objects.filter(id=chat.id).aupdate(name="Renamed")
+        second = await answer("Open the pod bay doors.")
+
+        # Then
+        assert await communicator.receive_nothing()
+        await communicator.disconnect()
+
+    assert pong == {"type": "pong", "data": None}
+    assert [response["type"] for response in first] == ["info", "text", "end"]
+    assert [response["type"] for response in second] == ["info", "text", "end"]
+    assert second[-1]["data"]["title"] == "Renamed"
+    assert await get_chat_message_text(chat.user, ChatMessage.Role.user) == ["Hello Hal.", "Open the pod bay doors."]
+    assert await get_chat_message_text(chat.user, ChatMessage.Role.ai) == ["Good afternoon, Mr. Amor."] * 2
+
+    # the Chat held between turns kept the running totals in step
+    await chat.arefresh_from_db()
+    history = [message.text async for message in chat.chatmessage_set.all()]
+    assert chat.history_token_count == sum(count_tokens(text) for text in history)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_shares_turns_with_other_sockets_on_the_chat(chat: Chat, mocked_connect: Connect):
+    # Given two tabs open on the chat
+    tabs = []
+    for _ in range(2):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+        communicator.scope["user"] = chat.user
+        communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+        connected, _ = await communicator.connect()
+        assert connected
+        tabs.append(communicator)
+    asking, watching = tabs
+
+    # When
+    with patch("redbox.RedboxState.get_llm", new=lambda _: mocked_connect):
+        await asking.send_json_to({"message": "Hello Hal."})
+        asked = [await asking.receive_json_from(timeout=5)]
+        while asked[-1]["type"] != "end":
+            asked.append(await asking.receive_json_from(timeout=5))
+        await asking.send_json_to({"type": "ping"})
+        assert (await asking.receive_json_from(timeout=5))["type"] == "pong"
+
+    watched = [await watching.receive_json_from(timeout=5) for _ in asked]
+
+    # Then
+    assert watched == asked
+    assert await watching.receive_nothing()
+    for communicator in tabs:
+        await communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_publishes_nothing_when_alone_on_the_chat(chat: Chat, mocked_connect: Connect):
+    # Given one tab open on the chat
+    communicator = await open_chat(chat)
+    channel_layer = get_channel_layer()
+
+    # When
+    with (
+        patch("redbox.RedboxState.get_llm", new=lambda _: mocked_connect),
+        patch.object(channel_layer, "group_send", wraps=channel_layer.group_send) as group_send,
+    ):
+        await ask(communicator, {"message": "Hello Hal."})
+        while (await communicator.receive_json_from(timeout=5))["type"] != "end":
+            pass
+        await communicator.send_json_to({"type": "ping"})
+        assert (await communicator.receive_json_from(timeout=5))["type"] == "pong"
+
+    # Then the answer was only written to the socket
+    assert [call.args[1]["type"] for call in group_send.await_args_list] == []
+    await communicator.disconnect()
+
+
+async def open_chat(chat: Chat) -> WebsocketCommunicator:
+    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+    communicator.scope["user"] = chat.user
+    communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+async def ask(communicator: WebsocketCommunicator, message: dict) -> str:
+    """send a question, returning the id of the stream its answer is sent on"""
+    await communicator.send_json_to(message)
+    response = await communicator.receive_json_from(timeout=5)
+    assert response["type"] == "stream"
+    return response["stream"]
+
+
+async def receive_message(communicator: WebsocketCommunicator) -> tuple[str, str | dict | None]:
+    response = await communicator.receive_json_from(timeout=5)
+    return response["type"], response["data"]
+
+
 @database_sync_to_async
 def get_chat_message_text(user: User, role: ChatMessage.Role) -> Sequence[str]:
     return [m.text for m in ChatMessage.objects.filter(chat__user=user, role=role)]
@@ -236,7 +422,7 @@ async def test_chat_consumer_with_connection_error(chat: Chat, mocked_breaking_c
         connected, _ = await communicator.connect()
         assert connected
 
-        await communicator.send_json_to({"message": "Hello Hal."})
+        await ask(communicator, {"message": "Hello Hal."})
         response_1 = await communicator.receive_json_from(timeout=5)
         response_2 = await communicator.receive_json_from(timeout=5)
 
@@ -245,6 +431,128 @@ async def test_chat_consumer_with_connection_error(chat: Chat, mocked_breaking_c
         assert response_1["data"] == "Loading"
         assert response_2["type"] == "error"
 
+        # Close
+        await communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_stop_saves_truncated_answer(chat: Chat, hanging_llm: "HangingLLM"):
+    with patch("redbox.RedboxState.get_llm", new=lambda _: hanging_llm):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+        communicator.scope["user"] = chat.user
+        communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+        connected, _ = await communicator.connect()
+        assert connected
+
+        await ask(communicator, {"message": "Hello Hal."})
+        assert await receive_message(communicator) == ("info", "Loading")
+        assert await receive_message(communicator) == ("text", "Good afternoon, ")
+
+        await communicator.send_json_to({"type": "stop"})
+        response = await communicator.receive_json_from(timeout=5)
+        assert response["type"] == "end"
+        assert response["data"]["truncated"]
+        # the socket stays open for the next turn
+        assert await communicator.receive_nothing()
+        await communicator.disconnect()
+
+    assert hanging_llm.closed == [True]
+    message = await ChatMessage.objects.aget(chat=chat, role=ChatMessage.Role.ai)
+    assert str(message.id) == response["data"]["message_id"]
+    assert message.text == "Good afternoon, "
+    assert message.truncated
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_disconnect_saves_truncated_answer(chat: Chat, hanging_llm: "HangingLLM"):
+    with patch("redbox.RedboxState.get_llm", new=lambda _: hanging_llm):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+        communicator.scope["user"] = chat.user
+        communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+        connected, _ = await communicator.connect()
+        assert connected
+
+        await ask(communicator, {"message": "Hello Hal."})
+        await communicator.receive_json_from(timeout=5)
+        await communicator.receive_json_from(timeout=5)
+
+        await communicator.disconnect()
+
+    assert hanging_llm.closed == [True]
+    assert await get_chat_message_text(chat.user, ChatMessage.Role.ai) == ["Good afternoon, "]
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_resumes_answer_after_reconnect(chat: Chat, hanging_llm: "HangingLLM", settings):
+    settings.STREAM_RESUME_SECONDS = 60
+    with patch("redbox.RedboxState.get_llm", new=lambda _: hanging_llm):
+        dropped = await open_chat(chat)
+        stream = await ask(dropped, {"message": "Hello Hal."})
+        await dropped.disconnect()
+
+        # When the browser reconnects, having been sent the first message of the stream
+        reconnected = await open_chat(chat)
+        await reconnected.send_json_to({"type": "resume", "stream": stream, "seq": 1})
+        assert await receive_message(reconnected) == ("info", "Loading")
+        assert await receive_message(reconnected) == ("text", "Good afternoon, ")
+        hanging_llm.released.set()
+        assert await receive_message(reconnected) == ("text", "Mr. Amor.")
+        response = await reconnected.receive_json_from(timeout=5)
+
+        # Then the answer was finished rather than abandoned, and is saved under its stream's id
+        assert response["type"] == "end"
+        assert "truncated" not in response["data"]
+        assert response["data"]["message_id"] == stream
+        message = await ChatMessage.objects.aget(chat=chat, role=ChatMessage.Role.ai)
+        assert message.text == "Good afternoon, Mr. Amor."
+        assert not message.truncated
+
+        # and once saved, it is resumed from its message
+        await reconnected.send_json_to({"type": "resume", "stream": stream, "seq": 2})
+        assert await receive_message(reconnected) == ("answer", "Good afternoon, Mr. Amor.")
+        assert (await reconnected.receive_json_from(timeout=5))["type"] == "end"
+        assert await reconnected.receive_nothing()
+        await reconnected.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_stops_answer_resumed_after_reconnect(chat: Chat, hanging_llm: "HangingLLM", settings):
+    settings.STREAM_RESUME_SECONDS = 60
+    with patch("redbox.RedboxState.get_llm", new=lambda _: hanging_llm):
+        dropped = await open_chat(chat)
+        stream = await ask(dropped, {"message": "Hello Hal."})
+        assert await receive_message(dropped) == ("info", "Loading")
+        assert await receive_message(dropped) == ("text", "Good afternoon, ")
+        await dropped.disconnect()
+
+        reconnected = await open_chat(chat)
+        await reconnected.send_json_to({"type": "resume", "stream": stream, "seq": 3})
+        assert await reconnected.receive_nothing()
+        await reconnected.send_json_to({"type": "stop"})
+        response = await reconnected.receive_json_from(timeout=5)
+        await reconnected.disconnect()
+
+    assert response["type"] == "end"
+    assert response["data"]["truncated"]
+    assert hanging_llm.closed == [True]
+    assert await get_chat_message_text(chat.user, ChatMessage.Role.ai) == ["Good afternoon, "]
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_chat_consumer_cannot_resume_an_unknown_answer(chat: Chat, settings):
+    settings.STREAM_RESUME_TIMEOUT_SECONDS = 0.1
+    communicator = await open_chat(chat)
+
+    await communicator.send_json_to({"type": "resume", "stream": str(uuid.uuid4()), "seq": 1})
+
+    assert await receive_message(communicator) == ("error", error_messages.ANSWER_LOST)
+    await communicator.disconnect()
+
 
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio()
@@ -264,7 +572,7 @@ async def test_chat_consumer_with_explicit_unhandled_error(
         connected, _ = await communicator.connect()
         assert connected
 
-        await communicator.send_json_to({"message": "Hello Hal."})
+        await ask(communicator, {"message": "Hello Hal."})
         response_1 = await communicator.receive_json_from(timeout=5)
         response_2 = await communicator.receive_json_from(timeout=5)
         response_3 = await communicator.receive_json_from(timeout=5)
@@ -273,14 +581,36 @@ async def test_chat_consumer_with_explicit_unhandled_error(
         assert response_1["type"] == "info"
         assert response_1["data"] == "Loading"
         assert response_2["type"] == "text"
-        assert response_2["data"] == "Good afternoon, "
-        assert response_3["type"] == "text"
-        assert response_3["data"] == error_messages.CORE_ERROR_MESSAGE
+        assert response_2["data"] == "Good afternoon, " + error_messages.CORE_ERROR_MESSAGE
+        assert response_3["type"] == "end"
 
         # Close
         await communicator.disconnect()
 
 
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+@pytest.mark.parametrize(
+    "failing",
+    [
+        patch("redbox_app.redbox_core.consumers.get_chat_session", side_effect=Chat.DoesNotExist),
+        patch("redbox_app.redbox_core.admission.AdmissionQueue.admit", side_effect=TimeoutError),
+    ],
+)
+async def test_chat_consumer_with_error_before_answering(chat: Chat, failing, mocked_connect: Connect):
+    communicator = await open_chat(chat)
+
+    with patch("redbox.RedboxState.get_llm", new=lambda _: mocked_connect):
+        with failing:
+            await ask(communicator, {"message": "Hello Hal."})
+            assert await receive_message(communicator) == ("error", error_messages.CORE_ERROR_MESSAGE)
+
+        # the socket answers the next question
+        await ask(communicator, {"message": "Hello again."})
+        assert [(await receive_message(communicator))[0] for _ in range(3)] == ["info", "text", "end"]
+    await communicator.disconnect()
+
+
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio()
 async def test_chat_consumer_with_rate_limited_error(chat: Chat, mocked_connect_with_rate_limited_error: Connect):
@@ -297,7 +627,7 @@ async def test_chat_consumer_with_rate_limited_error(chat: Chat, mocked_connect_
         connected, _ = await communicator.connect()
         assert connected
 
-        await communicator.send_json_to({"message": "Hello Hal."})
+        await ask(communicator, {"message": "Hello Hal."})
         response_1 = await communicator.receive_json_from(timeout=5)
         response_2 = await communicator.receive_json_from(timeout=5)
         response_3 = await communicator.receive_json_from(timeout=5)
@@ -306,9 +636,8 @@ async def test_chat_consumer_with_rate_limited_error(chat: Chat, mocked_connect_
         assert response_1["type"] == "info"
         assert response_1["data"] == "Loading"
         assert response_2["type"] == "text"
-        assert response_2["data"] == "Good afternoon, "
-        assert response_3["type"] == "text"
-        assert response_3["data"] == error_messages.RATE_LIMITED
+        assert response_2["data"] == "Good afternoon, " + error_messages.RATE_LIMITED
+        assert response_3["type"] == "end"
         # Close
         await communicator.disconnect()
 
@@ -331,7 +660,7 @@ async def test_chat_consumer_with_explicit_no_document_selected_error(
         connected, _ = await communicator.connect()
         assert connected
 
-        await communicator.send_json_to({"message": "Hello Hal."})
+        await ask(communicator, {"message": "Hello Hal."})
         response_1 = await communicator.receive_json_from(timeout=5)
         response_2 = await communicator.receive_json_from(timeout=5)
 
@@ -364,17 +693,21 @@ async def test_chat_consumer_redbox_state(
         connected, _ = await communicator.connect()
         assert connected
 
-        await communicator.send_json_to({"message": "Third question, with selected files?"})
+        await ask(communicator, {"message": "Third question, with selected files?"})
+        # disconnecting stops the answer, so wait for it to finish
+        while (await communicator.receive_json_from(timeout=5))["type"] not in {"end", "error"}:
+            pass
 
         # Close
         await communicator.disconnect()
 
-        chat_backend_dict = model_to_dict(llm_backend)
+        # the chat sets its own temperature
+        chat_backend_dict = {**model_to_dict(llm_backend), "temperature": chat_with_files.temperature}
 
         # Then
         expected_request = RedboxState(
             documents=[
-                Document(page_content=str(f.text), metadata={"uri": f.original_file.name}) for f in several_files
+                Document(page_content=f.text or "", metadata={"uri": f.original_file.name}) for f in several_files
             ],
             messages=[
                 HumanMessage(content="A question?"),
@@ -432,6 +765,34 @@ class CannedGraphLLM(BaseChatModel):
                     pass
 
 
+class HangingLLM(BaseChatModel):
+    """streams one chunk and then waits until it is released, to finish the answer, or closed"""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    closed: list[bool] = Field(default_factory=list)
+    released: asyncio.Event = Field(default_factory=asyncio.Event)
+
+    def _generate(self, *_args, **_kwargs):
+        raise NotImplementedError
+
+    def _llm_type(self):
+        return "hanging"
+
+    async def astream(self, *_args, **_kwargs):
+        try:
+            yield AIMessageChunk(content="Good afternoon, ")
+            await self.released.wait()
+            yield AIMessageChunk(content="Mr. Amor.")
+        finally:
+            self.closed.append(True)
+
+
+@pytest.fixture()
+def hanging_llm() -> HangingLLM:
+    return HangingLLM()
+
+
 @pytest.fixture()
 def mocked_connect() -> Connect:
     responses = [
@@ -543,30 +904,44 @@ def refresh_from_db(obj: Model) -> None:
 
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio()
-async def test_chat_consumer_with_context_window_error(large_file: File):
-    # Given large_file
+async def test_chat_consumer_with_map_reduce(large_file: File, settings):
+    # Given large_file, which is too large for any model, with retrieval off
+    settings.MESSAGE_THROTTLE_SECONDS_MIN = 60
+    settings.RETRIEVAL_TOKEN_BUDGET = 0
+
+    async def run_map_reduce(_state, response_tokens_callback, progress_callback, **_kwargs):
+        await progress_callback("Read 1 of 1 sections")
+        await response_tokens_callback("An answer.")
+        return AIMessage(content="An answer."), timedelta(seconds=1)
 
     # When
-    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
-    communicator.scope["user"] = large_file.chat.user
-    communicator.scope["url_route"] = {"kwargs": {"chat_id": large_file.chat.id}}
-    connected, _ = await communicator.connect()
-    assert connected
+    with patch("redbox_app.redbox_core.consumers.run_map_reduce", new=run_map_reduce):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+        communicator.scope["user"] = large_file.chat.user
+        communicator.scope["url_route"] = {"kwargs": {"chat_id": large_file.chat.id}}
+        connected, _ = await communicator.connect()
+        assert connected
 
-    await communicator.send_json_to({"message": "Hello Hal."})
-    response_1 = await communicator.receive_json_from(timeout=5)
+        await ask(communicator, {"message": "Hello Hal."})
+        responses = [await communicator.receive_json_from(timeout=5) for _ in range(4)]
 
     # Then
-    assert response_1["type"] == "error"
-    assert response_1["data"] == error_messages.FILES_TOO_LARGE
+    assert [(response["type"], response["data"]) for response in responses[:3]] == [
+        ("info", "Loading"),
+        ("info", "Read 1 of 1 sections"),
+        ("text", "An answer."),
+    ]
+    assert responses[3]["type"] == "end"
+    assert await get_chat_message_text(large_file.chat.user, ChatMessage.Role.ai) == ["An answer."]
     # Close
     await communicator.disconnect()
 
 
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio()
-async def test_chat_consumer_with_context_window_error_with_suggestion(large_file: File, big_llm_backend):
-    # Given large_file
+async def test_chat_consumer_with_context_window_error_with_suggestion(large_file: File, big_llm_backend, settings):
+    # Given large_file, with retrieval off
+    settings.RETRIEVAL_TOKEN_BUDGET = 0
 
     # When
     communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
@@ -575,7 +950,7 @@ async def test_chat_consumer_with_context_window_error_with_suggestion(large_fil
     connected, _ = await communicator.connect()
     assert connected
 
-    await communicator.send_json_to({"message": "Hello Hal."})
+    await ask(communicator, {"message": "Hello Hal."})
     response_1 = await communicator.receive_json_from(timeout=5)
 
     # Then
@@ -585,3 +960,54 @@ async def test_chat_consumer_with_context_window_error_with_suggestion(large_fil
 
     # Close
     await communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_file_status_consumer(chat: Chat, s3_client):  # noqa: ARG001
+    # Given
+    file = await File.objects.acreate(
+        chat=chat, status=File.Status.processing, original_file=SimpleUploadedFile("test.txt", b"Lorem Ipsum.")
+    )
+    communicator = WebsocketCommunicator(FileStatusConsumer.as_asgi(), f"/ws/chat/{chat.id}/files")
+    communicator.scope["user"] = chat.user
+    communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+    connected, _ = await communicator.connect()
+    assert connected
+
+    # When
+    snapshot = await communicator.receive_json_from(timeout=5)
+    await database_sync_to_async(file.ingest)()
+    queued = await communicator.receive_json_from(timeout=5)
+    await database_sync_to_async(ingest)(file.id, file.ingest_task_id)
+    running = await communicator.receive_json_from(timeout=5)
+    complete = await communicator.receive_json_from(timeout=5)
+
+    # Then
+    assert snapshot == {
+        "type": "file-status",
+        "data": {"id": str(file.id), "status": "Processing", "position_in_queue": -1, "tokens": None, "progress": None},
+    }
+    assert queued["data"]["status"] == "Processing"
+    assert queued["data"]["position_in_queue"] == 0
+    assert running["data"]["status"] == "Processing"
+    assert complete["data"] == {
+        "id": str(file.id),
+        "status": "Complete",
+        "position_in_queue": -1,
+        "tokens": count_tokens("Lorem Ipsum."),
+        "progress": None,
+    }
+
+    await communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio()
+async def test_file_status_consumer_rejects_other_users(chat: Chat, bob: User):
+    communicator = WebsocketCommunicator(FileStatusConsumer.as_asgi(), f"/ws/chat/{chat.id}/files")
+    communicator.scope["user"] = bob
+    communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+    connected, _ = await communicator.connect()
+    assert not connected
+    await communicator.disconnect()
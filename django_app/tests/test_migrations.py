@@ -1,7 +1,9 @@
+import zlib
 from decimal import Decimal
 
 import pytest
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django_q.signing import SignedPackage
 
 
 @pytest.mark.django_db()
@@ -462,3 +464,54 @@ def test_0092_remove_user_old_business_unit(migrator):
     assert new_cod_user.business_unit.business_unit == cod.business_unit
     assert new_other_user.business_unit.department == cod.department
     assert new_other_user.business_unit.business_unit == other.business_unit
+
+
+def test_0094_extracted_text_ingest_tasks_and_chat_totals(migrator):
+    old_state = migrator.apply_initial_migration(("redbox_core", "0093_chatmessage_time_to_first_token"))
+
+    User = old_state.apps.get_model("redbox_core", "User")
+    Chat = old_state.apps.get_model("redbox_core", "Chat")
+    ChatMessage = old_state.apps.get_model("redbox_core", "ChatMessage")
+    File = old_state.apps.get_model("redbox_core", "File")
+    ChatLLMBackend = old_state.apps.get_model("redbox_core", "ChatLLMBackend")
+    OrmQ = old_state.apps.get_model("django_q", "OrmQ")
+
+    user = User.objects.create(email="someone@example.com")
+    chat_backend, _ = ChatLLMBackend.objects.get_or_create(name="gpt-4o", provider="azure_openai")
+    chat = Chat.objects.create(user=user, name="a chat", chat_backend=chat_backend)
+    empty_chat = Chat.objects.create(user=user, name="an empty chat", chat_backend=chat_backend)
+    queued = OrmQ.objects.create(key="redbox", payload=SignedPackage.dumps({"id": "a-queued-task"}))
+    files = {
+        name: File.objects.create(
+            chat=chat, original_file=SimpleUploadedFile(f"{name}.txt", b"Lorem Ipsum."), status=status, **fields
+        )
+        for name, status, fields in [
+            ("complete", "complete", {"text": "some text", "token_count": 100}),
+            ("queued", "processing", {"task": queued}),
+            ("errored", "errored", {"token_count": 20}),
+        ]
+    }
+    ChatMessage.objects.create(chat=chat, text="a question", role="user", token_count=124)
+    ChatMessage.objects.create(chat=chat, text="an answer", role="ai", token_count=3)
+
+    new_state = migrator.apply_tested_migration(("redbox_core", "0094_extracted_text_ingest_tasks_and_chat_totals"))
+
+    NewFile = new_state.apps.get_model("redbox_core", "File")  # noqa: N806
+    NewChat = new_state.apps.get_model("redbox_core", "Chat")  # noqa: N806
+    new_files = {name: NewFile.objects.get(id=file.id) for name, file in files.items()}
+    complete = new_files["complete"].extracted_text
+    assert zlib.decompress(complete.compressed_text).decode() == "some text"
+    assert complete.token_count == 100
+    assert complete.content_hash is None
+    assert new_files["queued"].extracted_text is None
+    assert new_files["queued"].ingest_task.task_id == "a-queued-task"
+    assert new_files["queued"].ingest_task.state == "queued"
+    assert new_files["errored"].ingest_task is None
+
+    new_chat = NewChat.objects.get(id=chat.id)
+    assert (new_chat.file_token_count, new_chat.history_token_count, new_chat.summary_token_count) == (120, 127, 0)
+    new_empty_chat = NewChat.objects.get(id=empty_chat.id)
+    assert (new_empty_chat.file_token_count, new_empty_chat.history_token_count) == (0, 0)
+
+    # Cleanup:
+    migrator.reset()
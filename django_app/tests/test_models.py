@@ -1,13 +1,28 @@
 from datetime import UTC, datetime, timedelta
+from unittest.mock import patch
 
 import pytest
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
 from freezegun import freeze_time
-from pytz import utc
+from langchain_core.messages import AIMessage
 
+from redbox import LexicalIndex, count_tokens
 from redbox_app.redbox_core.models import (
+    Chat,
     ChatMessage,
+    ExtractedText,
     File,
+    IngestTask,
+    RateLimitBucket,
+    get_chat_session,
+)
+from redbox_app.redbox_core.rate_limit import (
+    DatabaseTokenBucket,
+    MemoryTokenBucket,
+    TokenBucket,
+    get_rate_limiter,
+    tokens_used,
 )
 
 
@@ -40,22 +55,301 @@ def test_chat_message_model_token_count_on_save(chat):
 
 
 @pytest.mark.django_db()
-@pytest.mark.parametrize(("role", "expected_count"), [(ChatMessage.Role.ai, 0), (ChatMessage.Role.user, 100)])
-def test_associated_file_token_count(chat, original_file, role, expected_count):
-    now = datetime.now(tz=utc)
+def test_chat_to_langchain_retrieval_mode(chat, original_file, settings):
+    settings.RETRIEVAL_CONTEXT_RESERVE_TOKENS = chat.context_window_size() - 100
+    settings.RETRIEVAL_TOKEN_BUDGET = 50
+    text = "\n\n".join(["cats and dogs " * 30, "the spending review " * 30, "lorem ipsum " * 30])
+    File.objects.create(
+        original_file=original_file,
+        chat=chat,
+        status=File.Status.complete,
+        token_count=count_tokens(text),
+        extracted_text=ExtractedText.objects.create(
+            text=text,
+            token_count=count_tokens(text),
+            lexical_index=LexicalIndex.from_text(text, chunk_size=32).model_dump(),
+        ),
+    )
+    ChatMessage.objects.create(chat=chat, role=ChatMessage.Role.user, text="what about the spending review?")
+
+    state = chat.to_langchain()
+
+    assert state.documents
+    assert sum(count_tokens(document.page_content) for document in state.documents) <= 50
+    assert "spending review" in state.documents[0].page_content
+
+
+@pytest.mark.django_db()
+def test_chat_to_langchain_full_document_mode(chat, original_file):
+    File.objects.create(
+        original_file=original_file,
+        chat=chat,
+        status=File.Status.complete,
+        token_count=3,
+        extracted_text=ExtractedText.objects.create(text="a small file", token_count=3),
+    )
+    ChatMessage.objects.create(chat=chat, role=ChatMessage.Role.user, text="hello")
+
+    state = chat.to_langchain()
+
+    assert [document.page_content for document in state.documents] == ["a small file"]
+
+
+@pytest.mark.django_db()
+def test_chat_to_langchain_uses_the_chat_temperature(chat):
+    chat.temperature = 0.7
+    chat.save()
+
+    assert chat.to_langchain().chat_backend.temperature == 0.7
+
+
+@pytest.mark.django_db()
+def test_chat_to_langchain_sends_a_large_document_in_full_if_it_fits(chat, original_file):
+    text = "\n\n".join(["cats and dogs " * 30, "the spending review " * 30, "lorem ipsum " * 30])
+    File.objects.create(
+        original_file=original_file,
+        chat=chat,
+        status=File.Status.complete,
+        # larger than any threshold of its own, but well within the 128k window
+        token_count=64_000,
+        extracted_text=ExtractedText.objects.create(
+            text=text,
+            token_count=64_000,
+            lexical_index=LexicalIndex.from_text(text, chunk_size=32).model_dump(),
+        ),
+    )
+    ChatMessage.objects.create(chat=chat, role=ChatMessage.Role.user, text="what about the spending review?")
+
+    state = chat.to_langchain()
+
+    assert [document.page_content for document in state.documents] == [text]
+
+
+@pytest.mark.django_db()
+def test_chat_larger_than_its_window_is_answered_from_retrieved_chunks(chat, original_file, settings):
+    settings.RETRIEVAL_TOKEN_BUDGET = 50
+    text = "\n\n".join(["cats and dogs " * 30, "the spending review " * 30, "lorem ipsum " * 30])
+    File.objects.create(
+        original_file=original_file,
+        chat=chat,
+        status=File.Status.complete,
+        # larger than the context window of every model
+        token_count=150_000,
+        extracted_text=ExtractedText.objects.create(
+            text=text,
+            token_count=150_000,
+            lexical_index=LexicalIndex.from_text(text, chunk_size=32).model_dump(),
+        ),
+    )
+
+    chat, _, reserved = get_chat_session(
+        chat.user, chat.id, {"message": "what about the spending review?"}, reserve=False
+    )
+
+    assert chat.token_count() > chat.context_window_size()
+    assert reserved == chat.prompt_token_count() < chat.context_window_size()
+    assert not chat.needs_map_reduce()
+    state = chat.to_langchain()
+    assert sum(count_tokens(document.page_content) for document in state.documents) <= 50
+    assert "spending review" in state.documents[0].page_content
+
+
+@pytest.mark.django_db(transaction=True)
+def test_chat_compaction(chat, settings):
+    settings.COMPACTION_THRESHOLD = 100 / chat.context_window_size()
+    settings.COMPACTION_KEEP_MESSAGES = 2
+    for i in range(6):
+        role = ChatMessage.Role.user if i % 2 == 0 else ChatMessage.Role.ai
+        ChatMessage.objects.create(chat=chat, role=role, text=f"message {i} " + "lorem ipsum " * 20)
+
+    with patch("redbox_app.worker.summarise_messages", return_value="a summary") as summarise_messages:
+        chat.compact(sync=True)
+
+    folded = summarise_messages.call_args.args[0]
+    assert [message.content.split(" lorem")[0] for message in folded] == [f"message {i}" for i in range(4)]
+    chat.refresh_from_db()
+    assert chat.summary == "a summary"
+
+    state = chat.to_langchain()
+    assert state.summary == "a summary"
+    assert [message.content.split(" lorem")[0] for message in state.messages] == ["message 4", "message 5"]
+    assert "a summary" in state.get_messages()[0].content
+    assert chat.summary_token_count == count_tokens("a summary")
+    assert chat.history_token_count == sum(count_tokens(message.text) for message in chat.uncompacted_messages())
+
+
+@pytest.mark.django_db()
+def test_chat_token_totals(chat, original_file, s3_client):  # noqa: ARG001
+    file = File.objects.create(original_file=original_file, chat=chat, token_count=100)
+    ChatMessage.objects.create(chat=chat, role=ChatMessage.Role.user, text="I am a message")
+    stale_chat = Chat.objects.get(id=chat.id)
+
+    file.token_count = 150
+    file.save(update_fields=["token_count"])
+    stale_chat.name = "renamed"
+    stale_chat.save()
+
+    chat.refresh_from_db()
+    assert chat.name == "renamed"
+    assert chat.file_token_count == 150
+    assert chat.history_token_count == count_tokens("I am a message")
+    assert chat.token_count() == 150 + count_tokens("I am a message")
+
+    File.objects.get(id=file.id).delete()
+    chat.refresh_from_db()
+    assert chat.file_token_count == 0
+
+
+@pytest.mark.django_db()
+def test_chat_token_totals_after_deletes(chat, original_file, s3_client):  # noqa: ARG001
+    File.objects.create(original_file=original_file, chat=chat, token_count=100)
+    File.objects.create(original_file=original_file, chat=chat, token_count=200)
+    message = ChatMessage.objects.create(chat=chat, role=ChatMessage.Role.user, text="I am a message")
+    ChatMessage.objects.create(chat=chat, role=ChatMessage.Role.ai, text="I am an answer")
+
+    File.objects.filter(chat=chat, token_count=100).delete()
+    ChatMessage.objects.get(id=message.id).delete()
+    chat.refresh_from_db()
+    assert chat.file_token_count == 200
+    assert chat.history_token_count == count_tokens("I am an answer")
+
+    ChatMessage.objects.filter(chat=chat).delete()
+    chat.refresh_from_db()
+    assert chat.history_token_count == 0
+
+
+@pytest.mark.django_db()
+def test_rating_a_message_does_not_count_tokens(chat_message, django_assert_num_queries):
+    message = ChatMessage.objects.get(id=chat_message.id)
+    message.rating = 5
+
+    with patch("redbox_app.redbox_core.models.tokeniser") as tokeniser, django_assert_num_queries(1):
+        message.save()
+
+    tokeniser.encode.assert_not_called()
+    message.refresh_from_db()
+    assert message.rating == 5
+    assert message.token_count == chat_message.token_count
+
+
+@pytest.mark.django_db()
+def test_chat_compaction_below_threshold(chat_with_message):
+    with patch("redbox_app.redbox_core.models.async_task") as async_task:
+        chat_with_message.compact()
+
+    async_task.assert_not_called()
+    assert chat_with_message.to_langchain().summary is None
+
+
+@pytest.mark.django_db()
+def test_file_position_in_queue(chat, s3_client, settings):  # noqa: ARG001
+    files = [
+        File.objects.create(
+            chat=chat, status=File.Status.processing, original_file=SimpleUploadedFile(f"{i}.txt", b"Lorem Ipsum.")
+        )
+        for i in range(3)
+    ]
+    assert files[0].position_in_queue() == -1
+    # a task lost by django-q long ago, which is not counted as waiting ahead of any
+    lost = IngestTask.objects.create()
+    IngestTask.objects.filter(id=lost.id).update(
+        enqueued_at=timezone.now() - timedelta(seconds=settings.Q_CLUSTER["timeout"] + 1)
+    )
+
+    for file in files:
+        file.ingest()
+        # and tasks that have finished in between, which are not counted either
+        IngestTask.objects.create(state=IngestTask.State.complete)
+    assert [file.position_in_queue() for file in files] == [0, 1, 2]
+    assert IngestTask.first_queued() == files[0].ingest_task_id
+    assert all(file.ingest_task.task_id for file in files)
+
+    IngestTask.mark(files[0].ingest_task_id, IngestTask.State.running)
+    IngestTask.mark(files[1].ingest_task_id, IngestTask.State.running)
+    for file in files:
+        file.ingest_task.refresh_from_db()
+    assert [file.position_in_queue() for file in files] == [0, 0, 0]
+
+    IngestTask.mark(files[0].ingest_task_id, IngestTask.State.complete)
+    files[0].ingest_task.refresh_from_db()
+    assert files[0].position_in_queue() == -1
+
+
+@pytest.mark.django_db()
+def test_extracted_text_is_compressed():
+    text = "the spending review " * 1000
+
+    extracted_text = ExtractedText.objects.create(text=text, token_count=count_tokens(text))
+
+    extracted_text.refresh_from_db()
+    assert extracted_text.text == text
+    assert len(extracted_text.compressed_text) < len(text) / 10
+    assert ExtractedText().text == ""
+
+
+@pytest.mark.django_db()
+def test_listing_files_does_not_load_text(chat, original_file, django_assert_num_queries):
+    File.objects.create(
+        original_file=original_file,
+        chat=chat,
+        status=File.Status.complete,
+        token_count=3,
+        extracted_text=ExtractedText.objects.create(text="a small file", token_count=3),
+    )
+
+    with django_assert_num_queries(1) as captured:
+        completed_files, _ = File.get_completed_and_processing_files(chat.id)
+        assert [file.token_count for file in completed_files] == [3]
+    assert "compressed_text" not in captured.captured_queries[0]["sql"]
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("token_bucket", [MemoryTokenBucket, DatabaseTokenBucket])
+def test_token_bucket(chat, token_bucket):
+    chat_backend = chat.chat_backend
+    chat_backend.rate_limit = 600  # 10 tokens a second
+    bucket = token_bucket()
+
+    with freeze_time("2025-01-01 12:00:00") as frozen_time:
+        assert bucket.reserve(chat_backend, 500) == 0
+        assert bucket.reserve(chat_backend, 200) == pytest.approx(10)
+
+        bucket.refund(chat_backend, 100)
+        assert bucket.reserve(chat_backend, 0) == 0
+
+        frozen_time.tick(timedelta(seconds=5))
+        assert bucket.reserve(chat_backend, 100) == pytest.approx(5)
+
+        frozen_time.tick(timedelta(minutes=10))
+        assert bucket.reserve(chat_backend, 700) == pytest.approx(10)
+
+
+def test_token_bucket_is_abstract():
+    with pytest.raises(TypeError):
+        TokenBucket()
+
+
+@pytest.mark.django_db()
+def test_get_chat_session_reserves_tokens(chat):
+    chat_backend = chat.chat_backend
+
+    with freeze_time("2025-01-01 12:00:00"):
+        get_rate_limiter().reserve(chat_backend, chat_backend.rate_limit)
+
+        chat, delay, reserved = get_chat_session(chat.user, chat.id, {"message": "what is the spending review?"})
 
-    # Given a chat message...
-    with freeze_time(now):
-        chat_message = ChatMessage.objects.create(chat=chat, role=role, text="I am a message")
+        assert reserved == chat.prompt_token_count() > 0  # the files and every message, including this one
+        assert delay == pytest.approx(reserved * 60 / chat_backend.rate_limit)
 
-    # and a file created before it...
-    with freeze_time(now - timedelta(seconds=1)):
-        File.objects.create(original_file=original_file, chat=chat, token_count=100)
+        get_rate_limiter().refund(chat_backend, reserved)
+        assert RateLimitBucket.objects.get(chat_backend=chat_backend).level == 0
 
-    # and a file created after it...
-    with freeze_time(now + timedelta(seconds=1)):
-        File.objects.create(original_file=original_file, chat=chat, token_count=200)
 
-    # when i call associated_file_token_count
-    # I expect to see the token count for the file created before it in the count
-    assert chat_message.associated_file_token_count == expected_count
+def test_tokens_used():
+    usage = {"input_tokens": 10, "output_tokens": 2, "total_tokens": 12}
+    assert tokens_used(AIMessage("hello", usage_metadata=usage), prompt_tokens=100) == 12
+    assert tokens_used(AIMessage("hello"), prompt_tokens=100) == 100 + count_tokens("hello")
+    assert tokens_used(AIMessage("hello", response_metadata={"cache_hit": True}), prompt_tokens=100) == 0
+    # a map-reduce answer served from the cache still made calls for its notes
+    cached = AIMessage("hello", usage_metadata=usage, response_metadata={"cache_hit": True})
+    assert tokens_used(cached, prompt_tokens=100) == 12
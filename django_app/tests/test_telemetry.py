@@ -0,0 +1,155 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from elastic_transport import ConnectionError as ElasticConnectionError
+
+from redbox_app.redbox_core.models import ChatMessage
+from redbox_app.redbox_core.telemetry import TelemetryQueue
+
+
+class FakeElastic:
+    def __init__(self):
+        self.requests: list[list[dict]] = []
+        self.down = False
+        # the status each document id is rejected with, once
+        self.rejects: dict[str, int] = {}
+
+    def bulk(self, operations):
+        if self.down:
+            msg = "elastic is down"
+            raise ElasticConnectionError(msg)
+        ids = [action["index"]["_id"] for action in operations[::2]]
+        rejected = {document_id: self.rejects.pop(document_id) for document_id in ids if document_id in self.rejects}
+        self.requests.append(
+            [
+                operation
+                for action, document in zip(operations[::2], operations[1::2], strict=True)
+                if action["index"]["_id"] not in rejected
+                for operation in (action, document)
+            ]
+        )
+        items = [
+            {"index": {"_id": document_id, "status": status, "error": {"type": "rejected"}}}
+            for document_id, status in rejected.items()
+        ]
+        return {"errors": bool(items), "items": items}
+
+    def documents(self) -> dict[str, dict]:
+        return {
+            action["index"]["_id"]: document
+            for operations in self.requests
+            for action, document in zip(operations[::2], operations[1::2], strict=True)
+        }
+
+
+@pytest.fixture()
+def elastic(settings, tmp_path):
+    settings.ELASTIC_CLIENT = FakeElastic()
+    settings.ELASTIC_CHAT_MESSAGE_INDEX = "chat-messages"
+    settings.TELEMETRY_FLUSH_INTERVAL_SECONDS = 60
+    settings.TELEMETRY_SPILL_PATH = str(tmp_path / "telemetry.jsonl")
+    return settings.ELASTIC_CLIENT
+
+
+@pytest.fixture()
+def telemetry(elastic):  # noqa: ARG001
+    telemetry = TelemetryQueue()
+    yield telemetry
+    telemetry.stop()
+
+
+def test_telemetry_coalesces_updates(elastic, telemetry):
+    telemetry.put("a", {"rating": None})
+    telemetry.put("b", {"rating": None})
+    telemetry.put("a", {"rating": 5})
+    assert elastic.requests == []
+
+    telemetry.flush()
+
+    assert len(elastic.requests) == 1
+    assert elastic.documents() == {"a": {"rating": 5}, "b": {"rating": None}}
+
+
+def test_telemetry_sends_in_batches(elastic, telemetry, settings):
+    settings.TELEMETRY_BATCH_SIZE = 2
+    for i in range(5):
+        telemetry.put(str(i), {"n": i})
+
+    telemetry.stop()
+
+    assert [len(operations) // 2 for operations in elastic.requests] == [2, 2, 1]
+
+
+def test_telemetry_drops_when_full(elastic, telemetry, settings):
+    settings.TELEMETRY_QUEUE_SIZE = 2
+    for i in range(3):
+        telemetry.put(str(i), {"n": i})
+    telemetry.put("0", {"n": 10})
+
+    telemetry.flush()
+
+    assert elastic.documents() == {"0": {"n": 10}, "1": {"n": 1}}
+    assert telemetry.dropped == 1
+
+
+def test_telemetry_spills_while_elastic_is_down(elastic, telemetry, settings):
+    elastic.down = True
+    telemetry.put("a", {"rating": None})
+    telemetry.flush()
+    telemetry.put("a", {"rating": 5})
+    telemetry.put("b", {"rating": 1})
+    telemetry.flush()
+    assert elastic.requests == []
+
+    elastic.down = False
+    telemetry.put("c", {"rating": 2})
+    telemetry.flush()
+
+    assert elastic.documents() == {"a": {"rating": 5}, "b": {"rating": 1}, "c": {"rating": 2}}
+    assert list(Path(settings.TELEMETRY_SPILL_PATH).parent.iterdir()) == []
+
+
+def test_telemetry_replay_skips_lines_cut_short(elastic, telemetry, settings):
+    spill = Path(settings.TELEMETRY_SPILL_PATH)
+    # a replay left by a process that stopped part way, and a spill whose last write was cut short
+    spill.with_name(f"{spill.name}.replay").write_text('{"id": "a", "document": {"rating": 1}}\n')
+    spill.write_text('{"id": "b", "document": {"rating": 2}}\n{"id": "c", "docu')
+
+    telemetry.put("d", {"rating": 3})
+    telemetry.flush()
+    telemetry.put("e", {"rating": 4})
+    telemetry.flush()
+
+    assert elastic.documents() == {"a": {"rating": 1}, "b": {"rating": 2}, "d": {"rating": 3}, "e": {"rating": 4}}
+    assert list(spill.parent.iterdir()) == []
+
+
+def test_telemetry_sends_documents_rejected_while_overloaded_again(elastic, telemetry):
+    elastic.rejects = {"a": 429, "b": 400}
+    telemetry.put("a", {"rating": 1})
+    telemetry.put("b", {"rating": 2})
+    telemetry.flush()
+    assert elastic.documents() == {}
+
+    telemetry.put("c", {"rating": 3})
+    telemetry.flush()
+
+    assert elastic.documents() == {"a": {"rating": 1}, "c": {"rating": 3}}
+
+
+@pytest.mark.django_db()
+def test_saving_chat_does_not_wait_for_elastic(chat_with_message, elastic, telemetry, django_assert_max_num_queries):
+    with patch("redbox_app.redbox_core.models.chat_message_telemetry", telemetry):
+        ChatMessage.objects.create(chat=chat_with_message, text="tomorrow", role=ChatMessage.Role.ai)
+
+        with django_assert_max_num_queries(4):
+            chat_with_message.name = "a new name"
+            chat_with_message.save()
+    assert elastic.requests == []
+
+    telemetry.flush()
+
+    documents = elastic.documents()
+    assert set(documents) == {str(message.id) for message in chat_with_message.chatmessage_set.all()}
+    assert {document["user_id"] for document in documents.values()} == {str(chat_with_message.user.id)}
@@ -0,0 +1,173 @@
+import resource
+from datetime import timedelta
+from unittest.mock import patch
+
+import pdfminer.high_level
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
+
+from redbox import count_tokens
+from redbox_app.extraction import memory_limit
+from redbox_app.redbox_core.models import ExtractedText, ExtractedTextBatch, File, IngestTask
+from redbox_app.redbox_core.utils import sanitise_string
+from redbox_app.worker import INGEST_VERSION, extract_text, ingest, peak_rss, reset_peak_rss, spool
+
+
+@pytest.mark.django_db()
+def test_ingest(uploaded_file: File, settings):
+    settings.INGEST_SPOOL_CHUNK_SIZE = 4
+
+    ingest(uploaded_file.id)
+
+    uploaded_file.refresh_from_db()
+    assert uploaded_file.status == File.Status.complete
+    assert uploaded_file.text == "Lorem Ipsum."
+    assert uploaded_file.token_count == count_tokens("Lorem Ipsum.")
+
+
+def test_memory_limit():
+    with pytest.raises(MemoryError), memory_limit(64 * 1024 * 1024):
+        bytearray(256 * 1024 * 1024)
+
+    # the limit no longer applies once the block exits
+    assert len(bytearray(256 * 1024 * 1024)) == 256 * 1024 * 1024
+
+
+@pytest.mark.django_db()
+def test_ingest_limits_the_memory_of_extraction_only(chat, s3_client, settings):  # noqa: ARG001
+    file = File.objects.create(
+        chat=chat,
+        status=File.Status.processing,
+        original_file=SimpleUploadedFile("big.txt", b"Lorem Ipsum. " * 1_500_000),
+    )
+    settings.INGEST_MEMORY_LIMIT_MB = 0
+    limits = resource.getrlimit(resource.RLIMIT_AS)
+
+    ingest(file.id)
+
+    file.refresh_from_db()
+    assert file.status == File.Status.errored
+    assert "ran out of memory" in file.ingest_error
+    # the limit was set in the process extracting the text, not in the worker
+    assert resource.getrlimit(resource.RLIMIT_AS) == limits
+
+
+def test_peak_rss():
+    reset_peak_rss()
+    buffer = bytearray(64 * 1024 * 1024)
+    buffer[::4096] = b"x" * len(buffer[::4096])
+
+    assert peak_rss() >= 64 * 1024 * 1024
+
+
+@pytest.mark.django_db()
+def test_ingest_reuses_text_extracted_from_identical_file(chat, s3_client, settings):  # noqa: ARG001
+    files = [
+        File.objects.create(chat=chat, status=File.Status.processing, original_file=SimpleUploadedFile(name, content))
+        for name, content in [("a.txt", b"Lorem Ipsum."), ("b.txt", b"Lorem Ipsum."), ("c.txt", b"Dolor.")]
+    ]
+    assert files[0].content_hash == files[1].content_hash != files[2].content_hash
+
+    with patch("redbox_app.worker.extract_text", wraps=extract_text) as extract:
+        for file in files:
+            ingest(file.id)
+
+    assert extract.call_count == 2
+    for file in files:
+        file.refresh_from_db()
+    assert [file.text for file in files] == ["Lorem Ipsum.", "Lorem Ipsum.", "Dolor."]
+    assert files[0].extracted_text == files[1].extracted_text != files[2].extracted_text
+    assert files[0].extracted_text.reference_count == 2
+
+    files[0].delete()
+    assert ExtractedText.delete_unreferenced() == 0
+    files[1].delete()
+    # text only just unreferenced may be about to be given to a file by an ingest still running
+    assert ExtractedText.delete_unreferenced() == 0
+    ExtractedText.objects.update(modified_at=timezone.now() - timedelta(seconds=settings.Q_CLUSTER["timeout"] + 1))
+    assert ExtractedText.delete_unreferenced() == 1
+    assert ExtractedText.objects.get() == files[2].extracted_text
+
+
+@pytest.mark.django_db()
+def test_ingest_pdf_in_page_batches(pdf_file: File, settings):
+    settings.INGEST_PAGE_BATCH_SIZE = 4
+
+    ingest(pdf_file.id)
+
+    pdf_file.refresh_from_db()
+    with spool(pdf_file.original_file, settings.INGEST_SPOOL_CHUNK_SIZE) as path:
+        expected = sanitise_string(pdfminer.high_level.extract_text(path))
+    assert pdf_file.status == File.Status.complete
+    assert (pdf_file.pages_extracted, pdf_file.pages_total, pdf_file.progress) == (6, 6, 100)
+    assert pdf_file.text == expected
+    assert pdf_file.token_count == count_tokens(expected)
+
+
+@pytest.mark.django_db()
+def test_ingest_pdf_resumes_from_checkpoint(pdf_file: File, settings):
+    settings.INGEST_PAGE_BATCH_SIZE = 2
+    settings.INGEST_TIME_BUDGET_SECONDS = 0
+    pdf_file.ingest()
+
+    progress = []
+    while pdf_file.status == File.Status.processing:
+        ingest(pdf_file.id, pdf_file.ingest_task_id)
+        pdf_file.refresh_from_db()
+        progress.append((pdf_file.progress, len(pdf_file.text)))
+        if pdf_file.extracting_text_id:
+            # each batch is saved as a row of its own, rather than the text so far being compressed again
+            assert pdf_file.extracting_text.batches.count() == len(progress)
+            assert not pdf_file.extracting_text.compressed_text
+
+    # each task hands over to a new one after a batch, with the text so far there for chats to use
+    assert [percent for percent, _ in progress] == [33, 66, 100]
+    assert 0 < progress[0][1] < progress[1][1] < progress[2][1]
+    assert pdf_file.status == File.Status.complete
+    # once complete, the text is compressed as a whole and its batches are gone
+    assert pdf_file.extracted_text.compressed_text
+    assert not ExtractedTextBatch.objects.exists()
+    assert list(IngestTask.objects.values_list("state", flat=True)) == [IngestTask.State.complete] * 3
+
+
+@pytest.mark.django_db()
+def test_reingest_pdf_keeps_the_old_text_until_the_new_is_complete(pdf_file: File, settings):
+    ingest(pdf_file.id)
+    pdf_file.refresh_from_db()
+    text, token_count = pdf_file.text, pdf_file.token_count
+    # as if it had been extracted by an older version of ingest
+    ExtractedText.objects.update(ingest_version=0)
+
+    settings.INGEST_PAGE_BATCH_SIZE = 2
+    settings.INGEST_TIME_BUDGET_SECONDS = 0
+    pdf_file.ingest()
+    pdf_file.refresh_from_db()
+    ingest(pdf_file.id, pdf_file.ingest_task_id)
+
+    pdf_file.refresh_from_db()
+    assert pdf_file.progress == 33
+    assert (pdf_file.status, pdf_file.text, pdf_file.token_count) == (File.Status.complete, text, token_count)
+    assert pdf_file.extracting_text_id != pdf_file.extracted_text_id
+
+    while pdf_file.extracting_text_id:
+        ingest(pdf_file.id, pdf_file.ingest_task_id)
+        pdf_file.refresh_from_db()
+
+    assert (pdf_file.status, pdf_file.text, pdf_file.ingest_version) == (File.Status.complete, text, INGEST_VERSION)
+    assert ExtractedText.objects.get() == pdf_file.extracted_text
+
+
+@pytest.mark.django_db()
+def test_failed_reingest_keeps_the_old_text(uploaded_file: File):
+    ingest(uploaded_file.id)
+    ExtractedText.objects.update(ingest_version=0)
+
+    task = IngestTask.objects.create()
+    with patch("redbox_app.worker.extract_text", side_effect=ValueError("corrupt")):
+        ingest(uploaded_file.id, task.id)
+
+    uploaded_file.refresh_from_db()
+    task.refresh_from_db()
+    assert (uploaded_file.status, uploaded_file.text) == (File.Status.complete, "Lorem Ipsum.")
+    assert task.state == IngestTask.State.errored
@@ -0,0 +1,46 @@
+"""Microbenchmark for RedboxState.get_messages
+
+usage: python benchmarks/get_messages.py --documents 1 10 50 --tokens 1000 100000
+"""
+
+import argparse
+import timeit
+
+from langchain_core.documents import Document
+from langchain_core.messages import HumanMessage
+from langchain_core.prompts import PromptTemplate
+
+from redbox import RedboxState, Settings
+
+
+def uncached_get_messages(state: RedboxState):
+    """how get_messages used to build the prompt, for comparison"""
+    return (
+        PromptTemplate.from_template(Settings().system_prompt_template, template_format="jinja2")
+        .invoke(input=state.model_dump())
+        .to_messages()
+    ) + state.messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'documents':>10} {'tokens':>10} {'uncached ms':>12} {'cached ms':>12}")  # noqa: T201
+    for n in args.documents:
+        for m in args.tokens:
+            # "lorem " is a single cl100k token
+            documents = [Document("lorem " * m, metadata={"uri": f"user@example.com/{i}.txt"}) for i in range(n)]
+            state = RedboxState(documents=documents, messages=[HumanMessage(content="summarise these documents")])
+            state.get_messages()  # warm the template cache
+
+            uncached = min(timeit.repeat(lambda: uncached_get_messages(state), number=1, repeat=args.repeat))  # noqa: B023
+            cached = min(timeit.repeat(state.get_messages, number=1, repeat=args.repeat))
+            print(f"{n:>10} {m:>10} {uncached * 1000:>12.2f} {cached * 1000:>12.2f}")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,29 @@
+import asyncio
+import atexit
+import contextlib
+import hashlib
+import json
+import math
 import os
+import re
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from collections.abc import Iterator, Sequence
 from functools import cache
 
 import boto3
 import datetime
+import httpx
 import tiktoken
 from _datetime import timedelta
+from jinja2 import Template
+from jinja2.sandbox import SandboxedEnvironment
 from langchain_core.documents import Document
-from langchain_core.messages import AIMessage, AnyMessage, BaseMessage
-from langchain_core.prompts import PromptTemplate
+from langchain_core.messages import AIMessage, AnyMessage, BaseMessage, HumanMessage
+from langchain_core.messages.ai import UsageMetadata, add_usage
+from langchain_core.prompt_values import StringPromptValue
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -18,6 +34,8 @@ class ChatLLMBackend(BaseModel):
     provider: str = "azure_openai"
     description: str | None = None
     context_window_size: int = 128_000
+    max_connections: int = 20
+    temperature: float | None = None
     model_config = {"frozen": True}
 
 
@@ -48,6 +66,44 @@ Title: {{d.metadata.get("uri", "unknown document")}}
 
 {% endfor %}
 {% endif %}
+{% if summary %}
+The earlier part of this conversation has been summarised as follows, the most recent messages come after it:
+{{summary}}
+{% endif %}
+"""
+
+    summary_prompt_template: str = """You are maintaining a running summary of a conversation between a civil servant
+and Redbox, an AI assistant, so that it can continue once the earlier messages are dropped.
+
+Update the summary with the new messages below. Keep every fact, figure, decision, instruction and open question
+that may matter later in the conversation, and drop pleasantries and repetition. Write in British English and
+reply with the updated summary only.
+
+{% if summary %}
+Summary so far:
+{{summary}}
+{% endif %}
+
+New messages:
+{% for m in messages %}
+{{m.type}}: {{m.content}}
+{% endfor %}
+"""
+
+    map_prompt_template: str = """You are Redbox, an AI assistant to civil servants in the United Kingdom.
+
+The document below is one section of a larger set of documents that is too long to read in one go. Make notes
+on everything in this section that bears on the question that follows it, quoting figures, names and key
+passages exactly. If nothing in it is relevant reply with "Nothing relevant." and nothing else.
+
+Title: {{document.metadata.get("uri", "unknown document")}}
+{{document.page_content}}
+{% if summary %}
+Summary of the conversation so far:
+{{summary}}
+{% endif %}
+Question:
+{{question}}
 """
 
     model_config = SettingsConfigDict(env_file=".env", env_nested_delimiter="__", extra="allow", frozen=True)
@@ -73,56 +129,602 @@ Title: {{d.metadata.get("uri", "unknown document")}}
         raise NotImplementedError(msg)
 
 
+@cache
+def get_settings() -> Settings:
+    return Settings()
+
+
+@cache
+def get_system_prompt_template() -> Template:
+    """compiled once per process, rendering is then a plain function call over the live documents"""
+    return SandboxedEnvironment().from_string(get_settings().system_prompt_template)
+
+
+@cache
+def get_summary_prompt_template() -> Template:
+    return SandboxedEnvironment().from_string(get_settings().summary_prompt_template)
+
+
+@cache
+def get_map_prompt_template() -> Template:
+    return SandboxedEnvironment().from_string(get_settings().map_prompt_template)
+
+
 @cache
 def get_tokeniser() -> tiktoken.Encoding:
     return tiktoken.get_encoding("cl100k_base")
 
 
+def count_tokens(text: str, chunk_chars: int = 1_000_000) -> int:
+    """Count tokens over chunks of at most chunk_chars, so that memory does not grow with the length of the text.
+
+    Chunks are cut just before a space that follows a word, where the tokeniser would split anyway.
+    """
+    tokeniser = get_tokeniser()
+    count = 0
+    start = 0
+    while len(text) - start > chunk_chars:
+        end = start + chunk_chars
+        while end > start and not (text[end] == " " and not text[end - 1].isspace()):
+            end -= 1
+        if end == start:
+            end = start + chunk_chars
+        count += len(tokeniser.encode(text[start:end], disallowed_special=()))
+        start = end
+    return count + len(tokeniser.encode(text[start:], disallowed_special=()))
+
+
+def _split_segments(text: str, max_chars: int) -> Iterator[tuple[int, int]]:
+    """yield (start, end) offsets of paragraphs, long paragraphs are broken on whitespace to at most max_chars"""
+    start = 0
+    for match in re.finditer(r"\n\s*\n|$", text):
+        end = match.end()
+        while end - start > max_chars:
+            cut = max(text.rfind(" ", start, start + max_chars), text.rfind("\n", start, start + max_chars))
+            if cut <= start:
+                cut = start + max_chars
+            yield start, cut
+            start = cut
+        if end > start:
+            yield start, end
+        start = end
+
+
+def split_text(text: str, chunk_size: int = 512) -> Iterator[tuple[int, int, int]]:
+    """Split text into chunks of roughly chunk_size tokens, breaking on paragraphs where possible.
+
+    Yields (start, end, token_count) so that chunks can be stored as offsets into the original text.
+    """
+    chunk_start, chunk_end, chunk_tokens = 0, 0, 0
+    for start, end in _split_segments(text, max_chars=chunk_size * 2):
+        tokens = count_tokens(text[start:end])
+        if chunk_tokens and chunk_tokens + tokens > chunk_size:
+            yield chunk_start, chunk_end, chunk_tokens
+            chunk_start, chunk_tokens = start, 0
+        chunk_end = end
+        chunk_tokens += tokens
+    if chunk_tokens:
+        yield chunk_start, chunk_end, chunk_tokens
+
+
+def lexical_terms(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class LexicalIndex(BaseModel):
+    """A BM25 index over the chunks of a single document.
+
+    Chunks are held as character offsets into the document text rather than copies of it.
+    """
+
+    spans: list[tuple[int, int]] = Field(default_factory=list)
+    token_counts: list[int] = Field(default_factory=list)
+    term_frequencies: list[dict[str, int]] = Field(default_factory=list)
+
+    @classmethod
+    def from_text(cls, text: str, chunk_size: int = 512) -> "LexicalIndex":
+        index = cls()
+        for start, end, token_count in split_text(text, chunk_size):
+            index.spans.append((start, end))
+            index.token_counts.append(token_count)
+            index.term_frequencies.append(dict(Counter(lexical_terms(text[start:end]))))
+        return index
+
+    def __len__(self) -> int:
+        return len(self.spans)
+
+
+def retrieve_chunks(
+    indexed_documents: Sequence[tuple[Document, LexicalIndex]],
+    query: str,
+    k: int = 32,
+    token_budget: int = 16_000,
+    k1: float = 1.5,
+    b: float = 0.75,
+) -> list[Document]:
+    """Return the k best BM25 matches for the query across all documents, within the token budget.
+
+    Document frequencies are taken across the chunks of every document passed in, so that scores are comparable.
+    The chunks are returned in document order rather than score order, so that a chunk that is selected on
+    consecutive turns keeps its place in the prompt.
+    """
+    n_chunks = sum(len(index) for _, index in indexed_documents)
+    if not n_chunks:
+        return []
+
+    document_frequencies: Counter[str] = Counter()
+    total_length = 0
+    for _, index in indexed_documents:
+        for term_frequencies in index.term_frequencies:
+            document_frequencies.update(term_frequencies.keys())
+            total_length += sum(term_frequencies.values())
+    average_length = total_length / n_chunks or 1
+
+    query_terms = set(lexical_terms(query))
+    idf = {
+        term: math.log(1 + (n_chunks - document_frequencies[term] + 0.5) / (document_frequencies[term] + 0.5))
+        for term in query_terms
+    }
+
+    candidates: list[tuple[float, int, int]] = []
+    for position, (_, index) in enumerate(indexed_documents):
+        for chunk, term_frequencies in enumerate(index.term_frequencies):
+            length = sum(term_frequencies.values())
+            score = sum(
+                idf[term]
+                * term_frequencies[term]
+                * (k1 + 1)
+                / (term_frequencies[term] + k1 * (1 - b + b * length / average_length))
+                for term in query_terms & term_frequencies.keys()
+            )
+            candidates.append((score, position, chunk))
+
+    # stable sort keeps document order for equal scores, so a query with no matches falls back to the opening chunks
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+    selected: list[tuple[int, int]] = []
+    used_tokens = 0
+    for _, position, chunk in candidates:
+        if len(selected) == k:
+            break
+        token_count = indexed_documents[position][1].token_counts[chunk]
+        if used_tokens + token_count > token_budget:
+            continue
+        selected.append((position, chunk))
+        used_tokens += token_count
+
+    results = []
+    for position, chunk in sorted(selected):
+        document, index = indexed_documents[position]
+        start, end = index.spans[chunk]
+        results.append(Document(document.page_content[start:end], metadata={**document.metadata, "chunk": chunk}))
+    return results
+
+
+# LLM clients are shared per backend across the whole process so that turns reuse pooled keep-alive connections to
+# the LiteLLM proxy. Async connections are bound to the event loop that opened them, so those are also keyed by loop.
+_sync_llms: dict[ChatLLMBackend, ChatOpenAI] = {}
+_async_llms: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[ChatLLMBackend, ChatOpenAI]] = (
+    weakref.WeakKeyDictionary()
+)
+_llms_lock = threading.Lock()
+
+
+def _http_client_kwargs(chat_backend: ChatLLMBackend) -> dict:
+    return {
+        "limits": httpx.Limits(
+            max_connections=chat_backend.max_connections,
+            max_keepalive_connections=chat_backend.max_connections,
+            keepalive_expiry=60,
+        ),
+        "timeout": httpx.Timeout(600, connect=10),
+    }
+
+
+def _build_llm(chat_backend: ChatLLMBackend, **http_clients) -> ChatOpenAI:
+    return ChatOpenAI(
+        model=chat_backend.name,
+        base_url=os.environ["LITELLM_PROXY_API_BASE"],
+        api_key=os.environ["LITELLM_PROXY_API_KEY"],
+        # usage is needed on streamed responses too, to record how much of the prompt the provider had cached
+        stream_usage=True,
+        **http_clients,
+    )
+
+
+def get_chat_llm(chat_backend: ChatLLMBackend) -> ChatOpenAI:
+    """Return the process-wide ChatOpenAI for this backend, for the running event loop if there is one.
+
+    Chats set their own temperature, so each temperature gets a copy of the backend's ChatOpenAI that shares its pool.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    pooled = chat_backend.model_copy(update={"temperature": None})
+    with _llms_lock:
+        if loop is None:
+            if pooled not in _sync_llms:
+                http_client = httpx.Client(**_http_client_kwargs(pooled))
+                _sync_llms[pooled] = _build_llm(pooled, http_client=http_client)
+            llm = _sync_llms[pooled]
+        else:
+            llms = _async_llms.setdefault(loop, {})
+            if pooled not in llms:
+                http_async_client = httpx.AsyncClient(**_http_client_kwargs(pooled))
+                llms[pooled] = _build_llm(pooled, http_async_client=http_async_client)
+            llm = llms[pooled]
+
+    if chat_backend.temperature is None:
+        return llm
+    return llm.model_copy(update={"temperature": chat_backend.temperature})
+
+
+async def aclose_chat_llms() -> None:
+    """close the pooled connections opened from the running event loop"""
+    with _llms_lock:
+        llms = _async_llms.pop(asyncio.get_running_loop(), {})
+    for llm in llms.values():
+        await llm.http_async_client.aclose()
+
+
+@atexit.register
+def close_chat_llms() -> None:
+    """close every pooled connection, async clients are closed on their own loop where it is still usable"""
+    with _llms_lock:
+        sync_llms = list(_sync_llms.values())
+        _sync_llms.clear()
+        async_llms = list(_async_llms.items())
+        _async_llms.clear()
+
+    for llm in sync_llms:
+        llm.http_client.close()
+    for loop, llms in async_llms:
+        if loop.is_closed() or loop.is_running():
+            continue
+        for llm in llms.values():
+            loop.run_until_complete(llm.http_async_client.aclose())
+
+
+# providers that only reuse a cached prompt prefix when it is explicitly marked, OpenAI caches long prefixes unprompted
+CACHE_CONTROL_PROVIDERS = frozenset({"anthropic", "bedrock", "bedrock_converse"})
+
+
+def get_cached_token_count(message: AIMessage) -> int | None:
+    """number of prompt tokens the provider read from its prefix cache, if it said"""
+    if not message.usage_metadata:
+        return None
+    return message.usage_metadata.get("input_token_details", {}).get("cache_read")
+
+
 class RedboxState(BaseModel):
     documents: list[Document] = Field(description="List of files to process", default_factory=list)
     messages: list[AnyMessage] = Field(description="All previous messages in chat", default_factory=list)
     chat_backend: ChatLLMBackend = Field(description="User request AI settings", default_factory=ChatLLMBackend)
+    summary: str | None = Field(description="Running summary of messages no longer sent verbatim", default=None)
 
-    def get_llm(self):
-        api_key = os.environ["LITELLM_PROXY_API_KEY"]
-        base_url = os.environ["LITELLM_PROXY_API_BASE"]
-        return ChatOpenAI(model=self.chat_backend.name, base_url=base_url, api_key=api_key)
+    def get_llm(self) -> ChatOpenAI:
+        return get_chat_llm(self.chat_backend)
 
     def get_messages(self) -> list[BaseMessage]:
-        settings = Settings()
+        """The system prompt, with the documents, comes first and holds nothing that changes from turn to turn.
+
+        That keeps it byte-identical across the turns of a chat so that providers can serve it from their prompt cache.
+        """
+        system_prompt = get_system_prompt_template().render(documents=self.documents, summary=self.summary)
+        if self.chat_backend.provider in CACHE_CONTROL_PROVIDERS:
+            content = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+            return [HumanMessage(content=content), *self.messages]
+        return StringPromptValue(text=system_prompt).to_messages() + self.messages
+
+
+def summarise_messages(messages: Sequence[AnyMessage], chat_backend: ChatLLMBackend, summary: str | None = None) -> str:
+    """Fold messages into the running summary of a conversation, returning the updated summary."""
+    prompt = get_summary_prompt_template().render(messages=messages, summary=summary)
+    return get_chat_llm(chat_backend).invoke(prompt).content
 
-        input_state = self.model_dump()
-        system_messages = (
-            PromptTemplate.from_template(settings.system_prompt_template, template_format="jinja2")
-            .invoke(input=input_state)
-            .to_messages()
-        )
-        return system_messages + self.messages
+
+class ResponseCache:
+    """An in-process cache of LLM answers, keyed on everything that goes into the request.
+
+    Entries expire after ttl seconds, and the least recently used are evicted once the answers held exceed max_bytes.
+    """
+
+    def __init__(self, ttl: float = 3600, max_bytes: int = 64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(state: "RedboxState") -> str:
+        documents = [
+            hashlib.sha256(json.dumps([d.page_content, d.metadata], sort_keys=True, default=str).encode()).hexdigest()
+            for d in state.documents
+        ]
+        messages = [[m.type, m.content] for m in state.messages]
+        request = [
+            state.chat_backend.model_dump(),
+            get_settings().system_prompt_template,
+            documents,
+            state.summary,
+            messages,
+        ]
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            expires, content = self._entries[key]
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return content
+
+    def set(self, key: str, content: str) -> None:
+        size = len(content.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = time.monotonic() + self.ttl, content
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key: str) -> None:
+        _, content = self._entries.pop(key)
+        self.size -= len(content.encode())
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
 
 async def _default_callback(*args, **kwargs):
     return None
 
 
-def run_sync(state: RedboxState) -> tuple[BaseMessage, timedelta]:
+class TokenBuffer:
+    """Coalesces streamed tokens into fewer, larger, calls to callback.
+
+    Buffered text is passed on once it reaches max_chars, or max_delay seconds after the first token in it arrived,
+    whichever is sooner, so a slow stream is no less responsive. Calls to callback are made one at a time and in order.
+    """
+
+    def __init__(self, callback, max_delay: float = 0.03, max_chars: int = 256):
+        self.callback = callback
+        self.max_delay = max_delay
+        self.max_chars = max_chars
+        self._parts: list[str] = []
+        self._size = 0
+        self._lock = asyncio.Lock()
+        self._timer: asyncio.TimerHandle | None = None
+        self._scheduled_flush: asyncio.Task | None = None
+
+    async def write(self, text: str) -> None:
+        if not text:
+            return
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.max_chars:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._flush_later)
+
+    def _flush_later(self) -> None:
+        self._timer = None
+        self._scheduled_flush = asyncio.ensure_future(self.flush())
+
+    async def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._parts:
+                return
+            text = "".join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            await self.callback(text)
+
+    async def aclose(self) -> None:
+        """pass on whatever is left in the buffer"""
+        await self.flush()
+        if self._scheduled_flush is not None:
+            await self._scheduled_flush
+
+
+def turn_timings(
+    start: datetime.datetime,
+    prompt_built: datetime.datetime,
+    first_token: datetime.datetime,
+    end: datetime.datetime,
+    output_tokens: int | None = None,
+) -> dict:
+    """the phases of a single LLM call, as recorded in response_metadata["timings"]"""
+    streaming = end - first_token
+    return {
+        "prompt_build": prompt_built - start,
+        "time_to_first_token": first_token - start,
+        "streaming": streaming,
+        "tokens_per_second": output_tokens / streaming.total_seconds()
+        if output_tokens and streaming.total_seconds()
+        else None,
+    }
+
+
+def _estimated_usage(prompt: str, answer: str) -> UsageMetadata:
+    """usage of a call the LLM did not report it for"""
+    input_tokens, output_tokens = count_tokens(prompt), count_tokens(answer)
+    return UsageMetadata(
+        input_tokens=input_tokens, output_tokens=output_tokens, total_tokens=input_tokens + output_tokens
+    )
+
+
+def _output_token_count(message: AIMessage) -> int:
+    if message.usage_metadata:
+        return message.usage_metadata["output_tokens"]
+    return count_tokens(message.content)
+
+
+def run_sync(state: RedboxState, response_cache: ResponseCache | None = None) -> tuple[BaseMessage, timedelta]:
     """
     Run Redbox without streaming events. This simpler, synchronous execution enables use of the graph debug logging
     """
     start = datetime.datetime.now()
-    result = state.get_llm().invoke(input=state.get_messages())
+    if response_cache is not None:
+        key = response_cache.key(state)
+        if (content := response_cache.get(key)) is not None:
+            end = datetime.datetime.now()
+            timings = turn_timings(start, start, end, end)
+            return AIMessage(content=content, response_metadata={"cache_hit": True, "timings": timings}), end - start
+
+    messages = state.get_messages()
+    prompt_built = datetime.datetime.now()
+    result = state.get_llm().invoke(input=messages)
     end = datetime.datetime.now()
+
+    # the whole answer arrives at once
+    result.response_metadata["timings"] = turn_timings(start, prompt_built, end, end)
+    if response_cache is not None:
+        response_cache.set(key, result.content)
+        result.response_metadata["cache_hit"] = False
     return result, end - start
 
 
 async def run_async(
     state: RedboxState,
     response_tokens_callback=_default_callback,
+    response_cache: ResponseCache | None = None,
+    flush_interval: float = 0.03,
+    flush_chars: int = 256,
 ) -> tuple[AIMessage, timedelta]:
+    """Stream the answer to response_tokens_callback, coalesced by a TokenBuffer with the given flush policy.
+
+    The phases of the call are returned in response_metadata["timings"], see turn_timings.
+    """
     start = datetime.datetime.now()
-    final_message = ""
-    async for chunk in state.get_llm().astream(
-        state.get_messages(),
-    ):
-        final_message += chunk.content
-        await response_tokens_callback(chunk.content)
-    return AIMessage(content=final_message), datetime.datetime.now() - start
+    if response_cache is not None:
+        key = response_cache.key(state)
+        if (content := response_cache.get(key)) is not None:
+            await response_tokens_callback(content)
+            end = datetime.datetime.now()
+            timings = turn_timings(start, start, end, end)
+            return AIMessage(content=content, response_metadata={"cache_hit": True, "timings": timings}), end - start
+
+    messages = state.get_messages()
+    prompt_built = datetime.datetime.now()
+    first_token = None
+    parts: list[str] = []
+    usage_metadata: UsageMetadata | None = None
+    buffer = TokenBuffer(response_tokens_callback, max_delay=flush_interval, max_chars=flush_chars)
+    try:
+        # aclosing closes the stream, and so the connection to the provider, as soon as the turn is cancelled
+        async with contextlib.aclosing(state.get_llm().astream(messages)) as stream:
+            async for chunk in stream:
+                if first_token is None and chunk.content:
+                    first_token = datetime.datetime.now()
+                parts.append(chunk.content)
+                if chunk.usage_metadata:
+                    usage_metadata = add_usage(usage_metadata, chunk.usage_metadata)
+                await buffer.write(chunk.content)
+    finally:
+        await buffer.aclose()
+    end = datetime.datetime.now()
+
+    final_message = AIMessage(content="".join(parts), usage_metadata=usage_metadata)
+    final_message.response_metadata["timings"] = turn_timings(
+        start, prompt_built, first_token or end, end, _output_token_count(final_message)
+    )
+    if response_cache is not None:
+        response_cache.set(key, final_message.content)
+        final_message.response_metadata["cache_hit"] = False
+    return final_message, end - start
+
+
+async def run_map_reduce(
+    state: RedboxState,
+    response_tokens_callback=_default_callback,
+    progress_callback=_default_callback,
+    concurrency: int = 4,
+    flush_interval: float = 0.03,
+    flush_chars: int = 256,
+) -> tuple[AIMessage, timedelta]:
+    """Answer over documents that are too large for the context window of any model.
+
+    The documents are split into sections of a quarter of the context window and the LLM makes notes on each,
+    at most concurrency at a time. Notes are combined in the same way until they fit in a section, and the answer
+    is then streamed as in run_async, with the notes taking the place of the documents. The notes are made for the
+    latest question and the summary, the rest of the history is only sent with the answer. The usage of the answer
+    includes that of every call made for the notes.
+    """
+    start = datetime.datetime.now()
+    section_size = state.chat_backend.context_window_size // 4
+    semaphore = asyncio.Semaphore(concurrency)
+    usage_metadata: UsageMetadata | None = None
+    question = state.messages[-1].content if state.messages else ""
+
+    async def make_notes(sections: list[Document], stage: str) -> list[Document]:
+        done = 0
+
+        async def make_note(section: Document) -> Document:
+            nonlocal done, usage_metadata
+            async with semaphore:
+                prompt = get_map_prompt_template().render(document=section, question=question, summary=state.summary)
+                note = await state.get_llm().ainvoke(prompt)
+            usage_metadata = add_usage(usage_metadata, note.usage_metadata or _estimated_usage(prompt, note.content))
+            done += 1
+            await progress_callback(f"{stage} {done} of {len(sections)} sections")
+            return Document(note.content, metadata=section.metadata)
+
+        return list(await asyncio.gather(*map(make_note, sections)))
+
+    sections = [
+        Document(document.page_content[section_start:section_end], metadata={**document.metadata, "chunk": chunk})
+        for document in state.documents
+        for chunk, (section_start, section_end, _) in enumerate(split_text(document.page_content, section_size))
+    ]
+    notes = await make_notes(sections, "Read")
+
+    while len(notes) > 1 and sum(count_tokens(note.page_content) for note in notes) > section_size:
+        batches: list[list[Document]] = [[]]
+        batch_tokens = 0
+        for note in notes:
+            tokens = count_tokens(note.page_content)
+            if batches[-1] and batch_tokens + tokens > section_size:
+                batches.append([])
+                batch_tokens = 0
+            batches[-1].append(note)
+            batch_tokens += tokens
+        if len(batches) == len(notes):
+            break
+        combined = [
+            Document("\n\n".join(note.page_content for note in batch), metadata=batch[0].metadata) for batch in batches
+        ]
+        notes = await make_notes(combined, "Combined")
+
+    await progress_callback("Writing answer")
+    answer_start = datetime.datetime.now()
+    message, _ = await run_async(
+        state.model_copy(update={"documents": notes}),
+        response_tokens_callback,
+        flush_interval=flush_interval,
+        flush_chars=flush_chars,
+    )
+    # the sections are read before the first token of the answer can arrive
+    message.response_metadata["timings"]["time_to_first_token"] += answer_start - start
+    if message.usage_metadata is None and not message.response_metadata.get("cache_hit"):
+        prompt = "\n\n".join([*(note.page_content for note in notes), *(str(m.content) for m in state.messages)])
+        message.usage_metadata = _estimated_usage(prompt, message.content)
+    message.usage_metadata = add_usage(usage_metadata, message.usage_metadata)
+    return message, datetime.datetime.now() - start
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from redbox import ChatLLMBackend, RedboxState, aclose_chat_llms, close_chat_llms, get_chat_llm
+
+
+@pytest.fixture(autouse=True)
+def litellm_proxy(monkeypatch):
+    monkeypatch.setenv("LITELLM_PROXY_API_BASE", "http://litellm:4000")
+    monkeypatch.setenv("LITELLM_PROXY_API_KEY", "sk-test")
+    yield
+    close_chat_llms()
+
+
+def test_get_chat_llm_is_shared_per_backend():
+    gpt_4o = ChatLLMBackend(name="gpt-4o")
+
+    assert get_chat_llm(gpt_4o) is get_chat_llm(ChatLLMBackend(name="gpt-4o"))
+    assert get_chat_llm(gpt_4o) is RedboxState(chat_backend=gpt_4o).get_llm()
+    assert get_chat_llm(gpt_4o) is not get_chat_llm(ChatLLMBackend(name="gpt-4o", max_connections=2))
+
+
+def test_close_chat_llms():
+    llm = get_chat_llm(ChatLLMBackend())
+    close_chat_llms()
+
+    assert llm.http_client.is_closed
+    assert get_chat_llm(ChatLLMBackend()) is not llm
+
+
+def test_get_chat_llm_async_is_shared_within_loop():
+    async def get_llms():
+        llms = get_chat_llm(ChatLLMBackend()), get_chat_llm(ChatLLMBackend())
+        await aclose_chat_llms()
+        return llms
+
+    first, second = asyncio.run(get_llms())
+
+    assert first is second
+    assert first is not get_chat_llm(ChatLLMBackend())
+    assert first.http_async_client.is_closed
+
+
+def test_get_chat_llm_shares_the_pool_between_temperatures():
+    default, warm = get_chat_llm(ChatLLMBackend()), get_chat_llm(ChatLLMBackend(temperature=0.7))
+
+    assert warm.temperature == 0.7
+    assert default.temperature is None
+    assert warm.root_client is default.root_client
@@ -0,0 +1,89 @@
+import asyncio
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+
+from redbox import ChatLLMBackend, RedboxState, run_map_reduce, split_text
+
+
+class FakeLLM:
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.final_prompt = None
+        self.final_messages = []
+        self.map_prompts = []
+        self.calls = 0
+
+    async def ainvoke(self, prompt):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        self.calls += 1
+        self.map_prompts.append(prompt)
+        section = prompt.split("Title: ")[1].split("\n")[0]
+        return AIMessage(
+            content=f"notes on {section}",
+            usage_metadata={"input_tokens": 100, "output_tokens": 10, "total_tokens": 110},
+        )
+
+    async def astream(self, messages):
+        self.final_prompt = messages[0].content
+        self.final_messages = messages
+        yield AIMessageChunk(content="the ")
+        yield AIMessageChunk(
+            content="answer", usage_metadata={"input_tokens": 50, "output_tokens": 2, "total_tokens": 52}
+        )
+
+
+def test_run_map_reduce(monkeypatch):
+    llm = FakeLLM()
+    monkeypatch.setattr(RedboxState, "get_llm", lambda _: llm)
+    state = RedboxState(
+        documents=[Document("lorem ipsum " * 2000, metadata={"uri": "consultation.pdf"})],
+        messages=[HumanMessage(content="what do respondents say?")],
+        chat_backend=ChatLLMBackend(context_window_size=1000),
+    )
+    tokens, progress = [], []
+
+    async def on_token(token):
+        tokens.append(token)
+
+    async def on_progress(message):
+        progress.append(message)
+
+    message, _ = asyncio.run(
+        run_map_reduce(state, response_tokens_callback=on_token, progress_callback=on_progress, concurrency=3)
+    )
+
+    assert message.content == "the answer"
+    assert tokens == ["the answer"]
+    assert llm.max_running == 3
+    n_sections = len(list(split_text(state.documents[0].page_content, 250)))
+    assert progress[:n_sections] == [f"Read {i} of {n_sections} sections" for i in range(1, n_sections + 1)]
+    assert progress[-1] == "Writing answer"
+    assert "notes on consultation.pdf" in llm.final_prompt
+    assert "lorem ipsum" not in llm.final_prompt
+    # the rate limit is charged for reading every section, not only for the answer
+    assert message.usage_metadata["total_tokens"] == 110 * llm.calls + 52
+
+
+def test_run_map_reduce_makes_notes_for_the_latest_question(monkeypatch):
+    llm = FakeLLM()
+    monkeypatch.setattr(RedboxState, "get_llm", lambda _: llm)
+    history = [HumanMessage(content="an earlier question"), AIMessage(content="an earlier answer")]
+    state = RedboxState(
+        documents=[Document("lorem ipsum " * 2000, metadata={"uri": "consultation.pdf"})],
+        messages=[*history, HumanMessage(content="what do respondents say?")],
+        chat_backend=ChatLLMBackend(context_window_size=1000),
+        summary="a summary of the chat",
+    )
+
+    asyncio.run(run_map_reduce(state))
+
+    # each section is read with only the question and the summary, the history is sent once with the answer
+    assert all("what do respondents say?" in prompt for prompt in llm.map_prompts)
+    assert all("a summary of the chat" in prompt for prompt in llm.map_prompts)
+    assert not any("an earlier" in prompt for prompt in llm.map_prompts)
+    assert [message.content for message in llm.final_messages[1:3]] == ["an earlier question", "an earlier answer"]
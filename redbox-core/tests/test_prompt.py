@@ -0,0 +1,83 @@
+import asyncio
+from unittest.mock import patch
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.prompts import PromptTemplate
+
+from redbox import (
+    ChatLLMBackend,
+    RedboxState,
+    get_cached_token_count,
+    get_settings,
+    get_system_prompt_template,
+    run_async,
+)
+
+
+def test_get_messages_matches_prompt_template():
+    state = RedboxState(
+        documents=[
+            Document("some text", metadata={"uri": "alice@example.com/a.txt"}),
+            Document("more text", metadata={}),
+        ],
+        messages=[HumanMessage(content="hello")],
+    )
+    expected = (
+        PromptTemplate.from_template(get_settings().system_prompt_template, template_format="jinja2")
+        .invoke(input=state.model_dump())
+        .to_messages()
+    )
+
+    assert state.get_messages() == [*expected, HumanMessage(content="hello")]
+
+
+def test_get_messages_without_documents():
+    messages = RedboxState(messages=[HumanMessage(content="hello")]).get_messages()
+
+    assert "Use the following documents" not in messages[0].content
+    assert messages[1:] == [HumanMessage(content="hello")]
+
+
+def test_system_prompt_template_is_compiled_once():
+    assert get_system_prompt_template() is get_system_prompt_template()
+
+
+def test_get_messages_marks_cacheable_prefix_for_anthropic():
+    documents = [Document("some text", metadata={"uri": "alice@example.com/a.txt"})]
+    first = RedboxState(
+        documents=documents,
+        messages=[HumanMessage(content="hello")],
+        chat_backend=ChatLLMBackend(name="claude-3-5-sonnet", provider="anthropic"),
+    )
+    follow_up = first.model_copy(
+        update={"messages": [*first.messages, AIMessage(content="hi"), HumanMessage(content="summarise")]}
+    )
+
+    [block] = first.get_messages()[0].content
+    assert block["cache_control"] == {"type": "ephemeral"}
+    assert block["text"] == RedboxState(documents=documents).get_messages()[0].content
+    assert follow_up.get_messages()[0] == first.get_messages()[0]
+
+
+def test_run_async_records_cached_tokens():
+    class FakeLLM:
+        async def astream(self, _messages):
+            yield AIMessageChunk(content="an ")
+            yield AIMessageChunk(content="answer")
+            yield AIMessageChunk(
+                content="",
+                usage_metadata={
+                    "input_tokens": 2000,
+                    "output_tokens": 2,
+                    "total_tokens": 2002,
+                    "input_token_details": {"cache_read": 1800},
+                },
+            )
+
+    with patch("redbox.RedboxState.get_llm", return_value=FakeLLM()):
+        message, _ = asyncio.run(run_async(RedboxState(messages=[HumanMessage(content="hello")])))
+
+    assert message.content == "an answer"
+    assert get_cached_token_count(message) == 1800
+    assert get_cached_token_count(AIMessage(content="no usage")) is None
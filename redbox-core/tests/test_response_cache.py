@@ -0,0 +1,81 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+
+from redbox import ChatLLMBackend, RedboxState, ResponseCache, run_async, run_sync
+
+
+def make_state(document="some text", question="summarise this document", temperature=None):
+    return RedboxState(
+        documents=[Document(document, metadata={"uri": "alice@example.com/a.txt"})],
+        messages=[HumanMessage(content=question)],
+        chat_backend=ChatLLMBackend(temperature=temperature),
+    )
+
+
+def test_key_covers_request():
+    key = ResponseCache.key(make_state())
+
+    assert key == ResponseCache.key(make_state())
+    assert key != ResponseCache.key(make_state(document="other text"))
+    assert key != ResponseCache.key(make_state(question="what is this about?"))
+    assert key != ResponseCache.key(make_state(temperature=0.2))
+
+
+def test_entries_expire():
+    cache = ResponseCache(ttl=10)
+    with patch("redbox.time.monotonic", return_value=0):
+        cache.set("a", "answer")
+    with patch("redbox.time.monotonic", return_value=5):
+        assert cache.get("a") == "answer"
+    with patch("redbox.time.monotonic", return_value=11):
+        assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_evicted_by_size():
+    cache = ResponseCache(max_bytes=10)
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+    cache.get("a")
+    cache.set("c", "cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.get("c") == "cccc"
+    assert cache.size == 8
+
+    cache.set("d", "d" * 11)
+    assert cache.get("d") is None
+
+
+def test_run_sync_with_response_cache():
+    cache = ResponseCache()
+    llm = MagicMock()
+    llm.invoke.return_value = AIMessage(content="an answer")
+
+    with patch("redbox.RedboxState.get_llm", return_value=llm):
+        first, _ = run_sync(make_state(), response_cache=cache)
+        second, _ = run_sync(make_state(), response_cache=cache)
+
+    assert llm.invoke.call_count == 1
+    assert (first.content, first.response_metadata["cache_hit"]) == ("an answer", False)
+    assert (second.content, second.response_metadata["cache_hit"]) == ("an answer", True)
+
+
+def test_run_async_streams_cached_answer():
+    cache = ResponseCache()
+    cache.set(ResponseCache.key(make_state()), "a cached answer")
+    tokens = []
+
+    async def callback(token):
+        tokens.append(token)
+
+    with patch("redbox.RedboxState.get_llm") as get_llm:
+        message, _ = asyncio.run(run_async(make_state(), response_tokens_callback=callback, response_cache=cache))
+
+    get_llm.assert_not_called()
+    assert tokens == ["a cached answer"]
+    assert message.response_metadata["cache_hit"]
@@ -0,0 +1,73 @@
+from langchain_core.documents import Document
+
+from redbox import LexicalIndex, count_tokens, get_tokeniser, retrieve_chunks, split_text
+
+
+def test_split_text_covers_text_within_chunk_size():
+    text = "\n\n".join(f"paragraph {i} " + "word " * 50 for i in range(40))
+
+    chunks = list(split_text(text, chunk_size=128))
+
+    assert len(chunks) > 1
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == len(text)
+    for (_, end, _), (next_start, _, _) in zip(chunks, chunks[1:], strict=False):
+        assert end == next_start
+    for start, end, token_count in chunks:
+        assert token_count <= 128
+        assert token_count == count_tokens(text[start:end])
+
+
+def test_split_text_breaks_long_paragraphs():
+    text = "lorem ipsum " * 2000
+
+    chunks = list(split_text(text, chunk_size=100))
+
+    assert len(chunks) > 10
+    assert "".join(text[start:end] for start, end, _ in chunks) == text
+
+
+def test_retrieve_chunks_prefers_matching_chunks():
+    text = "\n\n".join(["the cat sat on the mat " * 20, "budget spending review " * 20, "the dog chased the cat " * 20])
+    document = Document(text, metadata={"uri": "a.txt"})
+    index = LexicalIndex.from_text(text, chunk_size=64)
+
+    results = retrieve_chunks([(document, index)], query="what did the spending review say?", k=1)
+
+    assert len(results) == 1
+    assert "spending review" in results[0].page_content
+    assert results[0].metadata["uri"] == "a.txt"
+
+
+def test_retrieve_chunks_respects_token_budget():
+    texts = ["alpha beta gamma " * 100, "alpha delta " * 100]
+    indexed = [(Document(text), LexicalIndex.from_text(text, chunk_size=64)) for text in texts]
+
+    results = retrieve_chunks(indexed, query="alpha", k=100, token_budget=200)
+
+    assert results
+    assert sum(count_tokens(result.page_content) for result in results) <= 200
+
+
+def test_retrieve_chunks_keeps_document_order():
+    texts = ["nothing relevant here " * 60 + "\n\n" + "tax " * 20, "tax tax tax " * 20]
+    indexed = [
+        (Document(text, metadata={"uri": uri}), LexicalIndex.from_text(text, chunk_size=64))
+        for text, uri in zip(texts, ["a", "b"], strict=True)
+    ]
+
+    results = retrieve_chunks(indexed, query="tax", k=2)
+
+    assert [(result.metadata["uri"], result.metadata["chunk"]) for result in results] == [("a", 3), ("b", 0)]
+
+
+def test_lexical_index_round_trips():
+    index = LexicalIndex.from_text("hello world\n\nhello again", chunk_size=2)
+
+    assert LexicalIndex.model_validate(index.model_dump()) == index
+
+
+def test_count_tokens_in_chunks():
+    text = "the spending review, 2024\n\n" * 2000
+
+    assert count_tokens(text, chunk_chars=1000) == count_tokens(text) == len(get_tokeniser().encode(text))
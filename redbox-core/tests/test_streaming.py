@@ -0,0 +1,118 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from langchain_core.messages import AIMessageChunk, HumanMessage
+
+from redbox import RedboxState, TokenBuffer, run_async
+
+
+def collect():
+    frames = []
+
+    async def callback(text):
+        await asyncio.sleep(0)
+        frames.append(text)
+
+    return frames, callback
+
+
+def test_token_buffer_flushes_on_size():
+    frames, callback = collect()
+
+    async def stream():
+        buffer = TokenBuffer(callback, max_delay=60, max_chars=10)
+        for token in ["abc", "def", "ghij", "kl", "m"]:
+            await buffer.write(token)
+        await buffer.aclose()
+
+    asyncio.run(stream())
+
+    assert frames == ["abcdefghij", "klm"]
+
+
+def test_token_buffer_flushes_on_time():
+    frames, callback = collect()
+
+    async def stream():
+        buffer = TokenBuffer(callback, max_delay=0.01, max_chars=1000)
+        await buffer.write("slow ")
+        await asyncio.sleep(0.05)
+        assert frames == ["slow "]
+        await buffer.write("tokens")
+        await buffer.write(" arrive")
+        await buffer.aclose()
+
+    asyncio.run(stream())
+
+    assert frames == ["slow ", "tokens arrive"]
+
+
+def test_run_async_coalesces_tokens(monkeypatch):
+    class FakeLLM:
+        async def astream(self, _messages):
+            for i in range(100):
+                yield AIMessageChunk(content=f"{i} ")
+
+    monkeypatch.setattr(RedboxState, "get_llm", lambda _: FakeLLM())
+    frames, callback = collect()
+
+    message, _ = asyncio.run(run_async(RedboxState(messages=[HumanMessage(content="count")]), callback, flush_chars=50))
+
+    assert message.content == "".join(f"{i} " for i in range(100))
+    assert "".join(frames) == message.content
+    assert len(frames) < 10
+
+
+def test_run_async_times_phases(monkeypatch):
+    class SlowLLM:
+        async def astream(self, _messages):
+            await asyncio.sleep(0.05)
+            yield AIMessageChunk(content="first ")
+            await asyncio.sleep(0.05)
+            yield AIMessageChunk(
+                content="last",
+                usage_metadata={"input_tokens": 10, "output_tokens": 4, "total_tokens": 14},
+            )
+
+    monkeypatch.setattr(RedboxState, "get_llm", lambda _: SlowLLM())
+
+    message, total = asyncio.run(run_async(RedboxState(messages=[HumanMessage(content="hello")])))
+
+    timings = message.response_metadata["timings"]
+    assert timedelta(seconds=0.05) <= timings["time_to_first_token"] < timedelta(seconds=0.1)
+    assert timedelta(seconds=0.05) <= timings["streaming"] < timedelta(seconds=0.1)
+    assert timings["prompt_build"] <= timings["time_to_first_token"]
+    assert timings["time_to_first_token"] + timings["streaming"] <= total
+    assert timings["tokens_per_second"] == pytest.approx(4 / timings["streaming"].total_seconds())
+
+
+def test_cancelling_run_async_closes_the_stream(monkeypatch):
+    closed = []
+
+    class EndlessLLM:
+        async def astream(self, _messages):
+            try:
+                while True:
+                    yield AIMessageChunk(content="more ")
+            finally:
+                closed.append(True)
+
+    monkeypatch.setattr(RedboxState, "get_llm", lambda _: EndlessLLM())
+    frames = []
+
+    async def callback(text):
+        frames.append(text)
+        await asyncio.sleep(3600)
+
+    async def cancel_after_first_frame():
+        task = asyncio.create_task(run_async(RedboxState(messages=[HumanMessage(content="go on")]), callback))
+        while not frames:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_after_first_frame())
+
+    assert closed == [True]